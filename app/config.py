@@ -1,4 +1,5 @@
 import os
+import socket
 
 # Modify it match our system configs
 
@@ -14,3 +15,184 @@ class Config:
 
         ),
     )
+
+    # Optional read replica for read only operations, same URL format as DB_CONFIG
+    DB_REPLICA_CONFIG = os.getenv("DB_REPLICA_CONFIG")
+
+    # SQLAlchemy pool and asyncpg prepared statement cache, per engine and per worker process
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 20))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 30 * 60))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", 500))
+
+    REDIS_HOST = os.getenv("REDIS_HOST", "localhost")
+    REDIS_PORT = int(os.getenv("REDIS_PORT", 6379))
+
+    # Shared Pub/Sub multiplexer
+    PUBSUB_POLL_INTERVAL = float(os.getenv("PUBSUB_POLL_INTERVAL", 0.05))
+    PUBSUB_RECONNECT_MAX_DELAY = float(
+        os.getenv("PUBSUB_RECONNECT_MAX_DELAY", 10.0))
+
+    # Session fan-out transport. "pubsub" is fire and forget, "streams" appends every session message
+    # to a capped Redis Stream so that a reconnecting client resumes from its last seen id. In streams
+    # mode every frame is sent as {"id": <entry id>, "data": <message>}.
+    FANOUT_MODE = os.getenv("FANOUT_MODE", "pubsub")
+    # Approximate number of messages kept per session stream, also the longest possible replay
+    SESSION_STREAM_MAXLEN = int(os.getenv("SESSION_STREAM_MAXLEN", 1000))
+    SESSION_STREAM_READ_COUNT = int(os.getenv("SESSION_STREAM_READ_COUNT", 100))
+
+    # WebSocket fan-out: per-connection outbound queue and what to do when it is full
+    # (drop_oldest | coalesce | disconnect)
+    WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", 256))
+    WS_SLOW_CONSUMER_POLICY = os.getenv("WS_SLOW_CONSUMER_POLICY", "drop_oldest")
+
+    # Write pre-encoded broadcast frames straight to the socket transport when the ASGI server allows it,
+    # falling back to `send_text` while the transport buffer is above the high water mark
+    WS_RAW_FRAMES = os.getenv("WS_RAW_FRAMES", "1") == "1"
+    WS_RAW_FRAMES_HIGH_WATER = int(os.getenv("WS_RAW_FRAMES_HIGH_WATER", 64 * 1024))
+
+    # Connection lifecycle: every WS_HEARTBEAT_INTERVAL the server sends {"ping": <ms>} to each socket,
+    # clients answer {"pong": <ms>}. A socket silent for WS_IDLE_TIMEOUT is evicted. On shutdown the
+    # sockets get WS_DRAIN_TIMEOUT to flush their queues, then close with 1012 and a reconnect delay
+    # drawn up to WS_RECONNECT_SPREAD seconds, so the clients of a node do not come back all at once.
+    WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", 15.0))
+    WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", 45.0))
+    WS_DRAIN_TIMEOUT = float(os.getenv("WS_DRAIN_TIMEOUT", 5.0))
+    WS_RECONNECT_SPREAD = float(os.getenv("WS_RECONNECT_SPREAD", 10.0))
+
+    # Whether the server negotiates permessage-deflate, pass the same value to uvicorn's
+    # --ws-per-message-deflate. Compressed connections skip the raw frames, which are never compressed.
+    WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "0") == "1"
+
+    # Coalescing of busy sessions: the messages of an opted-in session arriving within the window are
+    # sent as one {"batch": [...]} frame. WS_COALESCE_SESSIONS is "*" or a comma separated list of ids.
+    WS_COALESCE_SESSIONS = os.getenv("WS_COALESCE_SESSIONS", "")
+    WS_COALESCE_WINDOW = float(os.getenv("WS_COALESCE_WINDOW", 0.01))
+    WS_COALESCE_MAX_BATCH = int(os.getenv("WS_COALESCE_MAX_BATCH", 100))
+
+    # Session ownership across API workers: every node owns the sessions the consistent hash ring gives
+    # it, and only the owner accepts their sockets. A node is the address the gateway routes to, so run
+    # one uvicorn worker per address.
+    SHARDING_ENABLED = os.getenv("SHARDING_ENABLED", "0") == "1"
+    SHARD_NODE_ADDRESS = os.getenv(
+        "SHARD_NODE_ADDRESS", f"{socket.gethostname()}:8000")
+    SHARD_VNODES = int(os.getenv("SHARD_VNODES", 64))
+    SHARD_HEARTBEAT_INTERVAL = float(os.getenv("SHARD_HEARTBEAT_INTERVAL", 2.0))
+    # A node missing its heartbeats for that long leaves the ring
+    SHARD_NODE_TTL = float(os.getenv("SHARD_NODE_TTL", 6.0))
+
+    # Presence: changes are aggregated and published as one diff per session every tick, users whose
+    # sockets stopped heartbeating for PRESENCE_TTL go offline, typing wears off after PRESENCE_TYPING_TTL
+    PRESENCE_TICK = float(os.getenv("PRESENCE_TICK", 0.5))
+    PRESENCE_TTL = float(os.getenv("PRESENCE_TTL", 30.0))
+    PRESENCE_TYPING_TTL = float(os.getenv("PRESENCE_TYPING_TTL", 5.0))
+    # Presence updates accepted per user and per second, the rest are dropped
+    PRESENCE_RATE_LIMIT = int(os.getenv("PRESENCE_RATE_LIMIT", 5))
+
+    # Read state: read-acks from the sockets are aggregated and applied to Redis every READ_STATE_TICK,
+    # the cursors that moved are copied to Postgres by `flush_read_cursors`, at most
+    # READ_CURSOR_FLUSH_BATCH per run
+    READ_STATE_TICK = float(os.getenv("READ_STATE_TICK", 0.5))
+    READ_CURSOR_FLUSH_INTERVAL = float(os.getenv("READ_CURSOR_FLUSH_INTERVAL", 5.0))
+    READ_CURSOR_FLUSH_BATCH = int(os.getenv("READ_CURSOR_FLUSH_BATCH", 1000))
+    # Unread messages remembered per user and session, the counter stops there
+    READ_STATE_UNREAD_MAX = int(os.getenv("READ_STATE_UNREAD_MAX", 1000))
+
+    # Edge admission control. Token buckets in messages per second and burst size: per user and per
+    # session shared by all nodes through Redis, per connection local to its process. A process leases
+    # RATE_LIMIT_LEASE tokens of a shared bucket at a time, for at most RATE_LIMIT_LEASE_TTL seconds.
+    RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+    RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", 10))
+    RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", 20))
+    RATE_LIMIT_SESSION_RATE = float(os.getenv("RATE_LIMIT_SESSION_RATE", 100))
+    RATE_LIMIT_SESSION_BURST = int(os.getenv("RATE_LIMIT_SESSION_BURST", 200))
+    RATE_LIMIT_CONNECTION_RATE = float(os.getenv("RATE_LIMIT_CONNECTION_RATE", 10))
+    RATE_LIMIT_CONNECTION_BURST = int(os.getenv("RATE_LIMIT_CONNECTION_BURST", 20))
+    RATE_LIMIT_LEASE = int(os.getenv("RATE_LIMIT_LEASE", 5))
+    RATE_LIMIT_LEASE_TTL = float(os.getenv("RATE_LIMIT_LEASE_TTL", 1.0))
+    # Sockets and concurrent `send_message` calls accepted per worker process, 0 for no limit
+    WS_MAX_CONNECTIONS = int(os.getenv("WS_MAX_CONNECTIONS", 0))
+    SEND_MAX_IN_FLIGHT = int(os.getenv("SEND_MAX_IN_FLIGHT", 0))
+
+    # Origins allowed by CORS, comma separated, "*" for any. Credentials are only allowed with an
+    # explicit list.
+    CORS_ORIGINS = os.getenv("CORS_ORIGINS", "http://localhost:3000")
+
+    # Async Redis connection pool shared by the caches
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+    MESSAGE_CACHE_TTL = int(os.getenv("MESSAGE_CACHE_TTL", 60 * 60))  # 1hr
+
+    # Write-behind message persistence: messages are acknowledged once they are in a Redis Stream
+    # shard, a worker inserts them in batches. A shard must only be consumed by one worker at a time.
+    WRITE_BEHIND_SHARDS = int(os.getenv("WRITE_BEHIND_SHARDS", 8))
+    WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", 500))
+    WRITE_BEHIND_FLUSH_INTERVAL = float(
+        os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 0.05))
+    WRITE_BEHIND_MAX_RETRY_DELAY = float(
+        os.getenv("WRITE_BEHIND_MAX_RETRY_DELAY", 30.0))
+    # A message the database keeps rejecting, e.g. of a sender deleted meanwhile, is moved to the dead
+    # letter stream after that many attempts instead of holding its shard back
+    WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", 5))
+    WRITE_BEHIND_CONSUMER = os.getenv(
+        "WRITE_BEHIND_CONSUMER", socket.gethostname())
+    # The Celery `process_message` task consumes the shards by default. Set to 1 to run the worker
+    # inside the API process instead, e.g. in development without a Celery worker.
+    WRITE_BEHIND_IN_PROCESS = os.getenv("WRITE_BEHIND_IN_PROCESS", "0") == "1"
+
+    CELERY_BROKER_URL = os.getenv(
+        "CELERY_BROKER_URL", "redis://localhost:6379/0")
+    CELERY_RESULT_BACKEND = os.getenv(
+        "CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
+    # How long a `process_message` task waits for the first message of a batch before handing the
+    # shard over to its next task, the batch size and flush interval above bound the rest
+    PROCESS_IDLE_WAIT = float(os.getenv("PROCESS_IDLE_WAIT", 1.0))
+    # How long a `process_message` task chain owns its shard without renewing, it must outlive one
+    # batch. Orphaned shards are picked up again after that.
+    PROCESS_SHARD_LEASE = int(os.getenv("PROCESS_SHARD_LEASE", 30))
+
+    # Monthly range partitions of `messages` by created_at, created PARTITION_PREMAKE_MONTHS ahead.
+    # Partitions older than MESSAGE_RETENTION_MONTHS are detached, exported to PARTITION_ARCHIVE_DIR
+    # and dropped, 0 keeps every partition attached.
+    PARTITION_PREMAKE_MONTHS = int(os.getenv("PARTITION_PREMAKE_MONTHS", 3))
+    MESSAGE_RETENTION_MONTHS = int(os.getenv("MESSAGE_RETENTION_MONTHS", 0))
+    PARTITION_ARCHIVE_DIR = os.getenv("PARTITION_ARCHIVE_DIR", "/var/lib/room/archive")
+    # Seconds between two runs of the `maintain_partitions` task
+    PARTITION_MAINTENANCE_INTERVAL = int(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 6 * 60 * 60))
+
+    # Seconds between two pushes of the Celery workers' histograms to Redis, where the API's /metrics
+    # reads them, nothing scrapes the worker processes themselves
+    METRICS_PUSH_INTERVAL = float(os.getenv("METRICS_PUSH_INTERVAL", 5.0))
+
+    # Fernet key of the stored messages and of the session stream entries, shared by the API and the
+    # workers. Required unless WRITE_BEHIND_IN_PROCESS=1 with FANOUT_MODE=pubsub, a random key is only
+    # good for a single process.
+    MESSAGE_KEY = os.getenv("MESSAGE_KEY")
+
+    # Derived session keys kept in process by SignalProto
+    KEY_CACHE_SIZE = int(os.getenv("KEY_CACHE_SIZE", 10_000))
+    KEY_CACHE_TTL = float(os.getenv("KEY_CACHE_TTL", 300))
+
+    # Crypto executor, a thread pool since `cryptography` releases the GIL. Payloads smaller than
+    # CRYPTO_INLINE_BYTES and batches shorter than CRYPTO_BATCH_THRESHOLD stay on the event loop.
+    CRYPTO_WORKERS = int(os.getenv("CRYPTO_WORKERS", os.cpu_count() or 4))
+    CRYPTO_BATCH_THRESHOLD = int(os.getenv("CRYPTO_BATCH_THRESHOLD", 64))
+    CRYPTO_INLINE_BYTES = int(os.getenv("CRYPTO_INLINE_BYTES", 16 * 1024))
+
+    # Session history pages, the newest HISTORY_CACHE_SIZE messages of a session are indexed in Redis
+    HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 50))
+    HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", 200))
+    HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", 500))
+
+    # Session search over a blind index: words are stored as keyed hashes, keyed by SEARCH_KEY or the
+    # message key. Changing the key requires rebuilding `message_search`.
+    SEARCH_KEY = os.getenv("SEARCH_KEY")
+    SEARCH_MAX_TERMS = int(os.getenv("SEARCH_MAX_TERMS", 8))
+
+    # Read-through cache of users, rooms, sessions and memberships: a short lived process local tier
+    # in front of Redis. Ids that do not exist are cached too, for a shorter time.
+    ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", 50_000))
+    ENTITY_CACHE_LOCAL_TTL = float(os.getenv("ENTITY_CACHE_LOCAL_TTL", 5))
+    ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", 300))
+    ENTITY_CACHE_NEGATIVE_TTL = int(os.getenv("ENTITY_CACHE_NEGATIVE_TTL", 30))
@@ -1,16 +1,37 @@
 
+import math
+import os
+import socket
+import time
 import redis
-from .models.services.ws import ConnectionManager
-from .tasks import celery, process_message
+from contextlib import asynccontextmanager
+from .services.ws import WebSockM
+from . import tasks
+from .tasks import celery, post_process, queue_depth
 from datetime import datetime
 from celery import Celery
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from typing import List
-from fastapi import FastAPI, WebSocket, Depends
-from .services.db import get_db_session
-from .services.encryption import store_message
+from typing import List, Optional
+from fastapi import FastAPI, WebSocket, Depends, HTTPException, Query
+from starlette import status
+from sqlalchemy.ext.asyncio import AsyncSession
+from .config import Config
+from .services.db import DB_MANAGER, get_read_db_session
+from .services.encryption import message_cache, require_shared_key, store_message, write_behind
+from .operations import can_post
+from .services.persistence import WriteBehindWorker
+from .services.partitions import ensure_partitions
+from .services.crypto_pool import crypto_executor
+from .services.history import get_session_history
+from .services.search import search_session
+from .services.cache import entity_cache
+from .services.lifecycle import drain_before_server_shutdown
+from .services.presence import PresenceService, parse_update
+from .services.read_state import ReadStateService, parse_ack
+from .services.ratelimit import CLOSE_RATE_LIMITED, RateLimiter
+from .services.metrics import REGISTRY, SEND_MESSAGE, STAGE_SECONDS, redis_pool_usage
 # from .models import (
 #     UserModel,
 #     SessionModel,
@@ -21,41 +42,298 @@ from .services.encryption import store_message
 #     KeyModel,
 #     AddUser,
 # )
-from .models.schemas import Session, User, Message, Room, CreateUser, CreateSession, CreateRoom
+from .models.schemas import Session, User, Message, MessagePage, Room, CreateUser, CreateSession, CreateRoom, UnreadCounts
 
-app = FastAPI()
+require_shared_key()
+
+manager = WebSockM()
+presence = PresenceService()
+read_state = ReadStateService()
+limiter = RateLimiter()
+# Drain the sockets before uvicorn closes them itself
+drain_before_server_shutdown(manager.drain)
+# `send_message` calls in progress in this worker, for SEND_MAX_IN_FLIGHT
+in_flight = 0
+write_behind_worker = WriteBehindWorker(post_process=post_process)
+
+# Gauges are per API worker process, the label tells the uvicorn workers of a host apart
+WORKER = f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _redis_pools() -> dict:
+    pools = {
+        "message_cache": message_cache.pool,
+        "write_behind": write_behind.redis.connection_pool,
+        "entity_cache": entity_cache.redis.connection_pool,
+        "presence": presence.redis.connection_pool,
+        "tasks": tasks.redis.connection_pool,
+    }
+    if manager.pubsub_client.redis_connection is not None:
+        pools["fanout"] = manager.pubsub_client.redis_connection.connection_pool
+    if manager.ephemeral_client is not None and manager.ephemeral_client.redis_connection is not None:
+        pools["fanout_ephemeral"] = manager.ephemeral_client.redis_connection.connection_pool
+    return redis_pool_usage(pools)
+
+
+def _db_pools() -> dict:
+    return {
+        (name, state): count
+        for name, pool in DB_MANAGER.stats()["pools"].items()
+        for state, count in pool.items()
+    }
+
+
+REGISTRY.gauge("room_connections", "Open WebSocket connections",
+               lambda: {(WORKER,): manager.connection_count()}, ("worker",))
+REGISTRY.gauge("room_sessions", "Sessions with local WebSocket connections",
+               lambda: {(WORKER,): len(manager.sessions)}, ("worker",))
+REGISTRY.gauge("room_redis_pool_connections", "Redis connections by pool and state",
+               _redis_pools, ("pool", "state"))
+REGISTRY.gauge("room_db_pool_connections", "Database connections by pool and state",
+               _db_pools, ("pool", "state"))
+REGISTRY.gauge("room_celery_queue_depth", "Tasks waiting in the Celery queue", queue_depth)
+REGISTRY.pushed_histogram(
+    "room_worker_stage_seconds", "Time spent in each stage of the message path in the Celery workers, "
+    "summed over all of them", STAGE_SECONDS, tasks.redis)
+REGISTRY.stats("room_write_behind", write_behind_worker.stats)
+REGISTRY.stats("room_crypto", crypto_executor.stats)
+REGISTRY.stats("room_cache", entity_cache.stats)
+REGISTRY.stats("room_message_cache", message_cache.stats)
+REGISTRY.stats("room_presence", presence.stats)
+REGISTRY.stats("room_read_state", read_state.stats)
+REGISTRY.stats("room_rate_limit", limiter.stats)
+REGISTRY.stats("room_coalescing", manager.coalescing_stats)
+REGISTRY.stats("room_lifecycle", manager.lifecycle_stats)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    DB_MANAGER.init(Config.DB_CONFIG, Config.DB_REPLICA_CONFIG)
+    await manager.start()
+    await presence.start()
+    await read_state.start()
+    if Config.WRITE_BEHIND_IN_PROCESS:
+        # Without Celery nothing else runs the partition maintenance, at least cover the coming months
+        async with DB_MANAGER.connect() as connection:
+            await ensure_partitions(connection)
+        await write_behind_worker.start()
+    yield
+    # Close the sockets gracefully first, while the services they use are still up. Under uvicorn they
+    # were drained when it started shutting down, this only covers other servers
+    await manager.drain()
+    await write_behind_worker.stop()
+    await read_state.stop()
+    await presence.stop()
+    await manager.stop()
+    await DB_MANAGER.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 redis_client = redis.StrictRedis(host='localhost', port=6379, db=0)
 
+cors_origins = [origin.strip() for origin in Config.CORS_ORIGINS.split(",") if origin.strip()]
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # can alter with time
-    allow_credentials=True,
+    allow_origins=cors_origins,
+    # Never with a wildcard, any site could otherwise call the API with the user's cookies
+    allow_credentials="*" not in cors_origins,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
-manager = ConnectionManager()
-
 
 @app.post("/send_message")
-async def send_message(session_id: int, user_id: int, message: Message, db: Session = Depends(get_db_session)):
-    await store_message(message=message, user_id=user_id, sid=session_id)
-    # Save encrypted message to the database
-    # Enqueue task for processing
-    process_message.apply_async(args=[message], countdown=1)
-    return {"message": "Message sent for processing"}
+async def send_message(session_id: int, user_id: int, message: Message):
+    # Acknowledged once the encrypted message is in the write-behind stream, the `process_message`
+    # consumer of its shard persists, publishes and counts it in the next batch.
+    # Overload is shed first, before any crypto or Redis stream work.
+    global in_flight
+    if Config.SEND_MAX_IN_FLIGHT and in_flight >= Config.SEND_MAX_IN_FLIGHT:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                            detail="Server busy", headers={"Retry-After": "1"})
+    if (limited := await limiter.check_message(user_id, session_id)) is not None:
+        scope, retry_after = limited
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail=f"Rate limit of the {scope} exceeded",
+                            headers={"Retry-After": str(math.ceil(retry_after))})
+    # Checked before enqueueing, a message the database would reject must never reach the stream
+    if not await can_post(session_id, user_id):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
+                            detail=f"User {user_id} is not a member of session {session_id}")
+
+    in_flight += 1
+    try:
+        started = time.perf_counter()
+        mid = await store_message(message=message.text, user_id=user_id, sid=session_id)
+        SEND_MESSAGE.observe(time.perf_counter() - started)
+    finally:
+        in_flight -= 1
+    return {"message": "Message sent for processing", "mid": mid}
 
 
 @app.websocket("/message/{session_id}")
 async def websocket_endpoint(
-    websocket: WebSocket, session_id: int, db: Session = Depends(get_db_session)
+    websocket: WebSocket,
+    session_id: int,
+    last_id: Optional[str] = None,
+    user_id: Optional[int] = None,
 ):
-    await manager.connect(websocket)
+    # No database session is held for the lifetime of the connection, operations open short lived ones.
+    # A reconnecting client passes the id of the last frame it got to resume from there, and the
+    # presence and read state of the user are tracked when it passes its id.
+    if manager.draining:
+        # Shutting down, the client reconnects to another node after a randomized delay
+        await manager.lifecycle.turn_away(websocket)
+        return
+    if not manager.owns(session_id):
+        await manager.redirect(session_id, websocket)
+        return
+    if Config.WS_MAX_CONNECTIONS and manager.connection_count() >= Config.WS_MAX_CONNECTIONS:
+        # Shed before subscribing or replaying anything, the client retries later
+        await websocket.accept()
+        await websocket.close(code=status.WS_1013_TRY_AGAIN_LATER, reason="server busy")
+        return
+    await manager.add_user_to_session(session_id, websocket, last_id)
+    bucket = limiter.connection_bucket()
+    if user_id is not None:
+        presence.connect(session_id, user_id)
     try:
         while True:
-            message = await websocket.receive_text()
+            # Text, or a binary packet when the client negotiated the binary subprotocol
+            message = await manager.receive(websocket)
+            if bucket is not None and bucket.take() > 0:
+                # Every frame counts against the connection, presence and read-acks included
+                await manager.remove_user_from_room(
+                    session_id, websocket, CLOSE_RATE_LIMITED, "connection rate limit")
+                return
+            if isinstance(message, str) and (state := parse_update(message)) is not None:
+                # Aggregated and published with the next presence diff, never broadcast one by one
+                if user_id is not None:
+                    presence.update(session_id, user_id, state)
+                continue
+            if isinstance(message, str) and (mid := parse_ack(message)) is not None:
+                # Read-acks only move the user's cursor, they are not broadcast either
+                if user_id is not None:
+                    read_state.ack(session_id, user_id, mid)
+                continue
+            if (limited := await limiter.check_message(user_id, session_id)) is not None:
+                await manager.remove_user_from_room(
+                    session_id, websocket, CLOSE_RATE_LIMITED, f"{limited[0]} rate limit")
+                return
             # Process the message and send it to other users in the session
-            await manager.broadcast_message(message)
+            await manager.broadcast(session_id, message)
     except WebSocketDisconnect:
-        await manager.disconnect(websocket)
+        await manager.remove_user_from_room(session_id, websocket)
+    except ValueError:
+        await manager.remove_user_from_room(
+            session_id, websocket, status.WS_1003_UNSUPPORTED_DATA)
+    finally:
+        if user_id is not None:
+            presence.disconnect(session_id, user_id)
+
+
+@app.get("/sessions/{session_id}/presence")
+async def session_presence(session_id: int):
+    return await presence.get(session_id)
+
+
+@app.get("/sessions/{session_id}/messages", response_model=MessagePage)
+async def session_messages(
+    session_id: int,
+    before: Optional[int] = None,
+    limit: int = Query(Config.HISTORY_PAGE_SIZE, ge=1, le=Config.HISTORY_PAGE_MAX),
+    db: AsyncSession = Depends(get_read_db_session),
+):
+    return await get_session_history(session_id, before, limit, db)
+
+
+@app.get("/sessions/{session_id}/search", response_model=MessagePage)
+async def session_search(
+    session_id: int,
+    q: str = Query(..., min_length=1),
+    before: Optional[int] = None,
+    limit: int = Query(Config.HISTORY_PAGE_SIZE, ge=1, le=Config.HISTORY_PAGE_MAX),
+    db: AsyncSession = Depends(get_read_db_session),
+):
+    # Messages holding every word of `q`, newest first, paginated with `before` like the history
+    return await search_session(session_id, q, before, limit, db)
+
+
+@app.get("/users/{user_id}/unread", response_model=UnreadCounts)
+async def user_unread(user_id: int):
+    # Unread counters and read cursors of every session of the user at once, e.g. on app open
+    return await read_state.unread(user_id)
+
+
+@app.get("/route/sessions/{session_id}")
+async def route_session(session_id: int):
+    # Lookup for the gateway, to send every socket of a session to the same node
+    return {"session_id": session_id, "address": manager.route(session_id)}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    # Prometheus text exposition format, scraped per worker process
+    return PlainTextResponse(await REGISTRY.render(),
+                             media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats/connections")
+async def connection_stats():
+    return manager.connection_stats()
+
+
+@app.get("/stats/sharding")
+async def sharding_stats():
+    return manager.sharding_stats()
+
+
+@app.get("/stats/presence")
+async def presence_stats():
+    return presence.stats()
+
+
+@app.get("/stats/read_state")
+async def read_state_stats():
+    return read_state.stats()
+
+
+@app.get("/stats/rate_limit")
+async def rate_limit_stats():
+    return limiter.stats()
+
+
+@app.get("/stats/lifecycle")
+async def lifecycle_stats():
+    return manager.lifecycle_stats()
+
+
+@app.get("/stats/coalescing")
+async def coalescing_stats():
+    return manager.coalescing_stats()
+
+
+@app.get("/stats/write_behind")
+async def write_behind_stats():
+    return write_behind_worker.stats()
+
+
+@app.get("/stats/crypto")
+async def crypto_stats():
+    return crypto_executor.stats()
+
+
+@app.get("/stats/cache")
+async def cache_stats():
+    return entity_cache.stats()
+
+
+@app.get("/stats/message_cache")
+async def message_cache_stats():
+    return message_cache.stats()
+
+
+@app.get("/stats/db")
+async def db_stats():
+    return DB_MANAGER.stats()
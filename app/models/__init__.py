@@ -6,7 +6,9 @@ from .dbmodel import (
     RoomModel,
     SessionModel,
     Member_Model,
-    MessageModel
+    MessageModel,
+    MessageSearchModel,
+    ReadCursorModel
 )
 from sqlalchemy.orm import declarative_base
 
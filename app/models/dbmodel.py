@@ -2,19 +2,20 @@ from uuid import uuid4
 from datetime import datetime
 from pytz import timezone
 from sqlalchemy import (
-    mapped_column,
     Integer,
     String,
     Boolean,
     ForeignKey,
     BigInteger,
     DateTime,
+    Index,
 )
 
-from sqlalchemy import func
+from sqlalchemy import DDL, event, func
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import relationship, Mapped
+from sqlalchemy.orm import relationship, Mapped, mapped_column
 
 from app.services.db import Base
 from typing import List, Optional, Set
@@ -23,7 +24,7 @@ from typing import List, Optional, Set
 class TimeModel(Base):
     __abstract__ = True
 
-    created_at: Mapped[Optional[datetime.datetime]] = mapped_column(
+    created_at: Mapped[Optional[datetime]] = mapped_column(
         DateTime, server_default=func.now())
     update_time: Mapped[Optional[datetime]] = mapped_column(
         DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
@@ -58,14 +59,16 @@ class SessionModel(TimeModel):
     session_id: Mapped[int] = mapped_column(
         primary_key=True, autoincrement=True, index=True
     )
+    room_id: Mapped[int] = mapped_column(ForeignKey("rooms.rid"))
     session_name: Mapped[int] = mapped_column(nullable=False)
 
-    rooms: Mapped[Set["RoomModel"]] = relationship(back_populates="sessions")
+    room: Mapped["RoomModel"] = relationship(back_populates="sessions")
     users: Mapped[Set["UserModel"]] = relationship(secondary="session_data", back_populates="sessions"
                                                    )
     # Establish a one - to - many relation with message sent in the room
+    # Never loaded implicitly, history is read page by page through app.services.history
     messages: Mapped[List["MessageModel"]] = relationship(
-        back_populates="session"
+        back_populates="session", lazy="raise"
     )
 
 
@@ -97,20 +100,62 @@ class RoomModel(TimeModel):
         primary_key=True, autoincrement=True, index=True)
     members: Mapped[Set["UserModel"]] = relationship(
         secondary="membership", back_populates="rooms")
-    session: Mapped["SessionModel"] = relationship(
-        back_populates="rooms")
+    sessions: Mapped[List["SessionModel"]] = relationship(
+        back_populates="room")
 
 
 class MessageModel(TimeModel):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Keyset pagination of a session's history, newest first. Led by the partition key after the
+        # session so every monthly partition is read in order and the scan stops at the page size.
+        Index("ix_messages_session_created_mid", "session_id", "created_at", "mid"),
+        # Monthly partitions, created and retired by app.services.partitions
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
 
     mid: Mapped[int] = mapped_column(
         primary_key=True, index=True, autoincrement=True)
+    # The partition key has to be part of the primary key, the write-behind worker sets it from the
+    # stream entry so a retried insert conflicts with the first one
+    created_at: Mapped[datetime] = mapped_column(
+        DateTime, primary_key=True, server_default=func.now())
 
     sender_id: Mapped[int] = mapped_column(
         ForeignKey("users.uid"), nullable=False)
     mssg_encrypt: Mapped[str]
-    room_id: Mapped[int] = mapped_column(
-        ForeignKey("rooms.rid"), nullable=False)
+    room_id: Mapped[Optional[int]] = mapped_column(ForeignKey("rooms.rid"))
     session_id: Mapped[int] = mapped_column(ForeignKey("sessions.session_id"))
-    room: Mapped["RoomModel"] = relationship(back_populates="messages")
+    session: Mapped["SessionModel"] = relationship(back_populates="messages")
+
+
+class ReadCursorModel(TimeModel):
+    __tablename__ = "read_cursors"
+
+    # Last message of a session a user acknowledged. Redis holds the live cursors, this table is their
+    # durable copy, written in batches by the `flush_read_cursors` task.
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.uid"), primary_key=True)
+    session_id: Mapped[int] = mapped_column(
+        ForeignKey("sessions.session_id"), primary_key=True)
+    last_read_mid: Mapped[int] = mapped_column(nullable=False)
+
+
+class MessageSearchModel(Base):
+    __tablename__ = "message_search"
+    __table_args__ = (
+        # One GIN index on the session and the document, so a search never leaves its session.
+        # Needs the btree_gin extension, created with the table.
+        Index("ix_message_search_session_document", "session_id", "document", postgresql_using="gin"),
+        # Partitioned like `messages`, its expired months are dropped with the messages'
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
+    # Searchable projection of a message: keyed hashes of its words, never the plaintext
+    mid: Mapped[int] = mapped_column(primary_key=True, autoincrement=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, primary_key=True)
+    session_id: Mapped[int] = mapped_column(nullable=False)
+    document = mapped_column(TSVECTOR, nullable=False)
+
+
+event.listen(MessageSearchModel.__table__, "before_create",
+             DDL("CREATE EXTENSION IF NOT EXISTS btree_gin"))
@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 
 class User(BaseModel):
@@ -39,14 +39,30 @@ class Message(BaseModel):
         orm_mode: True
 
 
-# Session
+class StoredMessage(Message):
+    # None when the stored message cannot be decrypted
+    text: Optional[str] = None
 
 
-class Session(Session):
-    messages: List[Message]
+class MessagePage(BaseModel):
+    messages: List[StoredMessage]
+    # Pass as `before` to get the next (older) page, None once the history is exhausted
+    next_before: Optional[int] = None
 
-    class Config:
-        orm_mode: True
+
+# Read state
+
+
+class SessionReadState(BaseModel):
+    session_id: int
+    unread: int = 0
+    # Id of the last message the user acknowledged, None before the first read-ack
+    last_read_mid: Optional[int] = None
+
+
+class UnreadCounts(BaseModel):
+    user_id: int
+    sessions: List[SessionReadState]
 
 
 # Room
@@ -1,18 +1,30 @@
-from .services.db import get_db_session
-from .models import UserModel, SessionModel, User_Session, Member_Model, RoomModel, MessageModel, KeyModel, AddUser  # noqa: F401
-from .models.schemas import User, Message, Room,  CreateUser, CreateSession, CreateRoom
+from .services.db import DB_MANAGER, get_db_session
+from .services.cache import (
+    entity_cache,
+    from_row,
+    load_row,
+    room_key,
+    room_members_key,
+    session_key,
+    session_members_key,
+    user_key,
+)
+from .models import UserModel, SessionModel, User_Session, Member_Model, RoomModel, MessageModel  # noqa: F401
+from .models.schemas import User, Message, Room, AddUser, CreateUser, CreateSession, CreateRoom
 
 from fastapi import Depends, HTTPException, Response, status
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List, Set
 
 
-DB: Session = Depends(get_db_session)
+DB: AsyncSession = Depends(get_db_session)
 
 #  Direct OP
 
 
-def add_user(user: CreateUser, db: DB):
+async def add_user(user: CreateUser, db: DB):
     """
     The function `add_user` adds a new user to the database.
 
@@ -32,8 +44,10 @@ def add_user(user: CreateUser, db: DB):
         number=user.number,
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
+    # The id may have been looked up, and negatively cached, before it existed
+    await entity_cache.invalidate(user_key(db_user.uid))
 
     return db_user
 
@@ -41,7 +55,7 @@ def add_user(user: CreateUser, db: DB):
 # Non Celery OP if user itself requests
 
 
-def get_user(user_id: int, db: DB):
+async def get_user(user_id: int, db: DB):
     """
     The function `get_user` retrieves a user from a database based on their user ID and returns the user
     if found, otherwise it raises an HTTPException with a 404 status code.
@@ -49,14 +63,17 @@ def get_user(user_id: int, db: DB):
     :param user_id: The user_id parameter is an integer that represents the unique identifier of a user
     :type user_id: int
     :param db: The "db" parameter is an instance of the DB class, which is used to query the database.
-    It is assumed to have a method called "query" that can be used to execute queries on the database
+    It is assumed to be an `AsyncSession` that can execute `select()` statements
     :type db: DB
-    :return: The function `get_user` returns the user object if it exists in the database. If the user
-    does not exist, it raises an HTTPException with a 404 status code and a detail message indicating
-    that the user with the given id does not exist in the database or cache.
+    :return: The function `get_user` returns the user object if it exists in the cache or the database,
+    as a read only `UserModel` without relationships loaded. If the user does not exist, it raises an
+    HTTPException with a 404 status code and a detail message indicating that the user with the given
+    id does not exist in the database or cache.
     """
-    if user := db.query(UserModel).filter(UserModel.uid == user_id).first():
-        return user
+    if row := await entity_cache.get(
+        user_key(user_id), lambda: load_row(db, UserModel, UserModel.uid == user_id)
+    ):
+        return from_row(UserModel, row)
     else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -66,7 +83,7 @@ def get_user(user_id: int, db: DB):
 # Celery OP
 
 
-def get_room(room_id: int, db: DB):
+async def get_room(room_id: int, db: DB):
     """
     The function `get_room` retrieves a room from a database based on its ID and raises an exception if
     the room does not exist.
@@ -78,11 +95,14 @@ def get_room(room_id: int, db: DB):
     query the database for the room with the given `room_id`
     :type db: DB
     :return: The function `get_room` returns the room object with the specified `room_id` if it exists
-    in the database (`db`). If the room does not exist, it raises an HTTPException with a 404 status
-    code and a detail message indicating that the room does not exist in the database or cache.
+    in the cache or the database (`db`), as a read only `RoomModel`. If the room does not exist, it
+    raises an HTTPException with a 404 status code and a detail message indicating that the room does
+    not exist in the database or cache.
     """
-    if room := db.query(RoomModel).filter(RoomModel.rid == room_id).first():
-        return room
+    if row := await entity_cache.get(
+        room_key(room_id), lambda: load_row(db, RoomModel, RoomModel.rid == room_id)
+    ):
+        return from_row(RoomModel, row)
     else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -92,7 +112,7 @@ def get_room(room_id: int, db: DB):
 # celery OP
 
 
-def get_session(session_id: int, db: DB):
+async def get_session(session_id: int, db: DB):
     """
     The function `get_session` retrieves a session from the database based on the provided session ID,
     and raises an exception if the session does not exist.
@@ -104,16 +124,16 @@ def get_session(session_id: int, db: DB):
     connection or session object used to interact with the database. It is used to query the database
     for a session with the given `session_id`
     :type db: DB
-    :return: the session with the specified session_id if it exists in the database. If the session does
-    not exist, it raises an HTTPException with a 404 status code and a detail message indicating that
-    the session does not exist in the database or cache.
+    :return: the session with the specified session_id if it exists in the cache or the database, as a
+    read only `SessionModel`. If the session does not exist, it raises an HTTPException with a 404
+    status code and a detail message indicating that the session does not exist in the database or
+    cache.
     """
-    if (
-        room := db.query(SessionModel)
-        .filter(SessionModel.session_id == session_id)
-        .first()
+    if row := await entity_cache.get(
+        session_key(session_id),
+        lambda: load_row(db, SessionModel, SessionModel.session_id == session_id),
     ):
-        return room
+        return from_row(SessionModel, row)
     else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -123,39 +143,40 @@ def get_session(session_id: int, db: DB):
 #  Direct OP
 
 
-def add_session(session: CreateSession, db: DB):
+async def add_session(session: CreateSession, db: DB):
     """
     The function `add_session` adds a new session to a database, checking if the room and users exist
-    before creating the session.
+    before creating the session. The number of queries does not depend on the number of users: one
+    membership count and one bulk insert into `session_data`.
 
     :param session: The `session` parameter is of type `CreateSession`, which is a custom class or data
     structure that contains the information needed to create a new session. It likely has the following
     attributes:
     :type session: CreateSession
     :param db: The parameter `db` is an instance of the `DB` class, which is used to interact with the
-    database. It is assumed to have methods like `query`, `add`, `commit`, and `refresh` for querying,
-    adding, committing, and refreshing data in the database, respectively
+    database. It is assumed to be an `AsyncSession`
     :type db: DB
     :return: a new session object of type SessionModel.
     """
-    room = db.query(RoomModel).filter(RoomModel.rid == session.room_id).first()
+    room_id = await db.scalar(select(RoomModel.rid).where(RoomModel.rid == session.room_id))
 
-    if not room:
+    if room_id is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"No such Room With room id : {session.room_id} exists",
         )
 
-    check_user = (
-        db.query(Member_Model)
-        .filter(
+    user_ids = set(session.users)
+    check_user = await db.scalar(
+        select(func.count())
+        .select_from(Member_Model)
+        .where(
             Member_Model.room_id == session.room_id,
-            Member_Model.user_id.in_(session.users),
+            Member_Model.user_id.in_(user_ids),
         )
-        .count()
     )
 
-    if check_user != len(session.users):
+    if check_user != len(user_ids):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Foreign Users Found in Selected Users check users",
@@ -164,24 +185,36 @@ def add_session(session: CreateSession, db: DB):
     new_session = SessionModel(
         room_id=session.room_id,
         session_name=session.session_name,
-        users=[
-            db.query(UserModel).filter(UserModel.uid == user_id).first()
-            for user_id in session.users
-        ],
     )
-
     db.add(new_session)
-    db.commit()
-    db.refresh(new_session)
+    await db.flush()
+
+    if user_ids:
+        await db.execute(
+            insert(User_Session)
+            .values([
+                {"session_id": new_session.session_id, "user_id": user_id}
+                for user_id in user_ids
+            ])
+            .on_conflict_do_nothing()
+        )
+
+    await db.commit()
+    await db.refresh(new_session)
+    await entity_cache.invalidate(
+        session_key(new_session.session_id),
+        session_members_key(new_session.session_id),
+    )
 
     return new_session
 
 # Celery Task
 
 
-def add_uses_to_room(users: AddUser, db: DB):
+async def add_uses_to_room(users: AddUser, db: DB):
     """
-    The function adds users to a room in a database.
+    The function adds users to a room in a database. Users are checked with one `IN` query and added with
+    one `INSERT ... ON CONFLICT DO NOTHING`, whatever the number of users.
 
     :param users: The parameter `users` is of type `AddUser`, which is a custom class or data structure
     that contains a list of user IDs (`user_list`) that need to be added to a room
@@ -192,31 +225,42 @@ def add_uses_to_room(users: AddUser, db: DB):
     :return: the updated room object after adding the specified users to the room's members list.
     """
 
-    room = db.query(RoomModel).filter(RoomModel.rid == users.room_id).first()
+    room = await db.scalar(select(RoomModel).where(RoomModel.rid == users.room_id))
     if room is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Room with id: {id} does not exist",
+            detail=f"Room with id: {users.room_id} does not exist",
+        )
+
+    user_ids = set(users.user_list)
+    found = set(
+        (await db.scalars(select(UserModel.uid).where(UserModel.uid.in_(user_ids)))).all()
+    )
+    if missing := user_ids - found:
+        raise HTTPException(
+            status_code=404, detail=f"User with id {min(missing)} not found"
         )
-    for user_id in users.user_list:
-        user = db.query(UserModel).filter(UserModel.uid == user_id).first()
-        if not user:
-            raise HTTPException(
-                status_code=404, detail=f"User with id {user_id} not found"
-            )
 
-        if user not in room.members:
-            room.members.append(user)
+    if user_ids:
+        await db.execute(
+            insert(Member_Model)
+            .values([
+                {"room_id": users.room_id, "user_id": user_id}
+                for user_id in user_ids
+            ])
+            .on_conflict_do_nothing()
+        )
 
-    db.commit()
-    db.refresh(room)
+    await db.commit()
+    await db.refresh(room, attribute_names=["members"])
+    await entity_cache.invalidate(room_members_key(users.room_id))
 
     return room
 
 #  Direct OP
 
 
-def make_room(room: CreateRoom, db: DB):
+async def make_room(room: CreateRoom, db: DB):
     """
     The function `make_room` creates a new room in a database if a room with the same name does not
     already exist, and adds the specified members to the room.
@@ -231,27 +275,92 @@ def make_room(room: CreateRoom, db: DB):
     :return: a new room object of type `RoomModel`.
     """
     if (
-        existing_room := db.query(RoomModel)
-        .filter(RoomModel.room_name == room.room_name)
-        .first()
+        existing_room := await db.scalar(
+            select(RoomModel.rid).where(RoomModel.room_name == room.room_name)
+        )
     ):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Room with name : {room.room_name} already exists in server",
         )
 
-    member_list = db.query(UserModel).filter(
-        UserModel.uid.in_(room.user_ids)).all()
+    member_list = (await db.scalars(
+        select(UserModel).where(UserModel.uid.in_(room.user_ids)))).all()
     # if len(member_list) != room.room_size:
     #     raise HTTPException(
     #         status_code=status.HTTP_400_BAD_REQUEST,
     #         detail=f"Specified Number of users: {room.room_size} users got from database: {len(member_list)}",
     #     )
 
-    new_room = RoomModel(room_name=room.room_name, members=member_list)
+    new_room = RoomModel(room_name=room.room_name, members=set(member_list))
 
     db.add(new_room)
-    db.commit()
-    db.refresh(new_room)
+    await db.commit()
+    await db.refresh(new_room)
+    await entity_cache.invalidate(
+        room_key(new_room.rid), room_members_key(new_room.rid))
 
     return new_room
+
+
+# Membership lookups, served from the cache
+
+
+async def _member_ids(db: DB, column, *criteria) -> List[int]:
+    return sorted((await db.scalars(select(column).where(*criteria))).all())
+
+
+async def get_room_members(room_id: int, db: DB) -> Set[int]:
+    """
+    The function `get_room_members` returns the ids of the users of a room, read through the cache.
+
+    :param room_id: The room_id parameter is an integer that represents the unique identifier of a room
+    :type room_id: int
+    :return: the set of member user ids, empty for an unknown room
+    """
+    members = await entity_cache.get(
+        room_members_key(room_id),
+        lambda: _member_ids(db, Member_Model.user_id,
+                            Member_Model.room_id == room_id),
+    )
+    return set(members or ())
+
+
+async def get_session_members(session_id: int, db: DB) -> Set[int]:
+    """
+    The function `get_session_members` returns the ids of the users of a session, read through the cache.
+
+    :param session_id: The session_id parameter is an integer that represents the unique identifier of a
+    session
+    :type session_id: int
+    :return: the set of member user ids, empty for an unknown session
+    """
+    members = await entity_cache.get(
+        session_members_key(session_id),
+        lambda: _member_ids(db, User_Session.user_id,
+                            User_Session.session_id == session_id),
+    )
+    return set(members or ())
+
+
+async def is_session_member(session_id: int, user_id: int, db: DB) -> bool:
+    return user_id in await get_session_members(session_id, db)
+
+
+async def can_post(session_id: int, user_id: int) -> bool:
+    """
+    The function `can_post` checks that a user is a member of a session before one of its messages is
+    accepted, which also proves that both exist. The membership is read through the cache, a database
+    session is only opened on a miss.
+
+    :param session_id: The session_id parameter is the session the message is sent to
+    :type session_id: int
+    :param user_id: The user_id parameter is the sender of the message
+    :type user_id: int
+    :return: True when the user may post to the session
+    """
+    async def load() -> List[int]:
+        async with DB_MANAGER.session() as db:
+            return await _member_ids(db, User_Session.user_id, User_Session.session_id == session_id)
+
+    return user_id in set(await entity_cache.get(session_members_key(session_id), load) or ())
@@ -0,0 +1,121 @@
+# two tier read-through cache for users, rooms, sessions and memberships
+
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Optional
+
+import aioredis
+import orjson
+from sqlalchemy import DateTime, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.config import Config
+from app.services.lru import TTLCache
+
+_ABSENT = object()
+
+
+def user_key(user_id: int) -> str:
+    return f"cache:user:{user_id}"
+
+
+def room_key(room_id: int) -> str:
+    return f"cache:room:{room_id}"
+
+
+def session_key(session_id: int) -> str:
+    return f"cache:session:{session_id}"
+
+
+def room_members_key(room_id: int) -> str:
+    return f"cache:room:{room_id}:members"
+
+
+def session_members_key(session_id: int) -> str:
+    return f"cache:session:{session_id}:members"
+
+
+def to_row(instance) -> dict:
+    return {column.key: getattr(instance, column.key) for column in inspect(instance).mapper.column_attrs}
+
+
+def from_row(model, row: dict):
+    """
+    Build a transient, read only `model` instance from a cached row. Relationships are not cached and
+    are not loaded on it.
+    """
+    values = dict(row)
+    for column in inspect(model).columns:
+        if isinstance(column.type, DateTime) and isinstance(values.get(column.key), str):
+            values[column.key] = datetime.fromisoformat(values[column.key])
+    return model(**values)
+
+
+async def load_row(db: AsyncSession, model, *criteria) -> Optional[dict]:
+    instance = await db.scalar(select(model).where(*criteria))
+    return None if instance is None else to_row(instance)
+
+
+# The class `ReadThroughCache` looks a key up in a process local LRU, then in Redis, and only then
+# calls the loader, storing what it returns in both tiers. A loader returning None is cached as a
+# negative entry so that lookups of nonexistent ids stop reaching the database. The local tier keeps
+# entries for a few seconds only, which bounds how stale another process can be after a write.
+class ReadThroughCache:
+    def __init__(self, redis_host=Config.REDIS_HOST, redis_port=Config.REDIS_PORT):
+        self.local = TTLCache(Config.ENTITY_CACHE_SIZE,
+                              Config.ENTITY_CACHE_LOCAL_TTL)
+        self.redis = aioredis.from_url(
+            f"redis://{redis_host}:{redis_port}",
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+        )
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Read `key` through the cache.
+
+        :param loader: coroutine function loading the JSON serializable value from the database, or None
+        when it does not exist
+        :return: the value, None for a (cached) nonexistent entry
+        """
+        value = self.local.get(key, _ABSENT)
+        if value is not _ABSENT:
+            self.local_hits += 1
+        elif (raw := await self.redis.get(key)) is not None:
+            self.redis_hits += 1
+            value = orjson.loads(raw)
+            self.local.set(key, value)
+        else:
+            self.misses += 1
+            value = await loader()
+            ttl = Config.ENTITY_CACHE_TTL if value is not None else Config.ENTITY_CACHE_NEGATIVE_TTL
+            await self.redis.set(key, orjson.dumps(value), ex=ttl)
+            self.local.set(key, value, ttl=min(
+                ttl, Config.ENTITY_CACHE_LOCAL_TTL))
+            return value
+
+        if value is None:
+            self.negative_hits += 1
+        return value
+
+    async def invalidate(self, *keys: str) -> None:
+        for key in keys:
+            self.local.pop(key)
+        if keys:
+            await self.redis.delete(*keys)
+
+    def stats(self) -> dict:
+        lookups = self.local_hits + self.redis_hits + self.misses
+        return {
+            "local_hits": self.local_hits,
+            "redis_hits": self.redis_hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "hit_ratio": (self.local_hits + self.redis_hits) / lookups if lookups else 0.0,
+            "local_size": len(self.local),
+        }
+
+
+entity_cache = ReadThroughCache()
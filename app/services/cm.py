@@ -1,29 +1,371 @@
 # redis manager lives here
 
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
 import aioredis
 
+from app.config import Config
+from app.services.encryption import seal, unseal_many
+from app.services.metrics import PUBLISH
+
+logger = logging.getLogger(__name__)
+
+MessageHandler = Callable[..., Awaitable[None]]
+
+
+def session_stream(session_id: int) -> str:
+    return f"session:{session_id}:stream"
+
+
+def entry_order(entry_id: bytes) -> Tuple[int, int]:
+    """Sort key of a stream entry id, raises ValueError for anything that is not `<ms>-<seq>`."""
+    millis, _, sequence = entry_id.partition(b"-")
+    return int(millis), int(sequence or 0)
+
+
+def valid_entry_id(entry_id: str) -> bool:
+    try:
+        entry_order(entry_id.encode())
+    except ValueError:
+        return False
+    return True
+
+
+def queue_publish(pipe, session_id: int, data: bytes, durable: bool = True) -> None:
+    """
+    Queue the publication of `data` to a session on a pipeline, for the configured fan-out mode.
+
+    :param durable: False for frames that are stale by the time a client reconnects, such as presence.
+        They are plain PUBLISHes in both modes and never take room in the replay window of the stream.
+        Durable frames stay in the stream, encrypted like every other copy of a message kept in Redis.
+    """
+    if durable and Config.FANOUT_MODE == "streams":
+        pipe.xadd(session_stream(session_id), {"data": seal(data)},
+                  maxlen=Config.SESSION_STREAM_MAXLEN, approximate=True)
+    else:
+        pipe.publish(session_id, data)
+
 
+# The class `redisPubSub` multiplexes every session channel of the process over a single Redis
+# connection, a single PubSub object and a single reader task. Subscription changes are queued and
+# sent as one SUBSCRIBE / UNSUBSCRIBE per batch, and the subscription set is replayed after a reconnect.
 class redisPubSub:
-    def __init__(self, redis_host, redis_port):
+    def __init__(self, redis_host=Config.REDIS_HOST, redis_port=Config.REDIS_PORT):
         self.host = redis_host
         self.port = redis_port
+        self.redis_connection: Optional[aioredis.Redis] = None
         self.pubsub = None
 
+        # Channels this process wants to be subscribed to, and the deltas not yet sent to Redis
+        self.channels: set = set()
+        self._pending_subscribe: set = set()
+        self._pending_unsubscribe: set = set()
+        self._wakeup = asyncio.Event()
+
+        self._handler: Optional[MessageHandler] = None
+        self._reader_task: Optional[asyncio.Task] = None
+
     async def _get_redis_connection(self) -> aioredis.Redis:
         return aioredis.Redis(host=self.host,
                               port=self.port,
                               auto_close_connection_pool=False)
 
     async def connect(self) -> None:
-        self.redis_connection = await self._get_redis_connection()
+        if self.redis_connection is None:
+            self.redis_connection = await self._get_redis_connection()
         self.pubsub = self.redis_connection.pubsub()
 
+    async def start(self, handler: MessageHandler) -> None:
+        """
+        Connect to Redis and start the single reader task of the process.
+
+        :param handler: coroutine called as `handler(session_id, data)` for every message received on a
+        subscribed session channel
+        """
+        if self._reader_task is not None:
+            return
+        self._handler = handler
+        await self.connect()
+        self._reader_task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        await self._reset_pubsub()
+        if self.redis_connection is not None:
+            try:
+                await self.redis_connection.close()
+                await self.redis_connection.connection_pool.disconnect()
+            except Exception:
+                pass
+            self.redis_connection = None
+
+    async def _reset_pubsub(self) -> None:
+        if self.pubsub is not None:
+            try:
+                await self.pubsub.close()
+            except Exception:  # the connection may already be gone
+                pass
+            self.pubsub = None
+
+    async def _publish(self, session_id: int, message: str):
+        started = time.perf_counter()
+        await self.redis_connection.publish(session_id, message)
+        PUBLISH.observe(time.perf_counter() - started)
+
+    def subscribe(self, session_id: int) -> None:
+        self.channels.add(session_id)
+        self._pending_unsubscribe.discard(session_id)
+        self._pending_subscribe.add(session_id)
+        self._wakeup.set()
+
+    def unsubscribe(self, session_id: int) -> None:
+        self.channels.discard(session_id)
+        self._pending_subscribe.discard(session_id)
+        self._pending_unsubscribe.add(session_id)
+        self._wakeup.set()
+
+    async def _flush_subscriptions(self) -> None:
+        # Snapshot and clear before awaiting so that changes made meanwhile land in the next batch
+        if self._pending_subscribe:
+            channels, self._pending_subscribe = self._pending_subscribe, set()
+            await self.pubsub.subscribe(*channels)
+        if self._pending_unsubscribe:
+            channels, self._pending_unsubscribe = self._pending_unsubscribe, set()
+            if self.pubsub.subscribed:
+                await self.pubsub.unsubscribe(*channels)
+
+    async def _read_loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            await self._flush_subscriptions()
+
+            if not self.pubsub.subscribed:
+                # Nothing to read from yet, sleep until a session subscribes
+                await self._wakeup.wait()
+                continue
+
+            message = await self.pubsub.get_message(
+                ignore_subscribe_messages=True, timeout=Config.PUBSUB_POLL_INTERVAL
+            )
+            if message is None or message["type"] != "message":
+                continue
+
+            try:
+                await self._handler(int(message["channel"]), message["data"])
+            except Exception:
+                logger.exception(
+                    "pubsub handler failed for channel %s", message["channel"])
+
+    async def _run(self) -> None:
+        delay = 0.1
+        while True:
+            try:
+                if self.pubsub is None:
+                    await self.connect()
+                    # A fresh PubSub knows nothing, replay the whole subscription set
+                    self._pending_unsubscribe.clear()
+                    self._pending_subscribe = set(self.channels)
+                    logger.info("pubsub reconnected, resubscribing %d channels",
+                                len(self.channels))
+                delay = 0.1
+                await self._read_loop()
+            except asyncio.CancelledError:
+                raise
+            except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+                logger.warning(
+                    "pubsub connection lost, reconnecting in %.1fs", delay)
+                # The pooled client reconnects by itself, only the PubSub connection is rebuilt
+                await self._reset_pubsub()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, Config.PUBSUB_RECONNECT_MAX_DELAY)
+
+
+# The class `redisStreams` is the durable counterpart of `redisPubSub`: every session publishes to a
+# capped Redis Stream, and a single reader task per process follows all the subscribed streams with one
+# blocking XREAD. The read position of every session is kept across reconnects, so nothing published
+# meanwhile is lost, and `replay` serves the entries a reconnecting client missed. Entries are kept at
+# rest as Fernet tokens, decrypted by the reader and `replay`.
+class redisStreams:
+    def __init__(self, redis_host=Config.REDIS_HOST, redis_port=Config.REDIS_PORT):
+        self.host = redis_host
+        self.port = redis_port
+        # Pooled client for XADD and replays, and a dedicated connection for the blocking reads
+        self.redis_connection: Optional[aioredis.Redis] = None
+        self.reader: Optional[aioredis.Redis] = None
+
+        # Sessions this process wants to follow, and the last entry id read from each of them
+        self.channels: set = set()
+        self.cursors: Dict[int, bytes] = {}
+        self._wakeup = asyncio.Event()
+
+        self._handler: Optional[MessageHandler] = None
+        self._reader_task: Optional[asyncio.Task] = None
+
+    async def connect(self) -> None:
+        if self.redis_connection is None:
+            self.redis_connection = aioredis.from_url(
+                f"redis://{self.host}:{self.port}",
+                max_connections=Config.REDIS_MAX_CONNECTIONS,
+            )
+        if self.reader is None:
+            self.reader = aioredis.Redis(host=self.host, port=self.port,
+                                         single_connection_client=True)
+
+    async def start(self, handler: MessageHandler) -> None:
+        """
+        Connect to Redis and start the single reader task of the process.
+
+        :param handler: coroutine called as `handler(session_id, data, entry_id)` for every entry
+        appended to a subscribed session stream
+        """
+        if self._reader_task is not None:
+            return
+        self._handler = handler
+        await self.connect()
+        self._reader_task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+            self._reader_task = None
+        await self._reset_reader()
+        if self.redis_connection is not None:
+            try:
+                await self.redis_connection.close()
+            except Exception:
+                pass
+            self.redis_connection = None
+
+    async def _reset_reader(self) -> None:
+        if self.reader is not None:
+            try:
+                await self.reader.close()
+            except Exception:  # the connection may already be gone
+                pass
+            self.reader = None
+
     async def _publish(self, session_id: int, message: str):
-        await self.redis_connection.publish(session_id, message=message)
+        started = time.perf_counter()
+        await self.redis_connection.xadd(
+            session_stream(session_id), {"data": seal(message)},
+            maxlen=Config.SESSION_STREAM_MAXLEN, approximate=True)
+        PUBLISH.observe(time.perf_counter() - started)
+
+    async def replay(self, session_id: int, last_id: str) -> List[Tuple[bytes, bytes]]:
+        """
+        Read what a session stream received after `last_id`.
+
+        When the cursor was already trimmed away the replay starts at the oldest entry still kept, the
+        client has to fetch what is older from the history endpoint.
+
+        :param last_id: the last entry id seen by the client
+        :return: (entry id, data) pairs, oldest first, empty for a malformed cursor
+        """
+        if not valid_entry_id(last_id):
+            return []
+        entries = await self.redis_connection.xrange(
+            session_stream(session_id), min=f"({last_id}", max="+",
+            count=Config.SESSION_STREAM_MAXLEN)
+        return [(entry_id, data) async for entry_id, data in self._unseal(session_id, entries)]
+
+    @staticmethod
+    async def _unseal(session_id: int, entries: list):
+        # Entries that cannot be decrypted, written under another key, are skipped
+        payloads = await unseal_many([fields[b"data"] for _, fields in entries])
+        for (entry_id, _), payload in zip(entries, payloads):
+            if payload.ok:
+                yield entry_id, payload.value
+            else:
+                logger.error("entry %s of session %s could not be decrypted: %r",
+                             entry_id, session_id, payload.error)
+
+    async def end_id(self, session_id: int) -> bytes:
+        """
+        The id of the last entry ever appended to a session stream, trimmed or not, "0-0" for a stream
+        that does not exist yet. Following the session from there delivers everything appended after
+        this call.
+        """
+        try:
+            info = await self.redis_connection.xinfo_stream(session_stream(session_id))
+        except aioredis.ResponseError:
+            return b"0-0"
+        return info["last-generated-id"]
+
+    def subscribe(self, session_id: int, cursor: bytes) -> None:
+        """
+        Follow a session stream from `cursor`, the last entry the local sockets already have: the end of
+        their replay, or `end_id` taken when the first socket joined. Anything appended after it is
+        delivered, whenever the reader gets to the new stream.
+        """
+        if session_id in self.channels:
+            return
+        self.channels.add(session_id)
+        self.cursors[session_id] = cursor
+        self._wakeup.set()
+
+    def unsubscribe(self, session_id: int) -> None:
+        self.channels.discard(session_id)
+        self.cursors.pop(session_id, None)
+
+    async def _read_loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+
+            if not self.cursors:
+                # Nothing to read from yet, sleep until a session subscribes
+                await self._wakeup.wait()
+                continue
 
-    async def subscribe(self, session_id: int) -> aioredis.Redis:
-        await self.pubsub.subscribe(session_id)
-        return self.pubsub
+            response = await self.reader.xread(
+                {session_stream(session_id): cursor for session_id,
+                 cursor in self.cursors.items()},
+                count=Config.SESSION_STREAM_READ_COUNT,
+                block=max(1, int(Config.PUBSUB_POLL_INTERVAL * 1000)),
+            )
+            for stream, entries in response or []:
+                session_id = int(stream.split(b":")[1])
+                if session_id not in self.cursors:
+                    continue
+                # Skipped entries still move the cursor, they would never decrypt
+                self.cursors[session_id] = entries[-1][0]
+                async for entry_id, data in self._unseal(session_id, entries):
+                    if session_id not in self.cursors:
+                        break  # unsubscribed by the handler
+                    try:
+                        await self._handler(session_id, data, entry_id)
+                    except Exception:
+                        logger.exception(
+                            "stream handler failed for session %s", session_id)
 
-    async def unsubscribe(self, session_id: int):
-        await self.pubsub.unsubscribe(session_id)
+    async def _run(self) -> None:
+        delay = 0.1
+        while True:
+            try:
+                if self.reader is None:
+                    await self.connect()
+                    # The cursors survived, reading resumes exactly where it stopped
+                    logger.info("stream reader reconnected, resuming %d sessions",
+                                len(self.cursors))
+                delay = 0.1
+                await self._read_loop()
+            except asyncio.CancelledError:
+                raise
+            except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+                logger.warning(
+                    "stream reader connection lost, reconnecting in %.1fs", delay)
+                await self._reset_reader()
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, Config.PUBSUB_RECONNECT_MAX_DELAY)
@@ -0,0 +1,111 @@
+# per session coalescing of the broadcast frames
+
+import asyncio
+import time
+from typing import Callable, List, Optional, Tuple
+
+import orjson
+
+from app.config import Config
+from app.services.frames import Frame
+from app.services.wire import pack_batch
+
+
+# The class `BatchFrame` is a `Frame` made of the frames of one coalescing window. Text clients get
+# {"batch": [<frame text>, ...]}, clients of the binary subprotocol get one batch packet when every
+# message of the window is binary.
+class BatchFrame(Frame):
+    __slots__ = ("frames",)
+
+    def __init__(self, frames: List[Frame]):
+        # The id of the last message, a client resuming from it has seen the whole batch. Presence
+        # frames are not in the stream and have none
+        super().__init__(b"", next((frame.id for frame in reversed(frames) if frame.id is not None), None))
+        self.frames = frames
+
+    @property
+    def binary(self) -> bool:
+        return all(frame.binary for frame in self.frames)
+
+    @property
+    def text_data(self) -> bytes:
+        if self._text_data is None:
+            self._text_data = orjson.dumps(
+                {"batch": [frame.text for frame in self.frames]})
+        return self._text_data
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = pack_batch([frame.packed for frame in self.frames])
+        return self._packed
+
+
+# The class `CoalesceStats` is shared by the coalescers of a process, it outlives the sessions.
+class CoalesceStats:
+    def __init__(self):
+        self.messages = 0
+        self.frames = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record(self, delays: List[float]) -> None:
+        self.messages += len(delays)
+        self.frames += 1
+        self.latency_total += sum(delays)
+        self.latency_max = max(self.latency_max, max(delays))
+
+    def stats(self) -> dict:
+        return {
+            "messages": self.messages,
+            "frames": self.frames,
+            "frames_saved": self.messages - self.frames,
+            "added_latency_avg": self.latency_total / self.messages if self.messages else 0.0,
+            "added_latency_max": self.latency_max,
+        }
+
+
+# The class `SessionCoalescer` holds the frames of one session for `window` seconds after the first
+# one arrived, then delivers them as a single frame, so a burst costs one frame and one write per
+# socket instead of one per message.
+class SessionCoalescer:
+    def __init__(
+        self,
+        window: float,
+        deliver: Callable[[Frame], None],
+        stats: CoalesceStats,
+        max_batch: int = Config.WS_COALESCE_MAX_BATCH,
+    ):
+        self.window = window
+        self.deliver = deliver
+        self.max_batch = max_batch
+        self._stats = stats
+        self._pending: List[Tuple[Frame, float]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def add(self, frame: Frame) -> None:
+        self._pending.append((frame, time.perf_counter()))
+        if len(self._pending) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self.flush)
+
+    def flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, []
+        now = time.perf_counter()
+        self._stats.record([now - arrived for _, arrived in pending])
+        frames = [frame for frame, _ in pending]
+        self.deliver(frames[0] if len(frames) == 1 else BatchFrame(frames))
+
+    def close(self) -> None:
+        # Nobody is left to deliver to
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._pending = []
@@ -0,0 +1,129 @@
+# executor for CPU bound crypto work
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, NamedTuple, Optional, Sequence
+
+from app.config import Config
+
+
+class CryptoResult(NamedTuple):
+    value: Any
+    error: Optional[Exception] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def _apply(fn: Callable, items: Sequence) -> List[CryptoResult]:
+    results = []
+    for item in items:
+        try:
+            results.append(CryptoResult(fn(item)))
+        except Exception as exc:
+            results.append(CryptoResult(None, exc))
+    return results
+
+
+# The class `CryptoExecutor` decides per call whether crypto work runs inline on the event loop or in
+# its thread pool, and records how long offloaded jobs wait for a thread and how long they run, which
+# is what the pool has to be sized on.
+class CryptoExecutor:
+    def __init__(
+        self,
+        workers: int = Config.CRYPTO_WORKERS,
+        inline_bytes: int = Config.CRYPTO_INLINE_BYTES,
+        batch_threshold: int = Config.CRYPTO_BATCH_THRESHOLD,
+    ):
+        self.workers = workers
+        self.inline_bytes = inline_bytes
+        self.batch_threshold = batch_threshold
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="crypto")
+
+        self._lock = threading.Lock()
+        self.inline_calls = 0
+        self.offloaded_calls = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.exec_total = 0.0
+        self.exec_max = 0.0
+
+    def _record(self, waited: float, ran: float) -> None:
+        with self._lock:
+            self.offloaded_calls += 1
+            self.queue_wait_total += waited
+            self.queue_wait_max = max(self.queue_wait_max, waited)
+            self.exec_total += ran
+            self.exec_max = max(self.exec_max, ran)
+
+    async def _offload(self, fn: Callable, *args) -> Any:
+        submitted = time.perf_counter()
+
+        def job():
+            started = time.perf_counter()
+            try:
+                return fn(*args)
+            finally:
+                self._record(started - submitted,
+                             time.perf_counter() - started)
+
+        return await asyncio.get_running_loop().run_in_executor(self._executor, job)
+
+    async def run(self, fn: Callable, *args, size: Optional[int] = None) -> Any:
+        """
+        Run `fn(*args)` inline or in the pool.
+
+        :param size: payload size in bytes, work on payloads under `inline_bytes` stays inline. None means
+        fixed cost work that is always worth offloading, like X25519 exchanges and HKDF derivations.
+        """
+        if size is not None and size < self.inline_bytes:
+            with self._lock:
+                self.inline_calls += 1
+            return fn(*args)
+        return await self._offload(fn, *args)
+
+    async def map_batch(self, fn: Callable, items: Sequence) -> List[CryptoResult]:
+        """
+        Apply the synchronous `fn` to every item and collect one `CryptoResult` per item, in order.
+
+        Small batches run inline, handing them to a thread costs more than the work itself. Batches of at
+        least `batch_threshold` items are split in one chunk per worker.
+
+        :param fn: function of one item, an exception it raises only fails that item
+        :param items: the batch
+        """
+        if len(items) < self.batch_threshold:
+            with self._lock:
+                self.inline_calls += 1
+            return _apply(fn, items)
+
+        size = -(-len(items) // self.workers)
+        chunks = await asyncio.gather(*(
+            self._offload(_apply, fn, items[start:start + size])
+            for start in range(0, len(items), size)
+        ))
+        return [result for chunk in chunks for result in chunk]
+
+    def stats(self) -> dict:
+        with self._lock:
+            offloaded = self.offloaded_calls or 1
+            return {
+                "workers": self.workers,
+                "inline_calls": self.inline_calls,
+                "offloaded_calls": self.offloaded_calls,
+                "queue_wait_avg": self.queue_wait_total / offloaded,
+                "queue_wait_max": self.queue_wait_max,
+                "exec_avg": self.exec_total / offloaded,
+                "exec_max": self.exec_max,
+            }
+
+
+crypto_executor = CryptoExecutor()
+
+
+async def map_batch(fn: Callable, items: Sequence) -> List[CryptoResult]:
+    return await crypto_executor.map_batch(fn, items)
@@ -1,5 +1,6 @@
 import contextlib
-from typing import AsyncIterator
+import time
+from typing import AsyncIterator, Iterator, Sequence
 from fastapi import Depends
 from sqlalchemy.ext.asyncio import (
     AsyncConnection,
@@ -10,32 +11,80 @@ from sqlalchemy.ext.asyncio import (
 )
 from sqlalchemy.orm import declarative_base
 
+from app.config import Config
+
 Base = declarative_base()
 
+# asyncpg accepts at most that many bind parameters in one statement
+MAX_BIND_PARAMS = 32767
+
+
+def chunked(rows: Sequence[dict], params_per_row: int) -> Iterator[Sequence[dict]]:
+    """Split the rows of a multi-row statement in parts that each stay under MAX_BIND_PARAMS."""
+    size = max(1, MAX_BIND_PARAMS // max(1, params_per_row))
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def _create_engine(host: str) -> AsyncEngine:
+    return create_async_engine(
+        host,
+        pool_size=Config.DB_POOL_SIZE,
+        max_overflow=Config.DB_MAX_OVERFLOW,
+        pool_timeout=Config.DB_POOL_TIMEOUT,
+        pool_recycle=Config.DB_POOL_RECYCLE,
+        pool_pre_ping=Config.DB_POOL_PRE_PING,
+        connect_args={
+            "prepared_statement_cache_size": Config.DB_STATEMENT_CACHE_SIZE},
+    )
+
 
 class DatabaseSessionManager:
     def __init__(self) -> None:
         self._engine: AsyncEngine | None = None
         self._sessionmaker: async_sessionmaker | None = None
+        self._replica_engine: AsyncEngine | None = None
+        self._replica_sessionmaker: async_sessionmaker | None = None
 
-    def init(self, host: str):
-        self._engine = create_async_engine(host)
+        self.checkouts = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    def init(self, host: str, replica_host: str | None = None):
+        self._engine = _create_engine(host)
         self._sessionmaker = async_sessionmaker(
             autocommit=False, bind=self._engine)
 
+        if replica_host:
+            self._replica_engine = _create_engine(replica_host)
+            self._replica_sessionmaker = async_sessionmaker(
+                autocommit=False, bind=self._replica_engine)
+
     async def close(self):
         if self._engine is None:
             raise Exception("DatabaseSessionManager is not initialized")
         await self._engine.dispose()
+        if self._replica_engine is not None:
+            await self._replica_engine.dispose()
         self._engine = None
         self._sessionmaker = None
+        self._replica_engine = None
+        self._replica_sessionmaker = None
+
+    def _record_checkout(self, started: float) -> None:
+        waited = time.perf_counter() - started
+        self.checkouts += 1
+        self.checkout_wait_total += waited
+        self.checkout_wait_max = max(self.checkout_wait_max, waited)
 
     @contextlib.asynccontextmanager
     async def connect(self) -> AsyncIterator[AsyncConnection]:
         if self._engine is None:
             raise Exception("DatabaseSessionManager is not initialized")
 
+        started = time.perf_counter()
         async with self._engine.begin() as connection:
+            self._record_checkout(started)
             try:
                 yield connection
             except Exception:
@@ -43,12 +92,26 @@ class DatabaseSessionManager:
                 raise
 
     @contextlib.asynccontextmanager
-    async def session(self) -> AsyncIterator[AsyncSession]:
+    async def session(self, readonly: bool = False) -> AsyncIterator[AsyncSession]:
+        """
+        Open a short lived session, meant to be held for one operation and not for the lifetime of a
+        WebSocket connection.
+
+        :param readonly: route the session to the read replica when one is configured
+        """
         if self._sessionmaker is None:
             raise Exception("DatabaseSessionManager is not initialized")
 
-        session = self._sessionmaker()
+        sessionmaker = self._sessionmaker
+        if readonly and self._replica_sessionmaker is not None:
+            sessionmaker = self._replica_sessionmaker
+
+        session = sessionmaker()
         try:
+            # Check the connection out up front to measure how long the pool made us wait
+            started = time.perf_counter()
+            await session.connection()
+            self._record_checkout(started)
             yield session
         except Exception:
             await session.rollback()
@@ -56,6 +119,25 @@ class DatabaseSessionManager:
         finally:
             await session.close()
 
+    def stats(self) -> dict:
+        engines = {"primary": self._engine, "replica": self._replica_engine}
+        pools = {
+            name: {
+                "size": engine.pool.size(),
+                "checked_in": engine.pool.checkedin(),
+                "checked_out": engine.pool.checkedout(),
+                "overflow": engine.pool.overflow(),
+            }
+            for name, engine in engines.items()
+            if engine is not None
+        }
+        return {
+            "pools": pools,
+            "checkouts": self.checkouts,
+            "checkout_wait_avg": self.checkout_wait_total / self.checkouts if self.checkouts else 0.0,
+            "checkout_wait_max": self.checkout_wait_max,
+        }
+
     # Used for testing
     async def create_all(self, connection: AsyncConnection):
         await connection.run_sync(Base.metadata.create_all)
@@ -67,6 +149,11 @@ class DatabaseSessionManager:
 DB_MANAGER = DatabaseSessionManager()
 
 
-async def get_db():
+async def get_db_session():
     async with DB_MANAGER.session() as session:
         yield session
+
+
+async def get_read_db_session():
+    async with DB_MANAGER.session(readonly=True) as session:
+        yield session
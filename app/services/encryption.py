@@ -1,53 +1,142 @@
-import redis  # TODO can we change it to async redis
-from fastapi import HTTPException, status, Depends
-from sqlalchemy.orm import Session
+import logging
+import time
+from fastapi import HTTPException, status
 from cryptography.fernet import Fernet
-from datetime import datetime, timedelta
-from app.services.db import get_db_session, add_to_db
-from app.models import MessageModel
+from typing import List, Optional, Sequence, Union
+from app.config import Config
+from app.services.crypto_pool import CryptoResult, crypto_executor, map_batch
+from app.services.message_cache import MessageCache
+from app.services.metrics import CACHE_WRITE, ENCRYPT, ENQUEUE
+from app.services.persistence import MessageWriteBehind
 
 
-DB: Session = Depends(get_db_session)
-# Assuming you have a Redis client instance
-redis_client = redis.StrictRedis(host="localhost", port=6379, db=0)
+logger = logging.getLogger(__name__)
+
+message_cache = MessageCache()
+write_behind = MessageWriteBehind()
 
 # Your Fernet key for encryption
-encryption_key = Fernet.generate_key()
+encryption_key = Config.MESSAGE_KEY or Fernet.generate_key()
 cipher_suite = Fernet(encryption_key)
 
 
+def require_shared_key() -> None:
+    """
+    Refuse to start when the Celery workers consume the write-behind streams, or the session streams
+    carry the fan-out, and no MESSAGE_KEY is set: every process would generate its own key, and the
+    workers could decrypt, publish and index nothing, the API processes read nothing from the streams
+    of the others. The search key falls back to the same key.
+    """
+    if Config.MESSAGE_KEY:
+        return
+    if not Config.WRITE_BEHIND_IN_PROCESS:
+        raise RuntimeError(
+            "MESSAGE_KEY must be set, and shared by the API and the Celery workers, when "
+            "WRITE_BEHIND_IN_PROCESS=0. Generate one with `Fernet.generate_key()`.")
+    if Config.FANOUT_MODE == "streams":
+        raise RuntimeError(
+            "MESSAGE_KEY must be set, and shared by the API processes, when FANOUT_MODE=streams. "
+            "Generate one with `Fernet.generate_key()`.")
+
+
+def _encrypt(message: str) -> str:
+    return cipher_suite.encrypt(message.encode()).decode()
+
+
+def _decrypt(encrypted_message: str) -> str:
+    return cipher_suite.decrypt(encrypted_message).decode()
+
+
+def seal(data: Union[str, bytes]) -> bytes:
+    # Session stream entries are Fernet tokens like every other copy of a message in Redis
+    return cipher_suite.encrypt(data.encode() if isinstance(data, str) else data)
+
+
+def _unseal(token: bytes) -> bytes:
+    return cipher_suite.decrypt(token)
+
+
+async def unseal_many(tokens: Sequence[bytes]) -> List[CryptoResult]:
+    """
+    Decrypt a batch of session stream entries, in the crypto thread pool when the batch is large.
+
+    :return: one `CryptoResult` per entry, in order, holding the payload or the error of that entry
+    """
+    return await map_batch(_unseal, tokens)
+
+
 async def encrypt_message(message: str) -> str:
-    return await cipher_suite.encrypt(message.encode())
+    return await crypto_executor.run(_encrypt, message, size=len(message))
 
 
 async def decrypt_message(encrypted_message: str) -> str:
-    return await cipher_suite.decrypt(encrypted_message).decode()
+    return await crypto_executor.run(_decrypt, encrypted_message, size=len(encrypted_message))
 
 
-async def store_message(user_id: int, message: str, db: DB, sid: int):
-    # Encrypt the message
-    encrypted_message = encrypt_message(message)
+async def encrypt_many(messages: Sequence[str]) -> List[CryptoResult]:
+    """
+    Encrypt a batch of messages, in the crypto thread pool when the batch is large.
+
+    :return: one `CryptoResult` per message, in order, holding the token or the error of that message
+    """
+    return await map_batch(_encrypt, messages)
+
+
+async def decrypt_many(encrypted_messages: Sequence[str]) -> List[CryptoResult]:
+    """
+    Decrypt a batch of Fernet tokens, in the crypto thread pool when the batch is large.
 
-    # Store the encrypted message in the database
-    db_message = MessageModel(
-        sender_id=user_id, mssg_encrypt=encrypted_message, session_id=sid)
-    await add_to_db(value=db_message)
+    :return: one `CryptoResult` per token, in order, holding the plaintext or the error of that token
+    """
+    return await map_batch(_decrypt, encrypted_messages)
 
-    # Store the encrypted message in Redis cache
-    cache_key = f"message:{db_message.mid}"
-    redis_client.set(cache_key, encrypted_message)
 
-    # Set an expiration time for the cache key # 1hr
-    expiration_time = datetime.now() + timedelta(hours=1)
-    redis_client.expireat(cache_key, expiration_time)
+async def store_message(user_id: int, message: str, sid: int) -> int:
+    # Encrypt the message
+    started = time.perf_counter()
+    encrypted_message = await encrypt_message(message)
+    encrypted = time.perf_counter()
+    ENCRYPT.observe(encrypted - started)
+
+    # Durably enqueue the encrypted message, the write-behind worker inserts it in the database
+    mid = await write_behind.enqueue(
+        session_id=sid, sender_id=user_id, mssg_encrypt=encrypted_message)
+    enqueued = time.perf_counter()
+    ENQUEUE.observe(enqueued - encrypted)
+
+    # Store the encrypted message in Redis cache, expiring with the cache TTL. The message is already
+    # on its way to the database, a failure here must not make the client send it again. It only joins
+    # the recent messages index of its session once persisted, in `post_process`
+    try:
+        await message_cache.set(mid, encrypted_message)
+    except Exception:
+        logger.warning("message %s enqueued but not cached", mid, exc_info=True)
+    CACHE_WRITE.observe(time.perf_counter() - enqueued)
+    return mid
 
 
 async def get_message_from_cachepy(message_id: int) -> str:
-    cache_key = f"message:{message_id}"
-    if cached_message := redis_client.get(cache_key):
+    if cached_message := await message_cache.get(message_id):
         return await decrypt_message(cached_message.decode())
     else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Message with id {message_id} not found in cache",
         )
+
+
+async def get_messages_from_cache(message_ids: Sequence[int]) -> List[Optional[str]]:
+    """
+    Load and decrypt many cached messages with a single MGET.
+
+    :param message_ids: ids of the messages to load
+    :return: the decrypted messages in the order of `message_ids`, None for the ids not in cache or
+    that fail to decrypt
+    """
+    cached_messages = await message_cache.get_many(message_ids)
+    hits = [cached for cached in cached_messages if cached is not None]
+    decrypted = iter(await decrypt_many(hits))
+    return [
+        next(decrypted).value if cached is not None else None
+        for cached in cached_messages
+    ]
@@ -0,0 +1,246 @@
+# per socket outbound queues for the websocket fan-out
+
+import asyncio
+import enum
+import itertools
+import logging
+import time
+from typing import List, Optional
+
+import orjson
+from fastapi import WebSocket
+from starlette import status
+
+from app.config import Config
+from app.services.cm import entry_order
+from app.services.frames import Frame, negotiated_deflate, raw_transport
+from app.services.metrics import SOCKET_SEND
+
+logger = logging.getLogger(__name__)
+
+# Process wide connection ids, the keys of the session memberships
+_connection_ids = itertools.count(1)
+
+
+class SlowConsumerPolicy(str, enum.Enum):
+    DROP_OLDEST = "drop_oldest"   # discard the oldest queued message to make room
+    COALESCE = "coalesce"         # replace the whole backlog with a resync marker, then the newest message
+    DISCONNECT = "disconnect"     # close the socket, the client reconnects and refetches
+
+
+def resync_frame(after: Optional[bytes]) -> Frame:
+    """
+    Frame sent in place of the backlog a slow consumer lost, {"resync": {"after": <entry id>}}. The
+    client refetches what followed the last frame it got: the entry id in the durable fan-out mode,
+    null in the pubsub mode where it reloads the history of the session.
+    """
+    return Frame(orjson.dumps({"resync": {"after": after.decode() if after is not None else None}}))
+
+
+# The class `Connection` wraps one accepted WebSocket with a bounded outbound queue that is drained by
+# its own writer task, so a slow client only ever delays itself and never the session or the reader.
+class Connection:
+    def __init__(
+        self,
+        ws: WebSocket,
+        session_id: int,
+        maxsize: int = Config.WS_SEND_QUEUE_SIZE,
+        policy: SlowConsumerPolicy = SlowConsumerPolicy(
+            Config.WS_SLOW_CONSUMER_POLICY),
+        binary: bool = False,
+    ):
+        self.id = next(_connection_ids)
+        self.ws = ws
+        self.session_id = session_id
+        # Last time the client sent anything, a heartbeat answer included
+        self.last_seen = time.monotonic()
+        # The client negotiated the binary subprotocol, packets are sent to it without text encoding
+        self.binary = binary
+        self.policy = policy
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self.closed = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        # Entry id of the last frame written to the socket, where a resync starts from
+        self.last_sent_id: Optional[bytes] = None
+
+        self.raw_sent = 0
+        self.deflate = False
+
+        self._transport = None
+        self._writer: Optional[asyncio.Task] = None
+        self._sending = False
+        # Live frames held back while a replay is queued, see `hold` and `resume`
+        self._held: Optional[List[Frame]] = None
+
+    def start(self) -> None:
+        if Config.WS_PER_MESSAGE_DEFLATE:
+            self.deflate = negotiated_deflate(self.ws)
+        if Config.WS_RAW_FRAMES and not self.deflate:
+            self._transport = raw_transport(self.ws)
+        self._writer = asyncio.create_task(self._drain())
+
+    def offer(self, payload: Frame) -> bool:
+        """
+        Enqueue `payload` without waiting, applying the slow consumer policy when the queue is full.
+
+        :param payload: pre-encoded message, shared by every connection of the session
+        :return: False if the connection is closed or has to be disconnected under the policy
+        """
+        if self.closed:
+            return False
+        if self._held is not None:
+            self._held.append(payload)
+            return True
+
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            pass
+
+        if self.policy is SlowConsumerPolicy.DROP_OLDEST:
+            self.queue.get_nowait()
+            self.dropped += 1
+        elif self.policy is SlowConsumerPolicy.COALESCE:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+                self.coalesced += 1
+            # Never lose messages silently, the client is told to refetch what it missed
+            self.queue.put_nowait(resync_frame(self.last_sent_id))
+            if self.queue.full():
+                # A queue of one, the marker covers this message too
+                self.coalesced += 1
+                return True
+        else:
+            # The owner is expected to close the connection
+            self.dropped += 1
+            return False
+
+        self.queue.put_nowait(payload)
+        return True
+
+    def touch(self) -> None:
+        self.last_seen = time.monotonic()
+
+    def ping(self, payload: Frame) -> None:
+        """
+        Queue a heartbeat, unless the queue is full or held for a replay: a heartbeat is never worth
+        dropping a message for, and a client that far behind is judged on what it sends anyway.
+        """
+        if self.closed or self._held is not None or self.queue.full():
+            return
+        self.queue.put_nowait(payload)
+
+    async def flush(self, timeout: float) -> bool:
+        """
+        Wait for the queued frames to be written, for a graceful close.
+
+        :return: False when the queue was not empty after `timeout` seconds or the writer stopped
+        """
+        deadline = time.monotonic() + timeout
+        while not self.closed and (self._sending or not self.queue.empty()):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
+        return not self.closed
+
+    def hold(self) -> None:
+        """Hold the live frames back until `resume`, so that they cannot overtake a replay."""
+        self._held = []
+
+    async def resume(self, replayed: List[Frame]) -> None:
+        """
+        Queue the replayed frames, then the live frames held meanwhile that are newer than the replay,
+        and go back to live delivery.
+
+        Unlike `offer` this waits for room in the queue, a replay is never dropped by the slow consumer
+        policy.
+
+        :param replayed: frames read from the session stream after the client's cursor, oldest first
+        """
+        cursor = entry_order(replayed[-1].id) if replayed else None
+        for frame in replayed:
+            if not await self._put(frame):
+                return
+        # Frames offered while waiting here are appended to the list and drained by this same loop
+        while self._held:
+            frame = self._held.pop(0)
+            # Frames without an id are not in the stream, so never part of the replay
+            if cursor is None or frame.id is None or entry_order(frame.id) > cursor:
+                if not await self._put(frame):
+                    return
+        self._held = None
+
+    async def _put(self, payload: Frame) -> bool:
+        while not self.closed:
+            try:
+                await asyncio.wait_for(self.queue.put(payload), timeout=1)
+                return True
+            except asyncio.TimeoutError:
+                continue
+        return False
+
+    async def _drain(self) -> None:
+        try:
+            while True:
+                payload = await self.queue.get()
+                self._sending = True
+                started = time.perf_counter()
+                binary = self.binary and payload.binary
+                transport = self._transport
+                if (
+                    transport is not None
+                    and not transport.is_closing()
+                    and transport.get_write_buffer_size() < Config.WS_RAW_FRAMES_HIGH_WATER
+                ):
+                    transport.write(payload.binary_wire if binary else payload.wire)
+                    self.raw_sent += 1
+                elif binary:
+                    await self.ws.send_bytes(payload.packed)
+                else:
+                    # No raw transport, or the peer is slow to read: let the server apply backpressure
+                    await self.ws.send_text(payload.text)
+                SOCKET_SEND.observe(time.perf_counter() - started)
+                self._sending = False
+                self.sent += 1
+                if payload.id is not None:
+                    self.last_sent_id = payload.id
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # The peer went away, the endpoint's receive loop takes care of the cleanup
+            logger.debug("writer for session %s stopped",
+                         self.session_id, exc_info=True)
+        finally:
+            self.closed = True
+
+    async def close(self, code: int = status.WS_1000_NORMAL_CLOSURE, reason: Optional[str] = None) -> None:
+        if self.closed and self._writer is None:
+            return
+        self.closed = True
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        try:
+            await self.ws.close(code=code, reason=reason)
+        except Exception:  # already closed by the peer
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "id": self.id,
+            "session_id": self.session_id,
+            "client": str(self.ws.client) if self.ws.client else None,
+            "binary": self.binary,
+            "deflate": self.deflate,
+            "queue_depth": self.queue.qsize(),
+            "sent": self.sent,
+            "raw_sent": self.raw_sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "idle": time.monotonic() - self.last_seen,
+            "closed": self.closed,
+        }
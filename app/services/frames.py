@@ -0,0 +1,146 @@
+# pre-encoded websocket frames for the broadcast path
+
+import asyncio
+import struct
+from typing import Optional
+
+import orjson
+from fastapi import WebSocket
+
+from app.services.wire import is_packed, to_json, with_entry_id
+
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+
+
+def encode_frame(payload: bytes, opcode: int = OP_TEXT) -> bytes:
+    """
+    Build an unfragmented, unmasked (server to client) WebSocket frame as described in RFC 6455 5.2.
+
+    :param payload: frame payload, UTF-8 for text frames
+    :param opcode: `OP_TEXT` or `OP_BINARY`
+    :return: header and payload as one buffer, ready to be written to a transport
+    """
+    length = len(payload)
+    first = 0x80 | opcode
+    if length < 126:
+        header = struct.pack("!BB", first, length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", first, 126, length)
+    else:
+        header = struct.pack("!BBQ", first, 127, length)
+    return header + payload
+
+
+# The class `Frame` is one broadcast message shared by every connection of a session. The text, the
+# binary packet and their wire bytes are each built at most once, on first use, and the very same
+# buffer is written to every transport.
+class Frame:
+    __slots__ = ("data", "id", "_text", "_text_data", "_packed", "_wire", "_binary_wire")
+
+    def __init__(self, data: bytes, id: Optional[bytes] = None):
+        # UTF-8 text, or a `wire.pack` packet
+        self.data = data
+        # Stream entry id of the message, only set in the streams fan-out mode
+        self.id = id
+        self._text: Optional[str] = None
+        self._text_data: Optional[bytes] = None
+        self._packed: Optional[bytes] = None
+        self._wire: Optional[bytes] = None
+        self._binary_wire: Optional[bytes] = None
+
+    @classmethod
+    def from_text(cls, text: str) -> "Frame":
+        frame = cls(text.encode())
+        frame._text = text
+        return frame
+
+    @classmethod
+    def from_entry(cls, entry_id: bytes, data: bytes) -> "Frame":
+        return cls(data, entry_id)
+
+    @property
+    def binary(self) -> bool:
+        return is_packed(self.data)
+
+    @property
+    def text_data(self) -> bytes:
+        # Text clients get packets as JSON, and the entry id they need to resume after a reconnect
+        if self._text_data is None:
+            if self.binary:
+                self._text_data = to_json(self.data, self.id)
+            elif self.id is not None:
+                self._text_data = orjson.dumps(
+                    {"id": self.id.decode(), "data": self.data.decode("utf-8")})
+            else:
+                self._text_data = self.data
+        return self._text_data
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.text_data.decode("utf-8")
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        # Only meaningful for binary messages, sent as is to the clients of the binary subprotocol
+        if self._packed is None:
+            self._packed = self.data if self.id is None else with_entry_id(self.data, self.id)
+        return self._packed
+
+    @property
+    def wire(self) -> bytes:
+        if self._wire is None:
+            self._wire = encode_frame(self.text_data, OP_TEXT)
+        return self._wire
+
+    @property
+    def binary_wire(self) -> bytes:
+        if self._binary_wire is None:
+            self._binary_wire = encode_frame(self.packed, OP_BINARY)
+        return self._binary_wire
+
+
+def _find_protocol(send, depth: int = 0):
+    # ASGI middlewares wrap `send` in closures, follow them down to the server's bound method
+    owner = getattr(send, "__self__", None)
+    if owner is not None and hasattr(owner, "transport"):
+        return owner
+    if depth > 8:
+        return None
+    for cell in getattr(send, "__closure__", None) or ():
+        try:
+            inner = cell.cell_contents
+        except ValueError:
+            continue
+        if callable(inner):
+            if (found := _find_protocol(inner, depth + 1)) is not None:
+                return found
+    return None
+
+
+def negotiated_deflate(ws: WebSocket) -> bool:
+    """Whether permessage-deflate was negotiated on the connection, as far as the server lets us see."""
+    protocol = _find_protocol(ws._send)
+    extensions = getattr(protocol, "extensions", None) or ()
+    return any(getattr(extension, "name", None) == "permessage-deflate" for extension in extensions)
+
+
+def raw_transport(ws: WebSocket) -> Optional[asyncio.Transport]:
+    """
+    Find the asyncio transport under an accepted Starlette WebSocket, if the ASGI server exposes one.
+
+    Frames written there bypass the server's per message encoding. Uncompressed frames stay valid when
+    permessage-deflate was negotiated, since RSV1 is left unset (RFC 7692 6).
+
+    :return: the transport, or None when only the ASGI `send_text` path is usable
+    """
+    protocol = _find_protocol(ws._send)
+    if protocol is None:
+        return None
+    transport = getattr(protocol, "transport", None)
+    # Not every event loop's transports subclass asyncio.Transport, check the interface instead
+    if not all(hasattr(transport, name) for name in ("write", "is_closing", "get_write_buffer_size")):
+        return None
+    return transport
@@ -0,0 +1,60 @@
+# paginated session history
+
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.models import MessageModel
+from app.models.schemas import MessagePage, StoredMessage
+from app.services.encryption import decrypt_many, message_cache
+
+
+async def get_session_history(session_id: int, before: Optional[int], limit: int, db: AsyncSession) -> MessagePage:
+    """
+    The function `get_session_history` returns one page of a session's messages, newest first, using
+    keyset pagination on `(session_id, created_at, mid)` so that the cost of a page does not depend on
+    how long the session is, nor on how many monthly partitions `messages` has.
+
+    :param session_id: the session whose history is read
+    :param before: only return messages older than this message id, None for the newest page
+    :param limit: the page size
+    :param db: database session, only used when the Redis recent messages index cannot serve the page
+    :return: a `MessagePage` whose `next_before` is the cursor of the next page
+    """
+    if (cached := await message_cache.recent_page(session_id, before, limit)) is not None:
+        rows = [(mid, sender_id, value.decode())
+                for mid, sender_id, value in cached]
+    else:
+        # Ids and creation times grow together, both are allocated in the enqueue script. Ordering by
+        # the partition key lets Postgres read the monthly partitions newest first and stop at the page.
+        query = (
+            select(MessageModel.mid, MessageModel.sender_id,
+                   MessageModel.mssg_encrypt)
+            .where(MessageModel.session_id == session_id)
+            .order_by(MessageModel.created_at.desc(), MessageModel.mid.desc())
+            .limit(limit)
+        )
+        if before is not None:
+            # Bounding created_at by the cursor's prunes the newer partitions at execution time. A cursor
+            # not persisted yet, still on its way through the write-behind stream, bounds nothing.
+            cursor_created_at = (
+                select(MessageModel.created_at)
+                .where(MessageModel.session_id == session_id, MessageModel.mid == before)
+                .scalar_subquery()
+            )
+            query = query.where(
+                MessageModel.mid < before,
+                MessageModel.created_at <= func.coalesce(cursor_created_at, datetime.max),
+            )
+        rows = (await db.execute(query)).all()
+
+    decrypted = await decrypt_many([encrypted for _, _, encrypted in rows])
+    messages = [
+        StoredMessage(mid=mid, sender_id=sender_id,
+                      session=session_id, text=result.value)
+        for (mid, sender_id, _), result in zip(rows, decrypted)
+    ]
+    next_before = messages[-1].mid if len(messages) == limit else None
+    return MessagePage(messages=messages, next_before=next_before)
@@ -0,0 +1,169 @@
+# heartbeats, idle eviction and graceful drain of the local sockets
+
+import asyncio
+import logging
+import random
+import time
+from typing import TYPE_CHECKING, Awaitable, Callable, Optional
+
+import orjson
+from fastapi import WebSocket
+from starlette import status
+
+from app.config import Config
+from app.services.frames import Frame
+
+if TYPE_CHECKING:
+    from app.services.ws import WebSockM
+
+logger = logging.getLogger(__name__)
+
+
+# Close code of a socket evicted after WS_IDLE_TIMEOUT without a frame
+CLOSE_IDLE = 4008
+# Service Restart: the client should reconnect, after the delay of the reason
+CLOSE_DRAIN = status.WS_1012_SERVICE_RESTART
+
+
+def is_pong(message: str) -> bool:
+    """
+    Recognize a heartbeat answer among the text messages of a session socket: a JSON object with a
+    "pong" key, conventionally echoing the ping, e.g. {"pong": 1700000000000}. They are never broadcast.
+    """
+    # Only messages that can be one are parsed
+    if '"pong"' not in message:
+        return False
+    try:
+        document = orjson.loads(message)
+    except orjson.JSONDecodeError:
+        return False
+    return isinstance(document, dict) and "pong" in document
+
+
+def reconnect_hint() -> str:
+    """Close reason of a drained socket, a reconnect delay spread over WS_RECONNECT_SPREAD."""
+    delay = int(random.uniform(0, Config.WS_RECONNECT_SPREAD) * 1000)
+    return orjson.dumps({"reconnect_after": delay}).decode()
+
+
+def drain_before_server_shutdown(drain: Callable[[], Awaitable[None]]) -> None:
+    """
+    Run `drain` as soon as uvicorn starts shutting down, while the sockets are still open.
+
+    uvicorn's `Server.shutdown` stops listening and closes every WebSocket with a bare 1012 before it
+    sends the lifespan shutdown event, so a drain left to the lifespan would find no live socket and
+    every client would reconnect at once. The lifespan drain stays as the fallback of other servers.
+
+    :param drain: coroutine function closing the local sockets gracefully, run once
+    """
+    try:
+        import uvicorn
+    except ImportError:
+        return
+    shutdown = uvicorn.Server.shutdown
+
+    async def drain_then_shutdown(server, *args, **kwargs):
+        try:
+            await drain()
+        except Exception:
+            logger.exception("drain before shutdown failed")
+        await shutdown(server, *args, **kwargs)
+
+    uvicorn.Server.shutdown = drain_then_shutdown
+
+
+# The class `ConnectionLifecycle` watches the local sockets of a `WebSockM`. Every heartbeat interval it
+# sends one shared ping frame to the live sockets and evicts the ones that stayed silent for too long
+# or whose writer died, instead of waiting for a send to fail. On shutdown it drains them.
+class ConnectionLifecycle:
+    def __init__(self, manager: "WebSockM"):
+        self.manager = manager
+        self.draining = False
+
+        self.pings = 0
+        self.evicted = 0
+        self.drained = 0
+        self.unflushed = 0
+
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def tick(self) -> None:
+        now = time.monotonic()
+        ping = Frame(orjson.dumps({"ping": int(time.time() * 1000)}))
+        for connection in list(self.manager.connections.values()):
+            if connection.closed:
+                # The writer stopped on a send error, the peer is gone
+                self.manager._discard(connection)
+                self.evicted += 1
+                self.manager._close_later(connection, status.WS_1011_INTERNAL_ERROR)
+            elif now - connection.last_seen > Config.WS_IDLE_TIMEOUT:
+                self.manager._discard(connection)
+                self.evicted += 1
+                self.manager._close_later(connection, CLOSE_IDLE, "idle timeout")
+            else:
+                connection.ping(ping)
+                self.pings += 1
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(Config.WS_HEARTBEAT_INTERVAL)
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("connection heartbeat failed")
+
+    async def turn_away(self, ws: WebSocket) -> None:
+        # Sockets arriving while draining go straight to another node
+        await ws.accept()
+        await ws.close(code=CLOSE_DRAIN, reason=reconnect_hint())
+
+    async def drain(self) -> None:
+        """
+        The function `drain` closes every local socket gracefully before shutdown. New sockets are turned
+        away, the node leaves the shard ring so its sessions move to other nodes, the sockets are taken
+        off the fan-out and given WS_DRAIN_TIMEOUT to flush their queues, then closed with 1012 and a
+        randomized reconnect delay. Clients of the durable fan-out resume from their last id.
+
+        It runs before uvicorn's own shutdown, see `drain_before_server_shutdown`, and again from the
+        lifespan where it returns at once.
+        """
+        if self.draining:
+            return
+        self.draining = True
+        await self.stop()
+        if self.manager.registry is not None:
+            await self.manager.registry.stop()
+
+        connections = list(self.manager.connections.values())
+        for connection in connections:
+            self.manager._discard(connection)
+        flushed = await asyncio.gather(
+            *(connection.flush(Config.WS_DRAIN_TIMEOUT) for connection in connections))
+        self.unflushed += flushed.count(False)
+        await asyncio.gather(
+            *(connection.close(CLOSE_DRAIN, reconnect_hint()) for connection in connections))
+        self.drained += len(connections)
+        logger.info("drained %d connections, %d with frames left unsent",
+                    len(connections), flushed.count(False))
+
+    def stats(self) -> dict:
+        return {
+            "draining": self.draining,
+            "connections": len(self.manager.connections),
+            "pings": self.pings,
+            "evicted": self.evicted,
+            "drained": self.drained,
+            "unflushed": self.unflushed,
+        }
@@ -0,0 +1,126 @@
+# async redis cache for encrypted messages
+
+import asyncio
+from typing import List, Optional, Sequence, Set, Tuple
+
+import aioredis
+
+from app.config import Config
+
+
+# The class `MessageCache` keeps encrypted messages in Redis on a pooled async client. Writes issued
+# in the same event loop tick by concurrent senders are sent as one pipeline, value and TTL in a single
+# SET each, and bulk reads are a single MGET.
+class MessageCache:
+    def __init__(self, redis_host=Config.REDIS_HOST, redis_port=Config.REDIS_PORT, ttl=Config.MESSAGE_CACHE_TTL):
+        self.ttl = ttl
+        self.pool = aioredis.ConnectionPool.from_url(
+            f"redis://{redis_host}:{redis_port}",
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+        )
+        self.redis = aioredis.Redis(connection_pool=self.pool)
+        self._pending: list = []
+        # The loop only keeps weak references to tasks, hold the running flushes until they are done
+        self._flushes: Set[asyncio.Task] = set()
+        self.writes = 0
+        self.write_errors = 0
+
+    @staticmethod
+    def key(message_id: int) -> str:
+        return f"message:{message_id}"
+
+    @staticmethod
+    def recent_key(session_id: int) -> str:
+        # Sorted set of the newest messages of a session, members are "mid:sender_id" scored by mid
+        return f"session:{session_id}:recent"
+
+    async def set(self, message_id: int, value) -> None:
+        """
+        Cache `value` under the message id with the cache TTL.
+
+        The write joins the pipeline of the current tick and the call returns once it was executed.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((message_id, value, future))
+        if len(self._pending) == 1:
+            # First writer of the tick schedules the flush, the others just join the batch
+            flush = asyncio.create_task(self._flush())
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+        await future
+
+    async def _flush(self) -> None:
+        batch, self._pending = self._pending, []
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for message_id, value, _ in batch:
+                    pipe.set(self.key(message_id), value, ex=self.ttl)
+                await pipe.execute()
+        except Exception as exc:
+            self.write_errors += len(batch)
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+        else:
+            self.writes += len(batch)
+            for *_, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    def queue_recent(self, pipe, rows: Sequence[dict]) -> None:
+        """
+        Queue on a pipeline the caching of persisted `messages` rows and their entry in the recent
+        messages index of their session. Only `post_process` calls it, after the insert, so the index
+        never holds a message that is not in the database: a page it serves has no gap but the ones
+        whose values expired, and those go to the database.
+        """
+        sessions = set()
+        for row in rows:
+            pipe.set(self.key(row["mid"]), row["mssg_encrypt"], ex=self.ttl)
+            pipe.zadd(self.recent_key(row["session_id"]),
+                      {f"{row['mid']}:{row['sender_id']}": row["mid"]})
+            sessions.add(row["session_id"])
+        for session_id in sessions:
+            recent = self.recent_key(session_id)
+            pipe.zremrangebyrank(recent, 0, -Config.HISTORY_CACHE_SIZE - 1)
+            pipe.expire(recent, self.ttl)
+
+    async def get(self, message_id: int) -> Optional[bytes]:
+        return await self.redis.get(self.key(message_id))
+
+    async def get_many(self, message_ids: Sequence[int]) -> List[Optional[bytes]]:
+        """
+        Fetch many cached messages in one MGET.
+
+        :return: the cached values in the order of `message_ids`, None for the misses
+        """
+        if not message_ids:
+            return []
+        return await self.redis.mget([self.key(mid) for mid in message_ids])
+
+    async def recent_page(self, session_id: int, before: Optional[int], limit: int) -> Optional[List[Tuple[int, int, bytes]]]:
+        """
+        Serve a page of a session's history from the recent messages index.
+
+        :param before: only messages with a smaller id, None for the newest page
+        :return: `(mid, sender_id, value)` tuples, newest first, or None when the cache cannot serve a full
+        page and the caller has to go to the database
+        """
+        maximum = "+inf" if before is None else f"({before}"
+        members = await self.redis.zrevrangebyscore(
+            self.recent_key(session_id), maximum, "-inf", start=0, num=limit)
+        if len(members) < limit:
+            return None
+
+        index = [tuple(int(part) for part in member.split(b":"))
+                 for member in members]
+        values = await self.get_many([mid for mid, _ in index])
+        if any(value is None for value in values):
+            return None
+        return [(mid, sender_id, value) for (mid, sender_id), value in zip(index, values)]
+
+    def stats(self) -> dict:
+        return {
+            "writes": self.writes,
+            "write_errors": self.write_errors,
+        }
@@ -0,0 +1,249 @@
+# process local metrics, exposed in the Prometheus text format
+
+import bisect
+import inspect
+import logging
+import math
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from 50us for the in memory stages up to the slow database batches
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def pushed_key(name: str) -> str:
+    # Redis hash of a histogram family pushed by the processes nobody scrapes, summed over all of them
+    return f"metrics:{name}"
+
+
+# The class `Histogram` counts observations into fixed buckets. Observing is a bisect and three
+# additions on plain Python numbers, no lock, which is enough from the event loop and cheap enough to
+# stay on in production. Buckets are only made cumulative when rendered.
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labelnames: Sequence[str], labelvalues: Sequence[Any]) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            le = f'le="{_number(bound)}"'
+            lines.append(f"{name}_bucket{_labels(labelnames, labelvalues, le)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labelnames, labelvalues)} {_number(self.sum)}")
+        lines.append(f"{name}_count{_labels(labelnames, labelvalues)} {self.count}")
+        return lines
+
+
+class HistogramFamily:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.children: Dict[Tuple, Histogram] = {}
+
+    def labels(self, *values: Any) -> Histogram:
+        """Child histogram of a label combination, meant to be looked up once and kept by the caller."""
+        if values not in self.children:
+            self.children[values] = Histogram(self.buckets)
+        return self.children[values]
+
+    async def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, histogram in self.children.items():
+            lines += histogram.render(self.name, self.labelnames, values)
+        return lines
+
+
+# The class `PushedHistogramFamily` renders the sums that other processes pushed for the `source`
+# family with `Registry.push`, read from Redis at scrape time. Fields of the hash are
+# `<label values>|<bucket index>`, `<label values>|sum` and `<label values>|count`.
+class PushedHistogramFamily:
+    def __init__(self, name: str, documentation: str, source: HistogramFamily, redis):
+        self.name = name
+        self.documentation = documentation
+        self.source = source
+        self.redis = redis
+
+    async def render(self) -> List[str]:
+        children: Dict[Tuple, Histogram] = {}
+        for field, value in (await self.redis.hgetall(pushed_key(self.source.name))).items():
+            label, _, slot = field.decode().rpartition("|")
+            values = tuple(label.split(",")) if self.source.labelnames else ()
+            histogram = children.setdefault(values, Histogram(self.source.buckets))
+            if slot == "sum":
+                histogram.sum = float(value)
+            elif slot == "count":
+                histogram.count = int(value)
+            elif int(slot) < len(histogram.counts):
+                histogram.counts[int(slot)] = int(value)
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, histogram in sorted(children.items()):
+            lines += histogram.render(self.name, self.source.labelnames, values)
+        return lines
+
+
+# The class `GaugeFamily` is read at scrape time from a callback, so nothing is maintained on the hot
+# paths. The callback returns a number, or a mapping of label value tuples to numbers, and may be a
+# coroutine function.
+class GaugeFamily:
+    def __init__(self, name: str, documentation: str, callback: Callable,
+                 labelnames: Sequence[str] = (), kind: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.kind = kind
+
+    async def render(self) -> List[str]:
+        value = self.callback()
+        if inspect.isawaitable(value):
+            value = await value
+        samples = value if isinstance(value, dict) else {(): value}
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, sample in samples.items():
+            if isinstance(sample, (int, float)) and not isinstance(sample, bool):
+                lines.append(f"{self.name}{_labels(self.labelnames, values)} {_number(sample)}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.families: Dict[str, Any] = {}
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> HistogramFamily:
+        family = HistogramFamily(name, documentation, labelnames, buckets)
+        self.families[name] = family
+        return family
+
+    def gauge(self, name: str, documentation: str, callback: Callable,
+              labelnames: Sequence[str] = ()) -> GaugeFamily:
+        family = GaugeFamily(name, documentation, callback, labelnames)
+        self.families[name] = family
+        return family
+
+    def pushed_histogram(self, name: str, documentation: str, source: HistogramFamily,
+                         redis) -> PushedHistogramFamily:
+        """Expose, under `name`, what the processes running `push` observed in the `source` family."""
+        family = PushedHistogramFamily(name, documentation, source, redis)
+        self.families[name] = family
+        return family
+
+    async def push(self, redis) -> None:
+        """
+        The function `push` adds what every histogram observed since the last push to its Redis hash, in
+        one pipeline, for the processes that are not scraped such as the Celery workers. The API sums
+        them up with `pushed_histogram`. What was pushed is taken off the local histograms, so nothing is
+        counted twice, and a failed push is retried with the next one.
+
+        :param redis: async Redis client
+        """
+        taken = []
+        async with redis.pipeline(transaction=False) as pipe:
+            for family in self.families.values():
+                if not isinstance(family, HistogramFamily):
+                    continue
+                for values, histogram in family.children.items():
+                    if histogram.count == 0:
+                        continue
+                    key, label = pushed_key(family.name), ",".join(map(str, values))
+                    counts = list(histogram.counts)
+                    for index, count in enumerate(counts):
+                        if count:
+                            pipe.hincrby(key, f"{label}|{index}", count)
+                    pipe.hincrbyfloat(key, f"{label}|sum", histogram.sum)
+                    pipe.hincrby(key, f"{label}|count", histogram.count)
+                    taken.append((histogram, counts, histogram.sum, histogram.count))
+            if not taken:
+                return
+            await pipe.execute()
+
+        for histogram, counts, total, count in taken:
+            # Observations made while the pipeline was in flight stay for the next push
+            histogram.counts = [now - pushed for now, pushed in zip(histogram.counts, counts)]
+            histogram.sum -= total
+            histogram.count -= count
+
+    def stats(self, prefix: str, callback: Callable[[], dict]) -> None:
+        """
+        Expose the numbers of an existing `stats()` dict, one untyped metric per key, read at scrape time.
+
+        :param prefix: metric name prefix, e.g. `room_write_behind`
+        :param callback: the `stats` method, its numeric keys are looked up once here
+        """
+        for key, value in callback().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                name = f"{prefix}_{key}"
+                self.families[name] = GaugeFamily(
+                    name, f"{key}, from the {prefix} stats", lambda key=key: callback().get(key),
+                    kind="untyped")
+
+    async def render(self) -> str:
+        lines = []
+        for family in self.families.values():
+            try:
+                lines += await family.render()
+            except Exception:
+                # One unreachable source, such as the broker, must not hide all the other metrics
+                logger.warning("metric %s could not be collected", family.name, exc_info=True)
+        return "\n".join(lines) + "\n"
+
+
+def redis_pool_usage(pools: Dict[str, Any]) -> Dict[Tuple[str, str], int]:
+    """
+    Connections of aioredis pools, by pool and state, for a gauge with the `pool` and `state` labels.
+
+    :param pools: the `ConnectionPool` of every client, by name
+    """
+    usage = {}
+    for name, pool in pools.items():
+        usage[(name, "in_use")] = len(pool._in_use_connections)
+        usage[(name, "idle")] = len(pool._available_connections)
+        usage[(name, "max")] = pool.max_connections
+    return usage
+
+
+REGISTRY = Registry()
+
+# Latency of every stage between `send_message` and the sockets
+STAGE_SECONDS = REGISTRY.histogram(
+    "room_stage_seconds", "Time spent in each stage of the message path", ("stage",))
+SEND_MESSAGE = STAGE_SECONDS.labels("send_message")
+ENCRYPT = STAGE_SECONDS.labels("encrypt")
+ENQUEUE = STAGE_SECONDS.labels("enqueue")
+CACHE_WRITE = STAGE_SECONDS.labels("cache_write")
+DB_INSERT = STAGE_SECONDS.labels("db_insert")
+POST_PROCESS = STAGE_SECONDS.labels("post_process")
+SEARCH_INDEX = STAGE_SECONDS.labels("search_index")
+PUBLISH = STAGE_SECONDS.labels("publish")
+FANOUT = STAGE_SECONDS.labels("fanout")
+SOCKET_SEND = STAGE_SECONDS.labels("socket_send")
@@ -0,0 +1,305 @@
+# monthly partitions of the messages and message_search tables
+
+import asyncio
+import csv
+import gzip
+import logging
+import os
+import sys
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from app.config import Config
+from app.models import MessageModel
+from app.services.db import DB_MANAGER
+
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:  # archives fall back to gzipped CSV
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+PARENT = "messages"
+# Tables partitioned by month on created_at. Only `messages` is archived, the other ones are derived
+# from it and their expired partitions are dropped.
+PARENTS = (PARENT, "message_search")
+# Serializes the partition DDL of the API and Celery processes, taken for the transaction only
+LOCK_ID = 727_001
+ARCHIVE_COLUMNS = ("mid", "session_id", "sender_id", "room_id", "mssg_encrypt", "created_at", "update_time")
+ARCHIVE_CHUNK = 10_000
+
+
+def month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1)
+
+
+def add_months(month: datetime, months: int) -> datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month: datetime, parent: str = PARENT) -> str:
+    return f"{parent}_y{month.year:04d}m{month.month:02d}"
+
+
+def partition_month(name: str, parent: str = PARENT) -> Optional[datetime]:
+    """
+    :return: the first day of the month a partition covers, None when the table is not a month partition
+    of `parent`
+    """
+    prefix = f"{parent}_y"
+    if not name.startswith(prefix) or len(name) != len(prefix) + 7 or name[-3] != "m":
+        return None
+    try:
+        return datetime(int(name[-7:-3]), int(name[-2:]), 1)
+    except ValueError:
+        return None
+
+
+async def attached_partitions(connection: AsyncConnection, parent: str = PARENT) -> List[str]:
+    result = await connection.execute(text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON pg_inherits.inhparent = parent.oid "
+        "JOIN pg_class child ON pg_inherits.inhrelid = child.oid "
+        "WHERE parent.relname = :parent AND pg_table_is_visible(parent.oid)"
+    ), {"parent": parent})
+    return sorted(result.scalars())
+
+
+async def detached_partitions(connection: AsyncConnection, parent: str = PARENT) -> List[str]:
+    # Month partitions detached by the retention policy and not archived yet
+    result = await connection.execute(text(
+        "SELECT relname FROM pg_class "
+        "WHERE relkind = 'r' AND NOT relispartition AND pg_table_is_visible(oid) "
+        "AND relname LIKE :pattern"
+    ), {"pattern": f"{parent}\\_y%"})
+    return sorted(name for name in result.scalars() if partition_month(name, parent) is not None)
+
+
+async def ensure_partitions(
+    connection: AsyncConnection,
+    now: Optional[datetime] = None,
+    since: Optional[datetime] = None,
+    ahead: int = Config.PARTITION_PREMAKE_MONTHS,
+) -> List[str]:
+    """
+    The function `ensure_partitions` creates the missing month partitions of the partitioned tables, from
+    the current month, or `since`, to `ahead` months after the current one. The write-behind worker
+    stamps every row with the time its message was enqueued, so the rows always land in one of them.
+    Tables that do not exist yet are skipped.
+
+    :param now: the current time, naive UTC like the `created_at` column
+    :param since: also cover the months from this time on, e.g. the oldest row of a migrated table
+    :param ahead: how many months to create in advance
+    :return: the names of the partitions created
+    """
+    await connection.execute(text("SELECT pg_advisory_xact_lock(:lock)"), {"lock": LOCK_ID})
+    current = month_start(now or datetime.utcnow())
+    created = []
+    for parent in PARENTS:
+        if await connection.scalar(text("SELECT to_regclass(:parent)"), {"parent": parent}) is None:
+            continue
+        existing = set(await attached_partitions(connection, parent))
+        month = month_start(min(since, current)) if since is not None else current
+        while month <= add_months(current, ahead):
+            name = partition_name(month, parent)
+            if name not in existing:
+                # Bounds are formatted from datetimes, DDL does not take bind parameters
+                await connection.execute(text(
+                    f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {parent} "
+                    f"FOR VALUES FROM ('{month.isoformat(sep=' ')}') "
+                    f"TO ('{add_months(month, 1).isoformat(sep=' ')}')"
+                ))
+                created.append(name)
+            month = add_months(month, 1)
+    if created:
+        logger.info("created message partitions: %s", ", ".join(created))
+    return created
+
+
+async def detach_expired(
+    connection: AsyncConnection,
+    now: Optional[datetime] = None,
+    retention: int = Config.MESSAGE_RETENTION_MONTHS,
+) -> List[str]:
+    """
+    Detach the partitions of the months that fell out of the retention window. A detached partition
+    keeps its rows as a standalone table until `archive_partition` exports and drops it.
+
+    DETACH briefly locks `messages`, so keep the transaction short and archive in another one.
+
+    :param retention: how many months to keep before the current one, 0 to keep everything
+    :return: the names of the partitions detached
+    """
+    if retention <= 0:
+        return []
+    await connection.execute(text("SELECT pg_advisory_xact_lock(:lock)"), {"lock": LOCK_ID})
+    cutoff = add_months(month_start(now or datetime.utcnow()), -retention)
+    detached = []
+    for parent in PARENTS:
+        for name in await attached_partitions(connection, parent):
+            month = partition_month(name, parent)
+            if month is not None and month < cutoff:
+                await connection.execute(text(f"ALTER TABLE {parent} DETACH PARTITION {name}"))
+                detached.append(name)
+    if detached:
+        logger.info("detached message partitions: %s", ", ".join(detached))
+    return detached
+
+
+def _parquet_schema():
+    return pyarrow.schema([
+        ("mid", pyarrow.int64()),
+        ("session_id", pyarrow.int64()),
+        ("sender_id", pyarrow.int64()),
+        ("room_id", pyarrow.int64()),
+        ("mssg_encrypt", pyarrow.string()),
+        ("created_at", pyarrow.timestamp("us")),
+        ("update_time", pyarrow.timestamp("us", tz="UTC")),
+    ])
+
+
+def _durable_replace(partial: str, path: str) -> None:
+    # The table is dropped right after, so the archive and its name must be on disk first
+    with open(partial, "rb") as archive:
+        os.fsync(archive.fileno())
+    os.replace(partial, path)
+    directory = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    try:
+        os.fsync(directory)
+    finally:
+        os.close(directory)
+
+
+async def archive_partition(connection: AsyncConnection, name: str,
+                            directory: str = Config.PARTITION_ARCHIVE_DIR) -> str:
+    """
+    The function `archive_partition` exports a detached partition to a local file and drops the table.
+    Messages stay Fernet encrypted in the archive.
+
+    Rows are streamed in chunks through a server side cursor. The file is Parquet with zstd compression
+    when pyarrow is installed, gzipped CSV otherwise, and is only moved to its final name once complete
+    and synced to disk along with its directory, the table is dropped after that.
+
+    :param name: a table returned by `detached_partitions`
+    :param directory: where the archives are written
+    :return: the path of the archive
+    """
+    os.makedirs(directory, exist_ok=True)
+    extension = "parquet" if pyarrow is not None else "csv.gz"
+    path = os.path.join(directory, f"{name}.{extension}")
+    partial = f"{path}.partial"
+
+    result = await connection.stream(text(
+        f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM {name} ORDER BY mid"))
+    rows = 0
+    if pyarrow is not None:
+        schema = _parquet_schema()
+        with parquet.ParquetWriter(partial, schema, compression="zstd") as writer:
+            async for chunk in result.partitions(ARCHIVE_CHUNK):
+                writer.write_table(pyarrow.Table.from_pylist(
+                    [dict(row._mapping) for row in chunk], schema=schema))
+                rows += len(chunk)
+    else:
+        with gzip.open(partial, "wt", newline="") as archive:
+            writer = csv.writer(archive)
+            writer.writerow(ARCHIVE_COLUMNS)
+            async for chunk in result.partitions(ARCHIVE_CHUNK):
+                writer.writerows(chunk)
+                rows += len(chunk)
+
+    _durable_replace(partial, path)
+    await connection.execute(text(f"DROP TABLE {name}"))
+    logger.info("archived %d messages of %s to %s", rows, name, path)
+    return path
+
+
+async def maintain() -> dict:
+    """
+    One maintenance run: create the upcoming partitions, detach the expired ones, archive every
+    detached `messages` partition and drop the detached partitions of the derived tables, each step in
+    its own transaction. A run that failed halfway is completed by the next one, since archival picks
+    up whatever is still detached.
+    """
+    async with DB_MANAGER.connect() as connection:
+        created = await ensure_partitions(connection)
+    async with DB_MANAGER.connect() as connection:
+        detached = await detach_expired(connection)
+    async with DB_MANAGER.connect() as connection:
+        pending = await detached_partitions(connection)
+        for parent in PARENTS[1:]:
+            for name in await detached_partitions(connection, parent):
+                await connection.execute(text(f"DROP TABLE {name}"))
+
+    archived = []
+    for name in pending:
+        async with DB_MANAGER.connect() as connection:
+            archived.append(await archive_partition(connection, name))
+    return {"created": created, "detached": detached, "archived": archived}
+
+
+async def partition_existing(connection: AsyncConnection) -> int:
+    """
+    Move an unpartitioned `messages` table, created before partitioning, into the partitioned one.
+
+    The old table is renamed to `messages_legacy`, with its indexes and id sequence, and kept so that it
+    can be checked and dropped by hand. Rows without a `created_at` go to the month of their
+    `update_time`.
+
+    :return: the number of rows copied, 0 when `messages` is already partitioned
+    """
+    kind = await connection.scalar(text(
+        "SELECT relkind FROM pg_class WHERE relname = :parent AND pg_table_is_visible(oid)"
+    ), {"parent": PARENT})
+    if kind != "r":
+        return 0
+
+    legacy = f"{PARENT}_legacy"
+    await connection.execute(text(f"ALTER TABLE {PARENT} RENAME TO {legacy}"))
+    indexes = (await connection.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = :legacy"), {"legacy": legacy})).scalars().all()
+    for index in indexes:
+        await connection.execute(text(
+            f"ALTER INDEX {index} RENAME TO {index.replace(PARENT, legacy, 1)}"))
+    await connection.execute(text(
+        f"ALTER SEQUENCE IF EXISTS {PARENT}_mid_seq RENAME TO {legacy}_mid_seq"))
+
+    await connection.run_sync(MessageModel.__table__.create)
+    oldest = await connection.scalar(text(
+        f"SELECT min(coalesce(created_at, update_time AT TIME ZONE 'UTC')) FROM {legacy}"))
+    await ensure_partitions(connection, since=oldest)
+
+    result = await connection.execute(text(
+        f"INSERT INTO {PARENT} (mid, sender_id, mssg_encrypt, room_id, session_id, created_at, update_time) "
+        f"SELECT mid, sender_id, mssg_encrypt, room_id, session_id, "
+        f"coalesce(created_at, update_time AT TIME ZONE 'UTC', now() AT TIME ZONE 'UTC'), update_time "
+        f"FROM {legacy}"
+    ))
+    await connection.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{PARENT}', 'mid'), "
+        f"(SELECT coalesce(max(mid), 0) + 1 FROM {legacy}), false)"))
+    return result.rowcount
+
+
+async def _main(command: str) -> None:
+    DB_MANAGER.init(Config.DB_CONFIG)
+    try:
+        if command == "migrate":
+            async with DB_MANAGER.connect() as connection:
+                logger.info("copied %d messages to the partitioned table",
+                            await partition_existing(connection))
+        else:
+            logger.info("maintenance: %s", await maintain())
+    finally:
+        await DB_MANAGER.close()
+
+
+if __name__ == "__main__":
+    # python -m app.services.partitions [migrate|maintain]
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main(sys.argv[1] if len(sys.argv) > 1 else "maintain"))
@@ -0,0 +1,368 @@
+# write-behind message persistence
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import aioredis
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.exc import IntegrityError
+
+from app.config import Config
+from app.models import MessageModel
+from app.services.db import DB_MANAGER, chunked
+from app.services.metrics import DB_INSERT, POST_PROCESS, REGISTRY
+
+logger = logging.getLogger(__name__)
+
+MID_SEQUENCE = "messages:mid"
+GROUP = "writers"
+# Messages rejected by the database WRITE_BEHIND_MAX_ATTEMPTS times, kept for inspection and replay
+DEAD_LETTER_STREAM = "messages:dead"
+# SQLSTATE of a row outside of every partition, it fails every row alike and is fixed by the partition
+# maintenance, so it is retried like any other failure
+CHECK_VIOLATION = "23514"
+
+# Allocate the message id and append the message to its shard in one atomic round trip
+ENQUEUE_SCRIPT = """
+local mid = redis.call('INCR', KEYS[1])
+redis.call('XADD', KEYS[2], '*', 'mid', mid, 'sid', ARGV[1], 'sender', ARGV[2], 'msg', ARGV[3])
+return mid
+"""
+
+# Never move the id sequence backwards, rows inserted before the write-behind era keep their ids
+SEQUENCE_FLOOR_SCRIPT = """
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if current < tonumber(ARGV[1]) then
+    redis.call('SET', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+
+def shard_stream(session_id: int) -> str:
+    # Every message of a session goes through the same shard, which keeps them in order
+    return f"messages:wb:{session_id % Config.WRITE_BEHIND_SHARDS}"
+
+
+def _redis() -> aioredis.Redis:
+    return aioredis.from_url(
+        f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}",
+        max_connections=Config.REDIS_MAX_CONNECTIONS,
+    )
+
+
+# The class `MessageWriteBehind` is the producer side: it durably enqueues a message to its Redis
+# Stream shard and hands back the message id, without touching Postgres.
+class MessageWriteBehind:
+    def __init__(self):
+        self.redis = _redis()
+        self._enqueue = self.redis.register_script(ENQUEUE_SCRIPT)
+
+    async def enqueue(self, session_id: int, sender_id: int, mssg_encrypt: str) -> int:
+        """
+        Append a message to the write-behind stream of its session.
+
+        :return: the message id, allocated from the Redis sequence
+        """
+        mid = await self._enqueue(
+            keys=[MID_SEQUENCE, shard_stream(session_id)],
+            args=[session_id, sender_id, mssg_encrypt],
+        )
+        return int(mid)
+
+
+# The class `WriteBehindWorker` drains the shard streams through a consumer group and inserts the
+# messages in multi-row batches, then hands the inserted rows to the `post_process` stage. Entries are
+# only acknowledged after both, so a failed or interrupted batch is retried, and the insert ignores ids
+# that were already written.
+class WriteBehindWorker:
+    def __init__(
+        self,
+        shards: Optional[List[int]] = None,
+        consumer: str = Config.WRITE_BEHIND_CONSUMER,
+        post_process: Optional[Callable[[List[dict]], Awaitable[None]]] = None,
+    ):
+        shards = range(Config.WRITE_BEHIND_SHARDS) if shards is None else shards
+        self.streams = [f"messages:wb:{shard}" for shard in shards]
+        self.consumer = consumer
+        self.post_process = post_process
+        self.redis = _redis()
+
+        self.batches = 0
+        self.rows = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        self.last_batch_size = 0
+        self.lag_seconds = 0.0
+        self.backlog = 0
+
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await self._prepare()
+        self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _prepare(self) -> None:
+        for stream in self.streams:
+            try:
+                await self.redis.xgroup_create(stream, GROUP, id="0", mkstream=True)
+            except aioredis.ResponseError as exc:
+                if "BUSYGROUP" not in str(exc):
+                    raise
+
+        async with DB_MANAGER.session() as session:
+            max_mid = (await session.execute(select(func.max(MessageModel.mid)))).scalar()
+        await self.redis.eval(SEQUENCE_FLOOR_SCRIPT, 1, MID_SEQUENCE, max_mid or 0)
+
+    async def _read(self, start_id: str, count: int, block: Optional[int]) -> List[tuple]:
+        response = await self.redis.xreadgroup(
+            GROUP, self.consumer, {stream: start_id for stream in self.streams},
+            count=count, block=block,
+        )
+        batch, deleted = [], []
+        for stream, entries in response or []:
+            stream = stream.decode() if isinstance(stream, bytes) else stream
+            for entry_id, fields in entries:
+                (batch if fields else deleted).append((stream, entry_id, fields))
+        if deleted:
+            # Entries deleted while pending come back empty, settle them or they are read back forever
+            await self._ack(deleted)
+        return batch
+
+    async def _next_batch(self, idle: Optional[float] = None) -> List[tuple]:
+        """
+        :param idle: give up with an empty batch when nothing arrived for that many seconds, wait
+        forever when None
+        """
+        # Entries delivered to this consumer but never acknowledged come first, on every call: a batch
+        # that failed, possibly in another process running the same consumer, or what the last read
+        # cut off. Nothing newer is read before they are done, which keeps every session in order.
+        if batch := await self._read("0", Config.WRITE_BEHIND_BATCH_SIZE, None):
+            return batch[:Config.WRITE_BEHIND_BATCH_SIZE]
+
+        batch: List[tuple] = []
+        deadline = None
+        idle_deadline = None if idle is None else time.monotonic() + idle
+        while len(batch) < Config.WRITE_BEHIND_BATCH_SIZE:
+            if deadline is not None:
+                timeout = deadline - time.monotonic()
+            elif idle_deadline is not None:
+                timeout = idle_deadline - time.monotonic()
+            else:
+                timeout = Config.WRITE_BEHIND_FLUSH_INTERVAL
+            if timeout <= 0:
+                break
+            remaining = Config.WRITE_BEHIND_BATCH_SIZE - len(batch)
+            entries = await self._read(">", remaining, max(1, int(timeout * 1000)))
+            if not entries:
+                if batch:
+                    break
+                continue
+            if len(entries) > remaining:
+                # COUNT applies to every stream of the read. What is over the budget is newer than the
+                # batch in its own stream, it stays pending and the next batch reads it back first.
+                entries = entries[:remaining]
+            batch.extend(entries)
+            if deadline is None:
+                deadline = time.monotonic() + Config.WRITE_BEHIND_FLUSH_INTERVAL
+        return batch
+
+    @staticmethod
+    def _row(entry_id: bytes, fields: Dict[bytes, bytes]) -> dict:
+        millis = int(entry_id.split(b"-")[0])
+        return {
+            "mid": int(fields[b"mid"]),
+            "session_id": int(fields[b"sid"]),
+            "sender_id": int(fields[b"sender"]),
+            "mssg_encrypt": fields[b"msg"].decode(),
+            "created_at": datetime.fromtimestamp(millis / 1000, tz=timezone.utc).replace(tzinfo=None),
+        }
+
+    async def _insert(self, rows: List[dict]) -> None:
+        # One transaction, in as many statements as the bind parameter limit requires
+        async with DB_MANAGER.session() as session:
+            for chunk in chunked(rows, len(rows[0])):
+                await session.execute(insert(MessageModel).values(chunk).on_conflict_do_nothing(
+                    index_elements=[MessageModel.mid, MessageModel.created_at]))
+            await session.commit()
+
+    async def _insert_apart(self, batch: List[tuple], rows: List[dict]) -> List[dict]:
+        """
+        Insert the rows of a batch one by one, after the batch insert failed on a constraint. Rows that
+        keep failing are moved to the dead letter stream once every one of them failed
+        WRITE_BEHIND_MAX_ATTEMPTS times, so that one bad message cannot hold its shard back for good.
+        Attempts are counted in Redis, whichever process retries the batch.
+
+        :return: the rows inserted, or already there
+        :raises IntegrityError: when a row still has attempts left, the whole batch is retried and the
+        rows inserted here are skipped by the next insert
+        """
+        inserted, failed = [], []
+        for entry, row in zip(batch, rows):
+            try:
+                await self._insert([row])
+                inserted.append(row)
+            except IntegrityError as exc:
+                failed.append((entry, exc))
+        if not failed:
+            return inserted
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for (stream, entry_id, _), _ in failed:
+                key = f"{stream}:attempts:{entry_id.decode()}"
+                pipe.incr(key)
+                pipe.expire(key, 24 * 60 * 60)
+            attempts = (await pipe.execute())[::2]
+        if min(attempts) < Config.WRITE_BEHIND_MAX_ATTEMPTS:
+            raise failed[0][1]
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for (stream, entry_id, fields), exc in failed:
+                pipe.xadd(DEAD_LETTER_STREAM, {
+                    **fields, "stream": stream, "entry_id": entry_id, "error": str(exc.orig)[:512]})
+                pipe.delete(f"{stream}:attempts:{entry_id.decode()}")
+            await pipe.execute()
+        self.dead_lettered += len(failed)
+        logger.error("moved %d messages rejected %d times to %s: %s", len(failed),
+                     Config.WRITE_BEHIND_MAX_ATTEMPTS, DEAD_LETTER_STREAM, failed[0][1].orig)
+        return inserted
+
+    async def flush(self, batch: List[tuple]) -> None:
+        rows = [self._row(entry_id, fields) for _, entry_id, fields in batch]
+        started = time.perf_counter()
+        try:
+            await self._insert(rows)
+        except IntegrityError as exc:
+            if getattr(exc.orig, "sqlstate", None) == CHECK_VIOLATION:
+                raise
+            # One bad row, such as a deleted sender or session, fails the whole statement
+            logger.warning("write-behind batch of %d messages rejected, inserting them one by one: %s",
+                           len(rows), exc.orig)
+            rows = await self._insert_apart(batch, rows)
+        inserted = time.perf_counter()
+        DB_INSERT.observe(inserted - started)
+        if self.post_process is not None and rows:
+            await self.post_process(rows)
+            POST_PROCESS.observe(time.perf_counter() - inserted)
+        await self._ack(batch)
+
+        oldest = min(int(entry_id.split(b"-")[0]) for _, entry_id, _ in batch)
+        self.lag_seconds = time.time() - oldest / 1000
+        self.batches += 1
+        self.rows += len(rows)
+        self.last_batch_size = len(rows)
+
+    async def _ack(self, batch: List[tuple]) -> None:
+        by_stream: Dict[str, list] = {}
+        for stream, entry_id, _ in batch:
+            by_stream.setdefault(stream, []).append(entry_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for stream, ids in by_stream.items():
+                pipe.xack(stream, GROUP, *ids)
+                pipe.xdel(stream, *ids)
+            for stream in self.streams:
+                pipe.xlen(stream)
+            results = await pipe.execute()
+        self.backlog = sum(results[2 * len(by_stream):])
+
+    async def process_once(self, idle: float) -> int:
+        """
+        Read and flush at most one batch, waiting no longer than the flush interval for it to fill once
+        the first message arrived.
+
+        A failed batch stays pending in the consumer group and is read again by the next call, in
+        whichever process makes it.
+
+        :param idle: how long to wait for the first message before returning empty handed
+        :return: the number of messages processed
+        """
+        batch = await self._next_batch(idle)
+        if batch:
+            try:
+                await self.flush(batch)
+            except Exception:
+                self.failures += 1
+                raise
+        return len(batch)
+
+    async def run(self) -> None:
+        delay = 0.1
+        while True:
+            try:
+                batch = await self._next_batch()
+            except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+                logger.warning("write-behind stream read failed, retrying in %.1fs", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, Config.WRITE_BEHIND_MAX_RETRY_DELAY)
+                continue
+            if not batch:
+                continue
+            while True:
+                try:
+                    await self.flush(batch)
+                    delay = 0.1
+                    break
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    # Keep the batch and retry it, nothing is acknowledged until it is committed
+                    self.failures += 1
+                    logger.exception("write-behind flush of %d messages failed, retrying in %.1fs",
+                                     len(batch), delay)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, Config.WRITE_BEHIND_MAX_RETRY_DELAY)
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "rows": self.rows,
+            "failures": self.failures,
+            "dead_lettered": self.dead_lettered,
+            "last_batch_size": self.last_batch_size,
+            "avg_batch_size": self.rows / self.batches if self.batches else 0.0,
+            "lag_seconds": self.lag_seconds,
+            "backlog": self.backlog,
+        }
+
+
+async def _push_metrics(redis: aioredis.Redis) -> None:
+    # Nobody scrapes the standalone worker either, its histograms go to Redis like the Celery workers'
+    while True:
+        await asyncio.sleep(Config.METRICS_PUSH_INTERVAL)
+        try:
+            await REGISTRY.push(redis)
+        except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+            logger.warning("worker metrics push failed, retrying in %.1fs", Config.METRICS_PUSH_INTERVAL)
+
+
+async def _main() -> None:
+    from app.tasks import post_process
+
+    DB_MANAGER.init(Config.DB_CONFIG, Config.DB_REPLICA_CONFIG)
+    worker = WriteBehindWorker(post_process=post_process)
+    await worker._prepare()
+    pusher = asyncio.create_task(_push_metrics(worker.redis))
+    try:
+        await worker.run()
+    finally:
+        pusher.cancel()
+        await DB_MANAGER.close()
+
+
+if __name__ == "__main__":
+    # Standalone worker: python -m app.services.persistence
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_main())
@@ -0,0 +1,302 @@
+# presence and typing indicators
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+import aioredis
+import orjson
+
+from app.config import Config
+from app.services.cm import queue_publish
+
+logger = logging.getLogger(__name__)
+
+ONLINE = "online"
+AWAY = "away"
+TYPING = "typing"
+OFFLINE = "offline"
+# States a client may set, offline only follows a disconnect or a missed heartbeat
+CLIENT_STATES = {ONLINE, AWAY, TYPING}
+# Seconds over which PRESENCE_RATE_LIMIT updates per user are allowed
+RATE_WINDOW = 1.0
+
+# Presence updates are sent on the session socket as {"presence": "<state>"}
+PRESENCE_PREFIX = '{"presence"'
+
+# Remove the members whose last heartbeat is older than ARGV[1], and return them. Their connection
+# counts go too, the processes that held them are gone.
+EXPIRE_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if #expired > 0 then
+    redis.call('ZREM', KEYS[1], unpack(expired))
+    redis.call('HDEL', KEYS[2], unpack(expired))
+    redis.call('HDEL', KEYS[3], unpack(expired))
+end
+return expired
+"""
+
+# Add ARGV[2] to the number of processes holding sockets of user ARGV[1] in the session and record
+# the state ARGV[3]. The user only goes offline when no process holds a socket anymore, the state to
+# publish is returned, nothing when another process keeps the user online.
+JOIN_SCRIPT = """
+local count = redis.call('HINCRBY', KEYS[3], ARGV[1], ARGV[2])
+if count <= 0 then
+    redis.call('HDEL', KEYS[3], ARGV[1])
+    redis.call('HDEL', KEYS[1], ARGV[1])
+    redis.call('ZREM', KEYS[2], ARGV[1])
+    return 'offline'
+end
+if ARGV[3] == 'offline' then
+    return false
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+redis.call('ZADD', KEYS[2], ARGV[4], ARGV[1])
+return ARGV[3]
+"""
+
+
+def state_key(session_id: int) -> str:
+    return f"presence:{session_id}"
+
+
+def seen_key(session_id: int) -> str:
+    return f"presence:{session_id}:seen"
+
+
+def connections_key(session_id: int) -> str:
+    # Number of processes holding sockets of each user, shared by all workers and nodes
+    return f"presence:{session_id}:connections"
+
+
+def parse_update(message: str) -> Optional[str]:
+    """
+    Recognize a presence update among the messages of a session socket.
+
+    :return: the requested state, None when the message is not a valid presence update
+    """
+    if not message.startswith(PRESENCE_PREFIX):
+        return None
+    try:
+        state = orjson.loads(message).get("presence")
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
+    return state if state in CLIENT_STATES else None
+
+
+# The class `PresenceService` tracks who is online, away or typing in every session that has local
+# sockets. Changes are only recorded in memory when they happen, and on every tick the whole batch is
+# written to Redis and published as one diff per session. The members of a session live in a hash of
+# states and a sorted set of last heartbeats, the users that stop beating are swept out as offline. A
+# user may have sockets in several processes, each process counts itself in a shared hash when it gets
+# the first socket of the user and out when it loses the last one, and the user goes offline at zero.
+class PresenceService:
+    def __init__(self):
+        self.redis = aioredis.from_url(
+            f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}",
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+        )
+        self._expire = self.redis.register_script(EXPIRE_SCRIPT)
+        self._join = self.redis.register_script(JOIN_SCRIPT)
+
+        # Local sockets per session and user, a user may have several tabs open
+        self.local: Dict[int, Dict[int, int]] = {}
+        # Latest state per session and user since the last tick, older updates are overwritten
+        self._changes: Dict[int, Dict[int, str]] = {}
+        # Change of the shared connection count per session and user since the last tick
+        self._joins: Dict[Tuple[int, int], int] = {}
+        self._typing_until: Dict[Tuple[int, int], float] = {}
+        self._rates: Dict[int, Tuple[float, int]] = {}
+        self._last_heartbeat = 0.0
+
+        self.updates = 0
+        self.rate_limited = 0
+        self.diffs = 0
+        self.expired = 0
+
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _set(self, session_id: int, user_id: int, state: str) -> None:
+        self._changes.setdefault(session_id, {})[user_id] = state
+
+    def _joined(self, session_id: int, user_id: int, delta: int) -> None:
+        key = (session_id, user_id)
+        self._joins[key] = self._joins.get(key, 0) + delta
+
+    def connect(self, session_id: int, user_id: int) -> None:
+        users = self.local.setdefault(session_id, {})
+        users[user_id] = users.get(user_id, 0) + 1
+        if users[user_id] == 1:
+            self._joined(session_id, user_id, 1)
+            self._set(session_id, user_id, ONLINE)
+
+    def disconnect(self, session_id: int, user_id: int) -> None:
+        users = self.local.get(session_id)
+        if not users or user_id not in users:
+            return
+        users[user_id] -= 1
+        if users[user_id] > 0:
+            return
+        del users[user_id]
+        if not users:
+            del self.local[session_id]
+        self._typing_until.pop((session_id, user_id), None)
+        self._joined(session_id, user_id, -1)
+        self._set(session_id, user_id, OFFLINE)
+
+    def _allow(self, user_id: int) -> bool:
+        now = time.monotonic()
+        started, count = self._rates.get(user_id, (now, 0))
+        if now - started >= RATE_WINDOW:
+            started, count = now, 0
+        if count >= Config.PRESENCE_RATE_LIMIT:
+            return False
+        self._rates[user_id] = (started, count + 1)
+        return True
+
+    def update(self, session_id: int, user_id: int, state: str) -> bool:
+        """
+        Record a state change requested by a connected user, it is published on the next tick.
+
+        :return: False when the update was dropped by the per user rate limit
+        """
+        if user_id not in self.local.get(session_id, {}):
+            return False
+        if not self._allow(user_id):
+            self.rate_limited += 1
+            return False
+        self.updates += 1
+        if state == TYPING:
+            # Typing wears off by itself, clients only repeat it while the user keeps typing
+            self._typing_until[(session_id, user_id)] = time.monotonic() + Config.PRESENCE_TYPING_TTL
+        else:
+            self._typing_until.pop((session_id, user_id), None)
+        self._set(session_id, user_id, state)
+        return True
+
+    async def get(self, session_id: int) -> Dict[int, str]:
+        states = await self.redis.hgetall(state_key(session_id))
+        return {int(user_id): state.decode() for user_id, state in states.items()}
+
+    async def _write(self, changes: Dict[int, Dict[int, str]], joins: Dict[Tuple[int, int], int],
+                     wall: float, heartbeat: bool) -> Dict[int, Dict[int, str]]:
+        """
+        Write the changes of a tick, and return the diff to publish.
+
+        Users that joined or left this process go through JOIN_SCRIPT, which keeps them online while
+        another process holds their sockets, the other changes are plain writes.
+        """
+        shared = [(session_id, user_id, state)
+                  for session_id, diff in changes.items() for user_id, state in diff.items()
+                  if state == OFFLINE or joins.get((session_id, user_id))]
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for session_id, user_id, state in shared:
+                await self._join(
+                    keys=[state_key(session_id), seen_key(session_id), connections_key(session_id)],
+                    args=[user_id, joins.get((session_id, user_id), 0), state, wall], client=pipe)
+            for session_id, diff in changes.items():
+                present = {user_id: state for user_id, state in diff.items()
+                           if state != OFFLINE and not joins.get((session_id, user_id))}
+                if present:
+                    pipe.hset(state_key(session_id), mapping=present)
+                    pipe.zadd(seen_key(session_id), {user_id: wall for user_id in present})
+            if heartbeat:
+                for session_id, users in self.local.items():
+                    pipe.zadd(seen_key(session_id), {user_id: wall for user_id in users})
+                    for key in (state_key(session_id), seen_key(session_id), connections_key(session_id)):
+                        pipe.expire(key, int(Config.PRESENCE_TTL * 2))
+            results = await pipe.execute()
+
+        published = {session_id: dict(diff) for session_id, diff in changes.items()}
+        for (session_id, user_id, _), state in zip(shared, results):
+            if state is None:
+                # Still connected through another process
+                del published[session_id][user_id]
+            else:
+                published[session_id][user_id] = state.decode() if isinstance(state, bytes) else state
+        return {session_id: diff for session_id, diff in published.items() if diff}
+
+    async def tick(self) -> None:
+        now = time.monotonic()
+        for key, until in list(self._typing_until.items()):
+            if until <= now:
+                del self._typing_until[key]
+                self._set(*key, ONLINE)
+        # Windows that are over allow a full burst anyway, keep only the users that updated lately
+        for user_id, (started, _) in list(self._rates.items()):
+            if now - started >= RATE_WINDOW:
+                del self._rates[user_id]
+
+        changes, self._changes = self._changes, {}
+        joins, self._joins = self._joins, {}
+        wall = time.time()
+        heartbeat = wall - self._last_heartbeat >= Config.PRESENCE_TTL / 3
+        if not changes and not heartbeat:
+            return
+
+        try:
+            changes = await self._write(changes, joins, wall, heartbeat)
+        except Exception:
+            # Put the batch back, updates recorded meanwhile are newer and win
+            for session_id, diff in changes.items():
+                self._changes[session_id] = {**diff, **self._changes.get(session_id, {})}
+            for key, delta in joins.items():
+                self._joined(*key, delta)
+            raise
+
+        if heartbeat:
+            self._last_heartbeat = wall
+            # Sweep the users of other nodes that stopped beating, atomically so only one node reports them
+            sessions = list(self.local)
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for session_id in sessions:
+                    await self._expire(keys=[seen_key(session_id), state_key(session_id),
+                                             connections_key(session_id)],
+                                       args=[wall - Config.PRESENCE_TTL], client=pipe)
+                results = await pipe.execute()
+            for session_id, expired in zip(sessions, results):
+                for user_id in expired:
+                    changes.setdefault(session_id, {})[int(user_id)] = OFFLINE
+                    self.expired += 1
+
+        if changes:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for session_id, diff in changes.items():
+                    queue_publish(pipe, session_id, orjson.dumps(
+                        {"presence": {str(user_id): state for user_id, state in diff.items()}}),
+                        durable=False)
+                await pipe.execute()
+            self.diffs += len(changes)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(Config.PRESENCE_TICK)
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("presence tick failed")
+
+    def stats(self) -> dict:
+        return {
+            "sessions": len(self.local),
+            "users": sum(len(users) for users in self.local.values()),
+            "updates": self.updates,
+            "rate_limited": self.rate_limited,
+            "diffs": self.diffs,
+            "expired": self.expired,
+        }
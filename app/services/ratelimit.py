@@ -0,0 +1,176 @@
+# token bucket rate limiting at the edge
+
+import logging
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import aioredis
+
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+# Close code of a socket shed for going over its rate, the reason names the limit
+CLOSE_RATE_LIMITED = 4029
+
+# Refill the bucket from the Redis clock, then grant up to ARGV[3] tokens when at least ARGV[4] are
+# there. Returns the tokens granted and, when none were, the milliseconds until enough are back.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+local minimum = tonumber(ARGV[4])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + math.floor(tonumber(clock[2]) / 1000)
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate / 1000)
+local granted = 0
+local retry = 0
+if tokens >= minimum then
+    granted = math.min(requested, math.floor(tokens))
+    tokens = tokens - granted
+else
+    retry = math.ceil((minimum - tokens) * 1000 / rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst * 1000 / rate) + 1000)
+return {granted, retry}
+"""
+
+
+class Limit(NamedTuple):
+    # Tokens per second, and how many can be spent at once
+    rate: float
+    burst: int
+
+
+USER_LIMIT = Limit(Config.RATE_LIMIT_USER_RATE, Config.RATE_LIMIT_USER_BURST)
+SESSION_LIMIT = Limit(Config.RATE_LIMIT_SESSION_RATE, Config.RATE_LIMIT_SESSION_BURST)
+CONNECTION_LIMIT = Limit(Config.RATE_LIMIT_CONNECTION_RATE, Config.RATE_LIMIT_CONNECTION_BURST)
+
+
+# The class `TokenBucket` is a process local bucket, for the limits of a single connection which
+# never leaves its process.
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, limit: Limit = CONNECTION_LIMIT):
+        self.rate = limit.rate
+        self.burst = limit.burst
+        self.tokens = float(limit.burst)
+        self.updated = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """
+        :return: 0 when the tokens were taken, otherwise how many seconds until they are available
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) / self.rate
+
+
+# The class `RateLimiter` enforces the limits shared by every process, per user and per session, with
+# token buckets living in Redis. A process leases a few tokens at a time and spends them locally, so
+# most checks never leave the process, and it remembers a refusal until the bucket refills, so a
+# client hammering a closed door does not cost Redis calls either. Leased tokens left unused when
+# their lease expires are lost, which errs on the strict side.
+class RateLimiter:
+    def __init__(self):
+        self.redis = aioredis.from_url(
+            f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}",
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+        )
+        self._bucket = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+        self._leases: Dict[str, Tuple[int, float]] = {}
+        self._denied: Dict[str, float] = {}
+        self._pruned = time.monotonic()
+
+        self.allowed = 0
+        self.limited = 0
+        self.redis_calls = 0
+        self.errors = 0
+
+    def _prune(self, now: float) -> None:
+        if now - self._pruned < 1:
+            return
+        self._pruned = now
+        self._leases = {key: lease for key, lease in self._leases.items() if lease[1] > now}
+        self._denied = {key: until for key, until in self._denied.items() if until > now}
+
+    async def acquire(self, key: str, limit: Limit) -> float:
+        """
+        Take one token from the shared bucket `key`.
+
+        When Redis cannot be reached the token is granted, the per connection limits still apply.
+
+        :return: 0 when the token was taken, otherwise how many seconds until the bucket has one again
+        """
+        now = time.monotonic()
+        self._prune(now)
+        until = self._denied.get(key)
+        if until is not None and until > now:
+            return until - now
+
+        tokens, expires = self._leases.get(key, (0, 0.0))
+        if tokens > 0 and expires > now:
+            self._leases[key] = (tokens - 1, expires)
+            return 0.0
+
+        lease = max(1, min(Config.RATE_LIMIT_LEASE, limit.burst))
+        self.redis_calls += 1
+        try:
+            granted, retry = await self._bucket(
+                keys=[f"ratelimit:{key}"], args=[limit.rate, limit.burst, lease, 1])
+        except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+            self.errors += 1
+            logger.warning("rate limiter unavailable, letting %s through", key)
+            return 0.0
+
+        if granted == 0:
+            self._denied[key] = now + retry / 1000
+            return retry / 1000
+        self._leases[key] = (granted - 1, now + Config.RATE_LIMIT_LEASE_TTL)
+        return 0.0
+
+    async def check_message(self, user_id: Optional[int], session_id: int) -> Optional[Tuple[str, float]]:
+        """
+        The function `check_message` admits one message of `user_id` to `session_id` against the per
+        user and per session limits. It is meant to run before any crypto or database work.
+
+        :param user_id: the sender, None for an anonymous socket which only counts against its session
+        :return: None when the message is admitted, otherwise the limit hit, "user" or "session", and
+        the seconds to wait before retrying
+        """
+        if not Config.RATE_LIMIT_ENABLED:
+            return None
+        checks = [("session", f"session:{session_id}", SESSION_LIMIT)]
+        if user_id is not None:
+            checks.insert(0, ("user", f"user:{user_id}", USER_LIMIT))
+        for scope, key, limit in checks:
+            retry_after = await self.acquire(key, limit)
+            if retry_after > 0:
+                self.limited += 1
+                return scope, retry_after
+        self.allowed += 1
+        return None
+
+    def connection_bucket(self) -> Optional[TokenBucket]:
+        """The bucket of a new connection, None when rate limiting is disabled."""
+        return TokenBucket(CONNECTION_LIMIT) if Config.RATE_LIMIT_ENABLED else None
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "limited": self.limited,
+            "redis_calls": self.redis_calls,
+            "errors": self.errors,
+            "leases": len(self._leases),
+            "denied": len(self._denied),
+        }
@@ -0,0 +1,255 @@
+# unread counters and read cursors
+
+import asyncio
+import logging
+from typing import Dict, Optional, Tuple
+
+import aioredis
+import orjson
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert
+
+from app.config import Config
+from app.models import ReadCursorModel
+from app.models.schemas import SessionReadState, UnreadCounts
+from app.services.db import DB_MANAGER, chunked
+
+logger = logging.getLogger(__name__)
+
+# "<user_id>:<session_id>" of the cursors that moved since they were last copied to Postgres
+DIRTY_KEY = "read:dirty"
+
+# Read-acks are sent on the session socket as {"read": <mid>}
+READ_PREFIX = '{"read"'
+
+# Move the cursor forward only, and take the messages up to the acked one off the unread set of the
+# session. Messages counted after the acked one stay unread. A late ack, older than the cursor, changes
+# nothing.
+ACK_SCRIPT = """
+local current = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local mid = tonumber(ARGV[2])
+if mid < current then
+    return 0
+end
+if mid > current then
+    redis.call('HSET', KEYS[1], ARGV[1], mid)
+    redis.call('SADD', KEYS[3], ARGV[3])
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', mid)
+local unread = redis.call('ZCARD', KEYS[4])
+if unread > 0 then
+    redis.call('HSET', KEYS[2], ARGV[1], unread)
+else
+    redis.call('HDEL', KEYS[2], ARGV[1])
+end
+return 1
+"""
+
+# Add the messages of a batch newer than the user's cursor to the unread set of the session, keep the
+# newest ARGV[2] of them, and store the count in the user's counters hash
+COUNT_SCRIPT = """
+local cursor = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or '0')
+for i = 3, #ARGV do
+    local mid = tonumber(ARGV[i])
+    if mid > cursor then
+        redis.call('ZADD', KEYS[2], mid, mid)
+    end
+end
+redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[2]) - 1)
+local unread = redis.call('ZCARD', KEYS[2])
+if unread > 0 then
+    redis.call('HSET', KEYS[1], ARGV[1], unread)
+end
+return unread
+"""
+
+
+def unread_key(user_id: int) -> str:
+    return f"unread:{user_id}"
+
+
+def unread_set_key(user_id: int, session_id: int) -> str:
+    # The ids of the unread messages of a session, the counter in `unread_key` is its size
+    return f"unread:{user_id}:{session_id}"
+
+
+def cursor_key(user_id: int) -> str:
+    return f"read:{user_id}"
+
+
+def parse_ack(message: str) -> Optional[int]:
+    """
+    Recognize a read-ack among the messages of a session socket.
+
+    :return: the id of the last message read, None when the message is not a valid read-ack
+    """
+    if not message.startswith(READ_PREFIX):
+        return None
+    try:
+        mid = orjson.loads(message).get("read")
+    except (orjson.JSONDecodeError, AttributeError):
+        return None
+    if isinstance(mid, bool) or not isinstance(mid, int) or mid <= 0:
+        return None
+    return mid
+
+
+# The class `ReadStateService` keeps, per user, a Redis hash of unread counters and a hash of read
+# cursors, both keyed by session id. `post_process` adds the messages it fans out to a capped set of
+# unread ids per user and session, with COUNT_SCRIPT, and the counter is the size of that set. A
+# read-ack moves the cursor and only takes the messages it covers off the set. Acks are aggregated in
+# memory and applied on every tick, only the latest one per user and session matters.
+class ReadStateService:
+    def __init__(self):
+        self.redis = aioredis.from_url(
+            f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}",
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+        )
+        self._ack = self.redis.register_script(ACK_SCRIPT)
+
+        self._acks: Dict[Tuple[int, int], int] = {}
+        self.acks = 0
+        self.applied = 0
+        self.flushed = 0
+
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            # Do not lose the acks of the last tick on a clean shutdown
+            await self.tick()
+        except Exception:
+            logger.warning("read-acks of the last tick were not applied", exc_info=True)
+
+    def ack(self, session_id: int, user_id: int, mid: int) -> None:
+        """Record that a user read a session up to message `mid`, applied on the next tick."""
+        key = (user_id, session_id)
+        if mid > self._acks.get(key, 0):
+            self._acks[key] = mid
+        self.acks += 1
+
+    async def tick(self) -> None:
+        acks, self._acks = self._acks, {}
+        if not acks:
+            return
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for (user_id, session_id), mid in acks.items():
+                    await self._ack(
+                        keys=[cursor_key(user_id), unread_key(user_id), DIRTY_KEY,
+                              unread_set_key(user_id, session_id)],
+                        args=[session_id, mid, f"{user_id}:{session_id}"], client=pipe)
+                await pipe.execute()
+        except Exception:
+            # Put the batch back, acks recorded meanwhile win when they are further
+            for key, mid in acks.items():
+                self._acks[key] = max(mid, self._acks.get(key, 0))
+            raise
+        self.applied += len(acks)
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(Config.READ_STATE_TICK)
+            try:
+                await self.tick()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("read state tick failed")
+
+    async def _load_cursors(self, user_id: int) -> Dict[int, int]:
+        # Redis lost the cursors of the user, e.g. after a restart without persistence: warm them up from
+        # their durable copy, without overwriting an ack applied meanwhile
+        async with DB_MANAGER.session(readonly=True) as db:
+            rows = (await db.execute(
+                select(ReadCursorModel.session_id, ReadCursorModel.last_read_mid)
+                .where(ReadCursorModel.user_id == user_id)
+            )).all()
+        if rows:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for session_id, mid in rows:
+                    pipe.hsetnx(cursor_key(user_id), session_id, mid)
+                await pipe.execute()
+        return {session_id: mid for session_id, mid in rows}
+
+    async def unread(self, user_id: int) -> UnreadCounts:
+        """
+        The counters and cursors of every session of a user, in one Redis round trip. Postgres is only
+        read when Redis has no cursor at all for the user.
+        """
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(unread_key(user_id))
+            pipe.hgetall(cursor_key(user_id))
+            counters, cursors = await pipe.execute()
+
+        counters = {int(session_id): int(count) for session_id, count in counters.items()}
+        cursors = {int(session_id): int(mid) for session_id, mid in cursors.items()}
+        if not cursors:
+            cursors = await self._load_cursors(user_id)
+
+        return UnreadCounts(user_id=user_id, sessions=[
+            SessionReadState(session_id=session_id, unread=max(counters.get(session_id, 0), 0),
+                             last_read_mid=cursors.get(session_id))
+            for session_id in sorted(counters.keys() | cursors.keys())
+        ])
+
+    async def flush(self, batch: int = Config.READ_CURSOR_FLUSH_BATCH) -> int:
+        """
+        The function `flush` copies up to `batch` cursors that moved to the `read_cursors` table, with
+        one multi-row upsert that never moves a cursor backwards.
+
+        :return: the number of cursors written
+        """
+        members = await self.redis.spop(DIRTY_KEY, batch)
+        if not members:
+            return 0
+        try:
+            keys = [tuple(int(part) for part in member.split(b":")) for member in members]
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for user_id, session_id in keys:
+                    pipe.hget(cursor_key(user_id), session_id)
+                mids = await pipe.execute()
+
+            rows = [
+                {"user_id": user_id, "session_id": session_id, "last_read_mid": int(mid)}
+                for (user_id, session_id), mid in zip(keys, mids)
+                if mid is not None
+            ]
+            if rows:
+                async with DB_MANAGER.session() as db:
+                    for chunk in chunked(rows, 3):
+                        statement = insert(ReadCursorModel).values(chunk)
+                        statement = statement.on_conflict_do_update(
+                            index_elements=[ReadCursorModel.user_id, ReadCursorModel.session_id],
+                            set_={
+                                "last_read_mid": func.greatest(
+                                    ReadCursorModel.last_read_mid, statement.excluded.last_read_mid),
+                                "update_time": func.now(),
+                            },
+                        )
+                        await db.execute(statement)
+                    await db.commit()
+        except Exception:
+            # Mark them dirty again, the next run retries
+            await self.redis.sadd(DIRTY_KEY, *members)
+            raise
+        self.flushed += len(rows)
+        return len(rows)
+
+    def stats(self) -> dict:
+        return {
+            "pending_acks": len(self._acks),
+            "acks": self.acks,
+            "applied": self.applied,
+            "flushed": self.flushed,
+        }
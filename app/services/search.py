@@ -0,0 +1,133 @@
+# session search over a blind index of the messages
+
+import hashlib
+import hmac
+import re
+from datetime import datetime
+from typing import List, Optional, Sequence
+
+from sqlalchemy import Text, and_, cast, func, select
+from sqlalchemy.dialects.postgresql import ARRAY, TSQUERY, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import Select
+
+from app.config import Config
+from app.models import MessageModel, MessageSearchModel
+from app.models.schemas import MessagePage, StoredMessage
+from app.services.db import chunked
+from app.services.encryption import decrypt_many, encryption_key
+
+WORD = re.compile(r"\w+")
+
+_search_key = Config.SEARCH_KEY or encryption_key
+if isinstance(_search_key, str):
+    _search_key = _search_key.encode()
+
+
+def words(text: str) -> List[str]:
+    """
+    :return: the distinct case folded words of a text, in order of appearance
+    """
+    return list(dict.fromkeys(WORD.findall(text.casefold())))
+
+
+def lexeme(word: str) -> str:
+    # 64 bits of HMAC, collisions inside one session are negligible. The letter keeps every lexeme a
+    # plain word to the tsquery parser.
+    return "h" + hmac.new(_search_key, word.encode(), hashlib.sha256).hexdigest()[:16]
+
+
+def lexemes(text: str) -> List[str]:
+    return [lexeme(word) for word in words(text)]
+
+
+async def index_messages(db: AsyncSession, messages: Sequence[dict]) -> int:
+    """
+    The function `index_messages` adds a batch of decrypted messages to the search index, in one
+    multi-row insert. Postgres only ever sees keyed hashes of the words, so the index holds no
+    plaintext, at the price of exact word matches only: no stemming, no prefixes.
+
+    Messages already indexed are skipped, which makes a retried batch harmless.
+
+    :param messages: dicts with the `mid`, `session_id`, `created_at` and plaintext `text` of the messages
+    :return: the number of messages with at least one word, the others are not indexed
+    """
+    values = [
+        {
+            "mid": message["mid"],
+            "session_id": message["session_id"],
+            "created_at": message["created_at"],
+            "document": func.array_to_tsvector(cast(terms, ARRAY(Text))),
+        }
+        for message in messages
+        if (terms := lexemes(message["text"]))
+    ]
+    for chunk in chunked(values, 4):
+        await db.execute(insert(MessageSearchModel).values(chunk).on_conflict_do_nothing(
+            index_elements=[MessageSearchModel.mid, MessageSearchModel.created_at]))
+    return len(values)
+
+
+def match_query(session_id: int, terms: Sequence[str], before: Optional[int], limit: int) -> Select:
+    """
+    Ids and creation times of the messages of a session holding every lexeme of `terms`, newest first.
+
+    :param terms: lexemes, as returned by `lexemes`
+    :param before: only match messages older than this message id, None for the newest page
+    """
+    query_terms = cast(" & ".join(f"'{term}'" for term in terms), TSQUERY)
+    query = (
+        select(MessageSearchModel.mid, MessageSearchModel.created_at)
+        .where(MessageSearchModel.session_id == session_id,
+               MessageSearchModel.document.op("@@")(query_terms))
+        .order_by(MessageSearchModel.created_at.desc(), MessageSearchModel.mid.desc())
+        .limit(limit)
+    )
+    if before is not None:
+        # Same cursor as the history pages, its creation time prunes the newer partitions
+        cursor_created_at = (
+            select(MessageSearchModel.created_at)
+            .where(MessageSearchModel.session_id == session_id, MessageSearchModel.mid == before)
+            .scalar_subquery()
+        )
+        query = query.where(
+            MessageSearchModel.mid < before,
+            MessageSearchModel.created_at <= func.coalesce(cursor_created_at, datetime.max),
+        )
+    return query
+
+
+async def search_session(session_id: int, text: str, before: Optional[int], limit: int,
+                         db: AsyncSession) -> MessagePage:
+    """
+    The function `search_session` returns one page of the messages of a session containing every word
+    of `text`, newest first, paginated like the session history.
+
+    :param session_id: the session searched, results never come from another one
+    :param text: the words to look for, only the first `SEARCH_MAX_TERMS` are used
+    :param before: only return messages older than this message id, None for the newest page
+    :param limit: the page size
+    :param db: database session
+    :return: a `MessagePage` whose `next_before` is the cursor of the next page
+    """
+    terms = lexemes(text)[:Config.SEARCH_MAX_TERMS]
+    if not terms:
+        return MessagePage(messages=[])
+
+    matches = match_query(session_id, terms, before, limit).subquery()
+    query = (
+        select(MessageModel.mid, MessageModel.sender_id, MessageModel.mssg_encrypt)
+        .join(matches, and_(MessageModel.mid == matches.c.mid,
+                            MessageModel.created_at == matches.c.created_at))
+        .order_by(matches.c.created_at.desc(), matches.c.mid.desc())
+    )
+    rows = (await db.execute(query)).all()
+
+    decrypted = await decrypt_many([encrypted for _, _, encrypted in rows])
+    messages = [
+        StoredMessage(mid=mid, sender_id=sender_id,
+                      session=session_id, text=result.value)
+        for (mid, sender_id, _), result in zip(rows, decrypted)
+    ]
+    next_before = messages[-1].mid if len(messages) == limit else None
+    return MessagePage(messages=messages, next_before=next_before)
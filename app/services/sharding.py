@@ -0,0 +1,126 @@
+# session ownership across the API workers
+
+import asyncio
+import bisect
+import hashlib
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import aioredis
+
+from app.config import Config
+
+logger = logging.getLogger(__name__)
+
+NODES_KEY = "shard:nodes"
+
+# Close code sent to the sockets of a session owned by another node, the reason is the owner's address
+CLOSE_MOVED = 4001
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+# The class `HashRing` maps session ids to nodes with consistent hashing. Every node is placed
+# `vnodes` times on the ring, so a node joining or leaving only moves about 1/n of the sessions, and
+# every node computes the same owners from the same node list.
+class HashRing:
+    def __init__(self, nodes: List[str], vnodes: int = Config.SHARD_VNODES):
+        self.nodes = sorted(nodes)
+        points = sorted(
+            (_hash(f"{node}#{replica}"), node)
+            for node in self.nodes
+            for replica in range(vnodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, session_id: int) -> Optional[str]:
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, _hash(str(session_id))) % len(self._points)
+        return self._owners[index]
+
+
+# The class `ShardRegistry` keeps this node alive in a Redis sorted set scored by its last heartbeat
+# and rebuilds the ring from the nodes that are still beating. A node is its routable address, the
+# gateway pins the sockets of a session to `owner(session_id)`.
+class ShardRegistry:
+    def __init__(
+        self,
+        address: str = Config.SHARD_NODE_ADDRESS,
+        on_change: Optional[Callable[[], Awaitable[None]]] = None,
+    ):
+        self.address = address
+        self.on_change = on_change
+        self.redis = aioredis.from_url(
+            f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}",
+            max_connections=Config.REDIS_MAX_CONNECTIONS,
+        )
+        self.ring = HashRing([])
+        self.rebalances = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        # Join before serving, so the first sockets are already checked against the ring
+        await self.beat()
+        self._task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Leave right away rather than after the TTL, the other nodes rebalance on their next beat
+        try:
+            await self.redis.zrem(NODES_KEY, self.address)
+        except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+            pass
+
+    async def beat(self) -> None:
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(NODES_KEY, {self.address: now})
+            pipe.zremrangebyscore(NODES_KEY, "-inf", now - Config.SHARD_NODE_TTL)
+            pipe.zrange(NODES_KEY, 0, -1)
+            *_, nodes = await pipe.execute()
+
+        nodes = sorted(node.decode() for node in nodes)
+        if nodes != self.ring.nodes:
+            logger.info("shard ring changed: %s", ", ".join(nodes))
+            self.ring = HashRing(nodes)
+            self.rebalances += 1
+            if self.on_change is not None:
+                await self.on_change()
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(Config.SHARD_HEARTBEAT_INTERVAL)
+            try:
+                await self.beat()
+            except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+                # Keep the last known ring, the other nodes drop us if this lasts past the TTL
+                logger.warning("shard heartbeat failed")
+
+    def owner(self, session_id: int) -> str:
+        """
+        Routing helper for the gateway and the endpoints.
+
+        :return: the address of the node owning the session, this node while the ring is empty
+        """
+        return self.ring.owner(session_id) or self.address
+
+    def owns(self, session_id: int) -> bool:
+        return self.owner(session_id) == self.address
+
+    def stats(self) -> Dict:
+        return {
+            "address": self.address,
+            "nodes": self.ring.nodes,
+            "rebalances": self.rebalances,
+        }
@@ -1,19 +1,103 @@
+import asyncio
+import logging
 import os
+from typing import List, NamedTuple, Optional
 import aioredis
+from fastapi import HTTPException, status
 from cryptography.hazmat.primitives.asymmetric import x25519
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers import algorithms
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives import padding
 
+from app.config import Config
+from app.services.crypto_pool import CryptoResult, crypto_executor, map_batch
+from app.services.lru import TTLCache
+
+GCM_TAG_SIZE = 16
+
+logger = logging.getLogger(__name__)
+
+# The id of every rekeyed peer is published here, each process drops what it cached for the peer
+KEY_INVALIDATION_CHANNEL = "keys:invalidate"
+
+
+class PeerKeys(NamedTuple):
+    enc_key: bytes
+    mac_key: bytes
+    aead: AESGCM  # built once per key, reused for every message of the peer
+
 
 # This class `SignalProto` implements a protocol for secure communication using asymmetric key
 # exchange, key derivation, encryption, and decryption with AES-GCM mode.
+#
+# Derived keys are cached in process. A rekey in any process is published on
+# KEY_INVALIDATION_CHANNEL, and the cache is only used while this process listens to it: `start` it
+# to enable the cache, until then every lookup reads Redis.
 class SignalProto:
     def __init__(self, redis_port, redis_host):
         self.privateK = x25519.X25519PrivateKey.generate()
         self.publicK = self.privateK.public_key()
         self.redis = aioredis.from_url(f"redis://{redis_host}:{redis_port}")
+        self.keys = TTLCache(Config.KEY_CACHE_SIZE, Config.KEY_CACHE_TTL)
+
+        self.listening = False
+        # Bumped on every invalidation, keys fetched across one are not cached
+        self._generation = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _invalidate(self, uid=None) -> None:
+        self._generation += 1
+        if uid is None:
+            self.keys.clear()
+        else:
+            self.keys.pop(uid)
+
+    async def _listen(self) -> None:
+        delay = 0.1
+        while True:
+            pubsub = self.redis.pubsub()
+            try:
+                await pubsub.subscribe(KEY_INVALIDATION_CHANNEL)
+                # Invalidations published while not subscribed are lost, start over from an empty cache
+                self._invalidate()
+                self.listening = True
+                delay = 0.1
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._invalidate(message["data"].decode())
+            except asyncio.CancelledError:
+                raise
+            except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+                logger.warning("key invalidation channel lost, reconnecting in %.1fs", delay)
+            finally:
+                self.listening = False
+                try:
+                    await pubsub.close()
+                except Exception:  # the connection may already be gone
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, Config.PUBSUB_RECONNECT_MAX_DELAY)
+
+    def _cached(self, uid) -> Optional[PeerKeys]:
+        return self.keys.get(str(uid)) if self.listening else None
+
+    def _cache(self, uid, keys: PeerKeys, generation: int) -> None:
+        if self.listening and generation == self._generation:
+            self.keys.set(str(uid), keys)
 
     async def _derive_keys(self, shared_secret, salt):
         """
@@ -30,16 +114,7 @@ class SignalProto:
         derivation process
         :return: The `_derive_keys` function returns two keys: `enc_key` and `mac_key`.
         """
-        kdf = HKDF(
-            algorithm=hashes.SHA3_256(),
-            length=32 + 16,
-            salt=salt,
-            info=None,
-            backend=None
-        )
-        keys = kdf.derive(shared_secret)
-        enc_key, mac_key = keys[:32], keys[32:]
-        return enc_key, mac_key
+        return await crypto_executor.run(_hkdf, shared_secret, salt)
 
     async def handshake_3D(self, uid, other_publicK):
         """
@@ -54,18 +129,45 @@ class SignalProto:
         perform key exchange with the private key of the current instance (`self.privateK`) to establish a
         shared secret
         """
-        shared_secret = self.privateK.exchange(other_publicK)
+        shared_secret = await crypto_executor.run(self.privateK.exchange, other_publicK)
         salt = os.urandom(32)
         encK, macK = await self._derive_keys(shared_secret=shared_secret, salt=salt)
 
-        await self.redis.set(f"enc_K:{uid}", encK)
-        await self.redis.set(f"mac_K:{uid}", macK)
+        # Every process, this one included, drops the old keys of the peer once the new ones are stored
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.mset({f"enc_K:{uid}": encK, f"mac_K:{uid}": macK})
+            pipe.publish(KEY_INVALIDATION_CHANNEL, str(uid))
+            await pipe.execute()
+        self._invalidate(str(uid))
+
+    async def _peer_keys(self, uid) -> PeerKeys:
+        """
+        The function `_peer_keys` returns the derived keys of a peer along with a reusable AES-GCM
+        context, from the in-process LRU cache or, on a miss, with a single MGET to Redis.
+
+        :param uid: The `uid` parameter identifies the peer whose keys were stored by `handshake_3D`
+        :return: a `PeerKeys` tuple with `enc_key`, `mac_key` and the `aead` cipher context
+        """
+        if (keys := self._cached(uid)) is not None:
+            return keys
+
+        generation = self._generation
+        encK, macK = await self.redis.mget(f"enc_K:{uid}", f"mac_K:{uid}")
+        if encK is None or macK is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"No session keys for user {uid}, handshake first",
+            )
+
+        keys = PeerKeys(encK, macK, AESGCM(encK))
+        self._cache(uid, keys, generation)
+        return keys
 
     async def encrypt_m(self, uid, message):
         """
         The function `encrypt_m` takes a user ID and a message, retrieves encryption and MAC keys from
-        Redis, encrypts the message using AES-GCM with PKCS7 padding, and returns the ciphertext, IV, and
-        MAC.
+        the key cache (Redis on a miss), encrypts the message using AES-GCM with PKCS7 padding, and
+        returns the ciphertext, IV, and MAC.
 
         :param uid: The `uid` parameter in the `encrypt_m` method is used as a unique identifier for a user.
         It is used to retrieve encryption and MAC keys specific to that user from the Redis database. These
@@ -79,18 +181,8 @@ class SignalProto:
         vector (iv), and the message authentication code (mac).
         """
 
-        encK = await self.redis.get(f"enc_K:{uid}")
-        macK = await self.redis.get(f"enc_K:{uid}")
-
-        iv = os.urandom(12)
-        padder = padding.PKCS7(algorithms.AES.block_size).padder()
-        padded_data = padder.update(message.encode()) + padder.finalize()
-        cipher = Cipher(algorithms.AES(encK), modes.GCM(iv))
-        encryptor = cipher.encryptor()
-        ciphertext = encryptor.update(padded_data) + encryptor.finalize()
-        mac = encryptor.compute_digest()
-
-        return ciphertext, iv, mac
+        keys = await self._peer_keys(uid)
+        return await crypto_executor.run(_seal, keys.aead, message, size=len(message))
 
     async def decrypt_message(self, client_id, ciphertext, iv, mac):
         """
@@ -110,16 +202,109 @@ class SignalProto:
         integrity of the message. It stands for Message Authentication Code, which is a short piece of
         information used to authenticate a message and to ensure that it has not been tampered with
         :return: The `decrypt_message` method decrypts a ciphertext using AES encryption with GCM mode. It
-        retrieves the encryption key (`encK`) and MAC key (`macK`) from Redis based on the `client_id`. It
-        then decrypts the ciphertext using the encryption key and verifies the integrity using the MAC key.
+        retrieves the encryption key (`encK`) and MAC key (`macK`) from the key cache based on the
+        `client_id`. It then decrypts the ciphertext using the encryption key and verifies the integrity using the MAC key.
         The decrypted plaintext is then unpadded and returned as a decoded string.
         """
-        encK = await self.redis.get(f"enc_key:{client_id}")
-        macK = await self.redis.get(f"mac_key:{client_id}")
+        keys = await self._peer_keys(client_id)
+        return await crypto_executor.run(_open, keys.aead, ciphertext, iv, mac, size=len(ciphertext))
+
+    async def _peer_keys_many(self, uids) -> dict:
+        """
+        The function `_peer_keys_many` resolves the keys of several peers at once: cached peers are served
+        in process and all the misses are fetched with a single MGET.
+
+        :param uids: The `uids` parameter is an iterable of peer ids, duplicates are looked up once
+        :return: a dict mapping every uid to its `PeerKeys`, or to the exception explaining why there are
+        none
+        """
+        resolved, missing = {}, []
+        for uid in dict.fromkeys(uids):
+            if (keys := self._cached(uid)) is not None:
+                resolved[uid] = keys
+            else:
+                missing.append(uid)
+
+        if missing:
+            generation = self._generation
+            values = await self.redis.mget(
+                *[key for uid in missing for key in (f"enc_K:{uid}", f"mac_K:{uid}")])
+            for i, uid in enumerate(missing):
+                encK, macK = values[2 * i], values[2 * i + 1]
+                if encK is None or macK is None:
+                    resolved[uid] = HTTPException(
+                        status_code=status.HTTP_404_NOT_FOUND,
+                        detail=f"No session keys for user {uid}, handshake first",
+                    )
+                    continue
+                keys = PeerKeys(encK, macK, AESGCM(encK))
+                self._cache(uid, keys, generation)
+                resolved[uid] = keys
+        return resolved
+
+    async def encrypt_many(self, items) -> List[CryptoResult]:
+        """
+        The function `encrypt_many` encrypts a batch of messages, possibly for different peers, fetching the
+        keys once per peer. Large batches are encrypted in the crypto thread pool.
+
+        :param items: The `items` parameter is a sequence of `(uid, message)` pairs
+        :return: one `CryptoResult` per item and in the same order, holding `(ciphertext, iv, mac)` or the
+        error of that item
+        """
+        keys = await self._peer_keys_many(uid for uid, _ in items)
+
+        def seal(item):
+            uid, message = item
+            if isinstance(peer := keys[uid], Exception):
+                raise peer
+            return _seal(peer.aead, message)
+
+        return await map_batch(seal, items)
+
+    async def decrypt_many(self, items) -> List[CryptoResult]:
+        """
+        The function `decrypt_many` decrypts a batch of messages, e.g. a page of session history, fetching
+        the keys once per peer. Large batches are decrypted in the crypto thread pool.
+
+        :param items: The `items` parameter is a sequence of `(client_id, ciphertext, iv, mac)` tuples
+        :return: one `CryptoResult` per item and in the same order, holding the plaintext or the error of
+        that item, e.g. `InvalidTag` for a tampered message
+        """
+        keys = await self._peer_keys_many(item[0] for item in items)
+
+        def open_(item):
+            client_id, ciphertext, iv, mac = item
+            if isinstance(peer := keys[client_id], Exception):
+                raise peer
+            return _open(peer.aead, ciphertext, iv, mac)
+
+        return await map_batch(open_, items)
+
+
+def _hkdf(shared_secret: bytes, salt: bytes) -> tuple:
+    kdf = HKDF(
+        algorithm=hashes.SHA3_256(),
+        length=32 + 16,
+        salt=salt,
+        info=None,
+        backend=None
+    )
+    keys = kdf.derive(shared_secret)
+    enc_key, mac_key = keys[:32], keys[32:]
+    return enc_key, mac_key
+
+
+def _seal(aead: AESGCM, message: str) -> tuple:
+    iv = os.urandom(12)
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    padded_data = padder.update(message.encode()) + padder.finalize()
+    sealed = aead.encrypt(iv, padded_data, None)
+    ciphertext, mac = sealed[:-GCM_TAG_SIZE], sealed[-GCM_TAG_SIZE:]
+    return ciphertext, iv, mac
+
 
-        cipher = Cipher(algorithms.AES(encK), modes.GCM(iv, mac))
-        decryptor = cipher.decryptor()
-        padded_data = decryptor.update(ciphertext) + decryptor.finalize()
-        unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
-        plaintext = unpadder.update(padded_data) + unpadder.finalize()
-        return plaintext.decode()
+def _open(aead: AESGCM, ciphertext: bytes, iv: bytes, mac: bytes) -> str:
+    padded_data = aead.decrypt(iv, ciphertext + mac, None)
+    unpadder = padding.PKCS7(algorithms.AES.block_size).unpadder()
+    plaintext = unpadder.update(padded_data) + unpadder.finalize()
+    return plaintext.decode()
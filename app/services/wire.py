@@ -0,0 +1,139 @@
+# binary wire protocol of the session websocket
+
+import base64
+import struct
+from typing import List, NamedTuple, Optional
+
+import orjson
+
+# Offered by the client in Sec-WebSocket-Protocol to get binary frames
+SUBPROTOCOL = "room.bin.v1"
+
+# 0xFF never starts a UTF-8 string, which tells packed messages apart from text ones in Redis
+MAGIC = 0xFF
+KIND_MESSAGE = 0x01
+KIND_BATCH = 0x02
+FLAG_ENTRY_ID = 0x01
+
+# magic, kind, flags, message id, sender id, iv length, tag length
+HEADER = struct.Struct("!BBBQQBB")
+# stream entry id (milliseconds, sequence), present with FLAG_ENTRY_ID
+ENTRY_ID = struct.Struct("!QQ")
+# magic, kind, packet count, then every packet prefixed with its length
+BATCH_HEADER = struct.Struct("!BBH")
+PACKET_LENGTH = struct.Struct("!I")
+
+
+# The class `WireMessage` is one end to end encrypted message as produced by `SignalProto.encrypt_m`,
+# along with the ids the server needs to route it. The payload is never decrypted by the server.
+class WireMessage(NamedTuple):
+    mid: int
+    sender_id: int
+    ciphertext: bytes
+    iv: bytes
+    tag: bytes
+    entry_id: Optional[bytes] = None
+
+
+def is_packed(data: bytes) -> bool:
+    return data[:1] == b"\xff"
+
+
+def pack(message: WireMessage) -> bytes:
+    """
+    Encode a message as a fixed header followed by the iv, the tag and the ciphertext, as raw bytes.
+
+    :return: the packet, sent as is in binary frames and published as is to Redis
+    """
+    flags = FLAG_ENTRY_ID if message.entry_id is not None else 0
+    parts = [HEADER.pack(MAGIC, KIND_MESSAGE, flags, message.mid, message.sender_id,
+                         len(message.iv), len(message.tag))]
+    if message.entry_id is not None:
+        millis, _, sequence = message.entry_id.partition(b"-")
+        parts.append(ENTRY_ID.pack(int(millis), int(sequence or 0)))
+    parts += [message.iv, message.tag, message.ciphertext]
+    return b"".join(parts)
+
+
+def unpack(data: bytes) -> WireMessage:
+    """
+    Decode a packet built by `pack`.
+
+    :raises ValueError: when the packet is truncated or not a message
+    """
+    if len(data) < HEADER.size:
+        raise ValueError("truncated header")
+    magic, kind, flags, mid, sender_id, iv_size, tag_size = HEADER.unpack_from(data)
+    if magic != MAGIC or kind != KIND_MESSAGE:
+        raise ValueError("not a message packet")
+
+    offset = HEADER.size
+    entry_id = None
+    if flags & FLAG_ENTRY_ID:
+        if len(data) < offset + ENTRY_ID.size:
+            raise ValueError("truncated entry id")
+        millis, sequence = ENTRY_ID.unpack_from(data, offset)
+        entry_id = f"{millis}-{sequence}".encode()
+        offset += ENTRY_ID.size
+    if len(data) < offset + iv_size + tag_size:
+        raise ValueError("truncated payload")
+
+    iv = data[offset:offset + iv_size]
+    offset += iv_size
+    tag = data[offset:offset + tag_size]
+    return WireMessage(mid, sender_id, data[offset + tag_size:], iv, tag, entry_id)
+
+
+def with_entry_id(data: bytes, entry_id: bytes) -> bytes:
+    return pack(unpack(data)._replace(entry_id=entry_id))
+
+
+def pack_batch(packets: List[bytes]) -> bytes:
+    """Concatenate message packets into one batch packet, sent by the server only."""
+    parts = [BATCH_HEADER.pack(MAGIC, KIND_BATCH, len(packets))]
+    for packet in packets:
+        parts += [PACKET_LENGTH.pack(len(packet)), packet]
+    return b"".join(parts)
+
+
+def unpack_batch(data: bytes) -> List[WireMessage]:
+    """
+    Decode a packet built by `pack_batch`.
+
+    :raises ValueError: when the packet is truncated or not a batch
+    """
+    if len(data) < BATCH_HEADER.size:
+        raise ValueError("truncated header")
+    magic, kind, count = BATCH_HEADER.unpack_from(data)
+    if magic != MAGIC or kind != KIND_BATCH:
+        raise ValueError("not a batch packet")
+
+    messages = []
+    offset = BATCH_HEADER.size
+    for _ in range(count):
+        if len(data) < offset + PACKET_LENGTH.size:
+            raise ValueError("truncated batch")
+        (length,) = PACKET_LENGTH.unpack_from(data, offset)
+        offset += PACKET_LENGTH.size
+        if len(data) < offset + length:
+            # The last ciphertext would come out short, unpack cannot tell
+            raise ValueError("truncated batch")
+        messages.append(unpack(data[offset:offset + length]))
+        offset += length
+    return messages
+
+
+def to_json(data: bytes, entry_id: Optional[bytes] = None) -> bytes:
+    """Render a packet for the clients that did not negotiate `SUBPROTOCOL`, binary fields as base64."""
+    message = unpack(data)
+    document = {
+        "mid": message.mid,
+        "sender_id": message.sender_id,
+        "ciphertext": base64.b64encode(message.ciphertext).decode(),
+        "iv": base64.b64encode(message.iv).decode(),
+        "tag": base64.b64encode(message.tag).decode(),
+    }
+    entry_id = entry_id or message.entry_id
+    if entry_id is not None:
+        document["id"] = entry_id.decode()
+    return orjson.dumps(document)
@@ -1,45 +1,266 @@
 import asyncio
-import json
-from fastapi import WebSocket
+import time
+from functools import partial
+from typing import Dict, Optional, Set, Union
+from fastapi import WebSocket, WebSocketDisconnect
+from starlette import status
 
-from app.services.cm import redisPubSub
+from app.config import Config
+from app.services.cm import redisPubSub, redisStreams, valid_entry_id
+from app.services.coalesce import CoalesceStats, SessionCoalescer
+from app.services.fanout import Connection
+from app.services.frames import Frame
+from app.services.lifecycle import ConnectionLifecycle, is_pong
+from app.services.metrics import FANOUT
+from app.services.sharding import CLOSE_MOVED, ShardRegistry
+from app.services.wire import SUBPROTOCOL, unpack
 
 
 class WebSockM:
     def __init__(self):
-        self.sessions: dict = {}
-        self.pubsub_client = redisPubSub()
+        # Members of every session keyed by connection id, and every connection by id and by socket,
+        # so that joining, leaving and lookups never scan a list
+        self.sessions: Dict[int, Dict[int, Connection]] = {}
+        self.connections: Dict[int, Connection] = {}
+        self._by_socket: Dict[int, Connection] = {}
+        # Closes of the dropped connections run in the background, the loop only keeps weak references
+        # to tasks so they are held here until done
+        self._closing: Set[asyncio.Task] = set()
+        self.lifecycle = ConnectionLifecycle(self)
+        # One multiplexed subscriber per process, shared by every session
+        self.durable = Config.FANOUT_MODE == "streams"
+        self.pubsub_client = redisStreams() if self.durable else redisPubSub()
+        # Non-durable frames, presence diffs, are plain PUBLISHes in both modes. With the durable
+        # fan-out they come through a second subscriber, on the pubsub channel of the session
+        self.ephemeral_client: Optional[redisPubSub] = redisPubSub() if self.durable else None
 
-    async def add_user_to_session(self, session_id: int, ws: WebSocket) -> None:
+        # Coalescing window of the opted-in sessions, and the coalescer of those with local sockets
+        self.coalesce_all = Config.WS_COALESCE_SESSIONS.strip() == "*"
+        self.coalesce_windows: Dict[int, float] = {
+            int(session_id): Config.WS_COALESCE_WINDOW
+            for session_id in Config.WS_COALESCE_SESSIONS.split(",")
+            if session_id.strip().isdigit()
+        }
+        self.coalescers: Dict[int, SessionCoalescer] = {}
+        self.coalesce_stats = CoalesceStats()
+
+        # Only the owner of a session holds its sockets, and so subscribes to its channel
+        self.registry: Optional[ShardRegistry] = None
+        if Config.SHARDING_ENABLED:
+            self.registry = ShardRegistry(on_change=self._rebalance)
+        self.moved = 0
+
+    async def start(self) -> None:
+        if self.registry is not None:
+            await self.registry.start()
+        await self.pubsub_client.start(self._pubsub_reader)
+        if self.ephemeral_client is not None:
+            await self.ephemeral_client.start(self._pubsub_reader)
+        await self.lifecycle.start()
+
+    @property
+    def draining(self) -> bool:
+        return self.lifecycle.draining
+
+    async def drain(self) -> None:
+        await self.lifecycle.drain()
+
+    async def stop(self) -> None:
+        await self.lifecycle.stop()
+        if self.registry is not None:
+            await self.registry.stop()
+        await self.pubsub_client.close()
+        if self.ephemeral_client is not None:
+            await self.ephemeral_client.close()
+
+    def route(self, session_id: int) -> Optional[str]:
+        """Address of the node owning the session, None when sharding is off and any node will do."""
+        return self.registry.owner(session_id) if self.registry is not None else None
+
+    def owns(self, session_id: int) -> bool:
+        return self.registry is None or self.registry.owns(session_id)
+
+    async def redirect(self, session_id: int, ws: WebSocket) -> None:
+        # Sockets that reach the wrong node are told where to reconnect, for gateways without routing
         await ws.accept()
+        await ws.close(code=CLOSE_MOVED, reason=self.route(session_id))
 
-        if session_id in self.sessions:
-            self.sessions[session_id].append(ws)
-        else:
-            self.sessions[session_id] = [ws]
+    async def _rebalance(self) -> None:
+        # The ring changed, hand the sessions this node lost over to their new owner
+        for session_id in list(self.sessions):
+            if self.owns(session_id):
+                continue
+            owner = self.route(session_id)
+            for connection in list(self.sessions.get(session_id, {}).values()):
+                self._discard(connection)
+                self.moved += 1
+                self._close_later(connection, CLOSE_MOVED, owner)
 
-            await self.pubsub_client.connect()
-            subscriber = await self.pubsub_client.subscribe(session_id)
-            asyncio.create_task(self._pubsub_reader(subscriber)
-                                )
+    async def add_user_to_session(
+        self, session_id: int, ws: WebSocket, last_id: Optional[str] = None
+    ) -> Connection:
+        """
+        Accept a WebSocket and attach it to the fan-out of its session.
 
-    async def broadcast(self, session_id: int, message: str):
-        await self.pubsub_client._publish(session_id, message)
+        :param last_id: last stream entry id seen by a reconnecting client, what the session received
+        since then is sent first. Ignored in the pubsub fan-out mode.
+        """
+        binary = SUBPROTOCOL in ws.scope.get("subprotocols", [])
+        await ws.accept(subprotocol=SUBPROTOCOL if binary else None)
+
+        connection = Connection(ws, session_id, binary=binary)
+        connection.start()
+        replay = self.durable and last_id is not None
+        if replay:
+            connection.hold()
+
+        subscribe = session_id not in self.sessions
+        if subscribe:
+            self.sessions[session_id] = {}
+            if not self.durable:
+                self.pubsub_client.subscribe(session_id)
+            else:
+                self.ephemeral_client.subscribe(session_id)
+        self.sessions[session_id][connection.id] = connection
+        self.connections[connection.id] = connection
+        self._by_socket[id(ws)] = connection
+
+        if not self.durable:
+            return connection
 
-    async def remove_user_from_room(self, session_id: str, websocket: WebSocket) -> None:
+        entries = await self.pubsub_client.replay(session_id, last_id) if replay else []
+        if subscribe and session_id in self.sessions:
+            # The stream is followed right after what the replay returned, or after the client's cursor
+            # when there was nothing newer, so nothing appended in between is skipped. Without a
+            # cursor, from the end of the stream as of now.
+            if entries:
+                cursor = entries[-1][0]
+            elif replay and valid_entry_id(last_id):
+                cursor = last_id.encode()
+            else:
+                cursor = await self.pubsub_client.end_id(session_id)
+            self.pubsub_client.subscribe(session_id, cursor)
+        if replay:
+            await connection.resume([Frame.from_entry(entry_id, data) for entry_id, data in entries])
 
-        self.rooms[session_id].remove(websocket)
+        return connection
 
-        if len(self.rooms[session_id]) == 0:
-            del self.rooms[session_id]
-            await self.pubsub_client.unsubscribe(session_id)
+    async def receive(self, ws: WebSocket) -> Union[str, bytes]:
+        """
+        Wait for the next message of a client, text or binary. Every frame keeps the connection alive,
+        heartbeat answers are consumed here.
 
-    async def _pubsub_reader(self, subscriber):
+        :raises WebSocketDisconnect: when the client went away
+        :raises ValueError: for a binary frame that is not a valid packet
+        """
         while True:
-            message = await subscriber.get_message(ignore_subscribe_messages=True)
-            if message is not None:
-                session_id = message['channel'].decode('utf-8')
-                all_sockets = self.rooms[session_id]
-                for socket in all_sockets:
-                    data = message['data'].decode('utf-8')
-                    await socket.send_text(data)
+            message = await ws.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", status.WS_1000_NORMAL_CLOSURE))
+            if connection := self._by_socket.get(id(ws)):
+                connection.touch()
+            if message.get("bytes") is not None:
+                # Relayed as is, the packet is validated but its payload is never decoded
+                unpack(message["bytes"])
+                return message["bytes"]
+            if not is_pong(message["text"]):
+                return message["text"]
+
+    async def broadcast(self, session_id: int, message: Union[str, bytes]):
+        await self.pubsub_client._publish(session_id, message)
+
+    async def remove_user_from_room(
+        self,
+        session_id: int,
+        websocket: WebSocket,
+        code: int = status.WS_1000_NORMAL_CLOSURE,
+        reason: Optional[str] = None,
+    ) -> None:
+        connection = self._by_socket.get(id(websocket))
+        if connection is None or connection.session_id != session_id:
+            return
+        self._discard(connection)
+        await connection.close(code, reason)
+
+    def _discard(self, connection: Connection) -> None:
+        connections = self.sessions.get(connection.session_id)
+        if connections is None or connections.pop(connection.id, None) is None:
+            return
+        self.connections.pop(connection.id, None)
+        if self._by_socket.get(id(connection.ws)) is connection:
+            del self._by_socket[id(connection.ws)]
+
+        if not connections:
+            del self.sessions[connection.session_id]
+            self.pubsub_client.unsubscribe(connection.session_id)
+            if self.ephemeral_client is not None:
+                self.ephemeral_client.unsubscribe(connection.session_id)
+            if coalescer := self.coalescers.pop(connection.session_id, None):
+                coalescer.close()
+
+    def _close_later(self, connection: Connection, code: int, reason: Optional[str] = None) -> None:
+        closing = asyncio.create_task(connection.close(code, reason))
+        self._closing.add(closing)
+        closing.add_done_callback(self._closing.discard)
+
+    def set_coalescing(self, session_id: int, window: float) -> None:
+        """
+        Opt a session in or out of coalescing at runtime, in this process only.
+
+        :param window: how long to hold the messages of the session, in seconds, 0 to opt out
+        """
+        self.coalesce_windows[session_id] = window
+        if coalescer := self.coalescers.pop(session_id, None):
+            coalescer.flush()
+
+    def _coalesce_window(self, session_id: int) -> float:
+        if session_id in self.coalesce_windows:
+            return self.coalesce_windows[session_id]
+        return Config.WS_COALESCE_WINDOW if self.coalesce_all else 0.0
+
+    def sharding_stats(self) -> dict:
+        if self.registry is None:
+            return {"enabled": False}
+        return {
+            "enabled": True,
+            **self.registry.stats(),
+            "sessions": len(self.sessions),
+            "moved_connections": self.moved,
+        }
+
+    def coalescing_stats(self) -> dict:
+        return {**self.coalesce_stats.stats(), "sessions": len(self.coalescers)}
+
+    def connection_count(self) -> int:
+        return len(self.connections)
+
+    def lifecycle_stats(self) -> dict:
+        return self.lifecycle.stats()
+
+    def connection_stats(self) -> list:
+        """Queue depth and drop counters of every local connection, to spot the clients falling behind."""
+        return [connection.stats() for connection in self.connections.values()]
+
+    async def _pubsub_reader(self, session_id: int, data: bytes, entry_id: Optional[bytes] = None) -> None:
+        # Encode once, every connection of the session shares the same frame. Enqueueing never
+        # waits, the per connection writer tasks do the actual sending.
+        frame = Frame(data) if entry_id is None else Frame.from_entry(entry_id, data)
+        if session_id not in self.sessions:
+            return
+
+        window = self._coalesce_window(session_id)
+        if window <= 0:
+            self._deliver(session_id, frame)
+            return
+        if session_id not in self.coalescers:
+            self.coalescers[session_id] = SessionCoalescer(
+                window, partial(self._deliver, session_id), self.coalesce_stats)
+        self.coalescers[session_id].add(frame)
+
+    def _deliver(self, session_id: int, frame: Frame) -> None:
+        started = time.perf_counter()
+        for connection in list(self.sessions.get(session_id, {}).values()):
+            if not connection.offer(frame):
+                self._discard(connection)
+                self._close_later(connection, status.WS_1013_TRY_AGAIN_LATER)
+        FANOUT.observe(time.perf_counter() - started)
@@ -1,16 +1,261 @@
-from email import message
+import asyncio
+import logging
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import aioredis
+import orjson
 from celery import Celery
-from .operations import add_session, add_user, add_user_to_room, get_room, get_session, get_user
+from celery.signals import worker_process_init, worker_ready
+
+from .config import Config
+from .operations import get_session_members
+from .services.cm import queue_publish
+from .services.db import DB_MANAGER
+from .services.encryption import decrypt_many, message_cache, require_shared_key
+from .services.metrics import PUBLISH, REGISTRY, SEARCH_INDEX
+from .services.partitions import maintain
+from .services.persistence import WriteBehindWorker
+from .services.read_state import (COUNT_SCRIPT, ReadStateService, cursor_key, unread_key,
+                                  unread_set_key)
+from .services.search import index_messages
+
+logger = logging.getLogger(__name__)
 
+require_shared_key()
 
 celery = Celery(
     "tasks",
-    broker="redis://localhost:6379/0",
-    backend="redis://localhost:6379/0",
+    broker=Config.CELERY_BROKER_URL,
+    backend=Config.CELERY_RESULT_BACKEND,
     include=["app.tasks"],
 )
+celery.conf.update(
+    task_serializer="json",
+    accept_content=["json"],
+    task_ignore_result=True,
+    # Re-create the shard consumers that died with their worker
+    beat_schedule={
+        "ensure-consumers": {
+            "task": "app.tasks.ensure_consumers",
+            "schedule": Config.PROCESS_SHARD_LEASE,
+        },
+        "flush-read-cursors": {
+            "task": "app.tasks.flush_read_cursors",
+            "schedule": Config.READ_CURSOR_FLUSH_INTERVAL,
+        },
+        "maintain-partitions": {
+            "task": "app.tasks.maintain_partitions",
+            "schedule": Config.PARTITION_MAINTENANCE_INTERVAL,
+        },
+    },
+)
+
+# Take the shard lease, or renew it when the caller already holds it
+LEASE_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner == false or owner == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+redis = aioredis.from_url(
+    f"redis://{Config.REDIS_HOST}:{Config.REDIS_PORT}",
+    max_connections=Config.REDIS_MAX_CONNECTIONS,
+)
+count_unread = redis.register_script(COUNT_SCRIPT)
+
+# Only used to read the queue length, the Redis broker keeps every queue in a list named after it
+broker = aioredis.from_url(Config.CELERY_BROKER_URL)
+
+
+async def queue_depth() -> Optional[int]:
+    """
+    Number of tasks waiting in the default Celery queue, for the metrics of the API.
+
+    :return: None when the broker is not Redis
+    """
+    if not Config.CELERY_BROKER_URL.startswith(("redis://", "rediss://")):
+        return None
+    return await broker.llen(celery.conf.task_default_queue)
+
+
+# One event loop per worker process, the database engine and the Redis pools stay bound to it
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_workers: Dict[int, WriteBehindWorker] = {}
+read_state = ReadStateService()
+_metrics_pushed = 0.0
+
+
+def _run(coroutine):
+    global _loop
+    if _loop is None:
+        _loop = asyncio.new_event_loop()
+    return _loop.run_until_complete(coroutine)
+
+
+async def post_process(rows: List[dict]) -> None:
+    """
+    The function `post_process` runs once per persisted batch: it adds the messages to the search
+    index and to the recent messages index of their session, publishes every message to its session
+    channel and adds the messages to the unread counters of the other session members.
+
+    Rows are handed over after the insert and before the stream entries are acknowledged, so a batch
+    that fails here is processed again and its messages may be published twice.
+
+    :param rows: the inserted `messages` rows, in stream order
+    :type rows: List[dict]
+    """
+    texts = await decrypt_many([row["mssg_encrypt"] for row in rows])
+
+    started = time.perf_counter()
+    async with DB_MANAGER.session() as db:
+        await index_messages(db, [
+            {**row, "text": text.value} for row, text in zip(rows, texts) if text.ok])
+        await db.commit()
+    SEARCH_INDEX.observe(time.perf_counter() - started)
+
+    members = {}
+    async with DB_MANAGER.session(readonly=True) as db:
+        for session_id in {row["session_id"] for row in rows}:
+            members[session_id] = await get_session_members(session_id, db)
+
+    # One COUNT_SCRIPT call per (user, session) of the batch, not per message
+    unread: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+    async with redis.pipeline(transaction=False) as pipe:
+        # Persisted by now, so the history pages served from the cache never show a message the
+        # database will not have
+        message_cache.queue_recent(pipe, rows)
+        for row, text in zip(rows, texts):
+            if not text.ok:
+                logger.error("message %s could not be decrypted: %s",
+                             row["mid"], text.error)
+                continue
+            queue_publish(pipe, row["session_id"], orjson.dumps({
+                "mid": row["mid"],
+                "session": row["session_id"],
+                "sender_id": row["sender_id"],
+                "text": text.value,
+            }))
+            for user_id in members[row["session_id"]] - {row["sender_id"]}:
+                unread[(user_id, row["session_id"])].append(row["mid"])
+        for (user_id, session_id), mids in unread.items():
+            await count_unread(
+                keys=[unread_key(user_id), unread_set_key(user_id, session_id), cursor_key(user_id)],
+                args=[session_id, Config.READ_STATE_UNREAD_MAX, *mids], client=pipe)
+        started = time.perf_counter()
+        await pipe.execute()
+        PUBLISH.observe(time.perf_counter() - started)
+
+
+async def _shard_worker(shard: int) -> WriteBehindWorker:
+    if shard not in _workers:
+        # The consumer is named after the shard and not the host, and every run reads its pending
+        # entries first: whichever process the chain runs in retries a failed batch before anything
+        # newer, nothing about the shard is kept in the process
+        worker = WriteBehindWorker(
+            shards=[shard], consumer=f"shard-{shard}", post_process=post_process)
+        await worker._prepare()
+        _workers[shard] = worker
+    return _workers[shard]
+
+
+async def _push_metrics() -> None:
+    # Nothing scrapes the worker processes, their stage histograms are summed up in Redis and exposed
+    # by the API as `room_worker_stage_seconds`
+    global _metrics_pushed
+    if time.monotonic() - _metrics_pushed < Config.METRICS_PUSH_INTERVAL:
+        return
+    _metrics_pushed = time.monotonic()
+    try:
+        await REGISTRY.push(redis)
+    except (aioredis.ConnectionError, aioredis.TimeoutError, OSError):
+        logger.warning("worker metrics push failed, retrying with the next batch")
+
+
+async def _process_shard(shard: int, token: str) -> Optional[int]:
+    owned = await redis.eval(
+        LEASE_SCRIPT, 1, f"messages:wb:{shard}:lease", token,
+        Config.PROCESS_SHARD_LEASE * 1000)
+    if not owned:
+        return None
+    worker = await _shard_worker(shard)
+    try:
+        return await worker.process_once(Config.PROCESS_IDLE_WAIT)
+    finally:
+        await _push_metrics()
+
+
+@celery.task
+def process_message(shard: int, token: Optional[str] = None) -> int:
+    """
+    The task `process_message` is the batch consumer of one write-behind shard. Each run persists and
+    post-processes at most one batch, bounded by `WRITE_BEHIND_BATCH_SIZE` messages and
+    `WRITE_BEHIND_FLUSH_INTERVAL` seconds, then enqueues the next run of the chain.
+
+    Only the chain holding the shard lease keeps going, a duplicate chain stops at its first run.
+
+    :param shard: the write-behind shard to consume
+    :type shard: int
+    :param token: the lease token of the chain, None to start a new chain
+    :type token: Optional[str]
+    :return: the number of messages processed by this run
+    """
+    token = token or uuid.uuid4().hex
+    countdown = 0
+    try:
+        processed = _run(_process_shard(shard, token))
+    except Exception:
+        logger.exception("processing shard %d failed, retrying", shard)
+        processed, countdown = 0, 1
+    if processed is None:
+        return 0
+    process_message.apply_async(args=[shard, token], countdown=countdown)
+    return processed
+
+
+@celery.task
+def ensure_consumers() -> None:
+    for shard in range(Config.WRITE_BEHIND_SHARDS):
+        process_message.delay(shard)
+
+
+@celery.task
+def maintain_partitions() -> dict:
+    """
+    The task `maintain_partitions` creates the upcoming monthly partitions of `messages`, detaches the
+    ones past the retention and archives them, see `app.services.partitions.maintain`.
+
+    :return: the partitions created, detached and the archive files written
+    """
+    return _run(maintain())
 
 
 @celery.task
-def process_message(message: message):
-    pass
+def flush_read_cursors() -> int:
+    """
+    The task `flush_read_cursors` copies the read cursors that moved in Redis to Postgres, batch after
+    batch until none is left.
+
+    :return: the number of cursors written
+    """
+    total = 0
+    while (written := _run(read_state.flush())) > 0:
+        total += written
+    return total
+
+
+@worker_process_init.connect
+def _init_worker_process(**kwargs) -> None:
+    DB_MANAGER.init(Config.DB_CONFIG, Config.DB_REPLICA_CONFIG)
+
+
+@worker_ready.connect
+def _start_consumers(**kwargs) -> None:
+    # The partitions first, the consumers cannot insert into a month that has none
+    maintain_partitions.delay()
+    ensure_consumers.delay()
@@ -0,0 +1,59 @@
+"""Per socket `send_text` encoding against one pre-encoded frame written to every transport.
+
+    python -m benchmarks.bench_broadcast --sockets 5000 --size 256
+"""
+import argparse
+import time
+
+from websockets.frames import Frame as WsFrame, Opcode
+
+from app.services.frames import Frame
+
+
+class FakeTransport:
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data: bytes) -> None:
+        self.written += len(data)
+
+
+def per_socket_send_text(text: str, transports) -> None:
+    # What the ASGI server does for every `send_text`: an ASGI message, then encode and frame it
+    for transport in transports:
+        message = {"type": "websocket.send", "text": text}
+        frame = WsFrame(Opcode.TEXT, message["text"].encode())
+        transport.write(frame.serialize(mask=False, extensions=[]))
+
+
+def pre_encoded(text: str, transports) -> None:
+    frame = Frame.from_text(text)
+    for transport in transports:
+        transport.write(frame.wire)
+
+
+def run(fn, text: str, sockets: int, messages: int) -> float:
+    transports = [FakeTransport() for _ in range(sockets)]
+    start = time.perf_counter()
+    for _ in range(messages):
+        fn(text, transports)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sockets", type=int, default=5000)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--messages", type=int, default=50)
+    args = parser.parse_args()
+
+    text = "x" * args.size
+    deliveries = args.sockets * args.messages
+    for name, fn in (("send_text loop", per_socket_send_text), ("pre-encoded", pre_encoded)):
+        elapsed = run(fn, text, args.sockets, args.messages)
+        print(f"{name:>15}: {elapsed:.3f}s  {deliveries / elapsed:,.0f} deliveries/s  "
+              f"{elapsed / deliveries * 1e9:,.0f} ns/delivery")
+
+
+if __name__ == "__main__":
+    main()
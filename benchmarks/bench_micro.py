@@ -0,0 +1,145 @@
+"""Microbenchmarks of the chat hot paths, in process and without any server.
+
+Every case reports nanoseconds per operation, results go to JSON for `benchmarks.compare`.
+
+    python -m benchmarks.bench_micro --iterations 20000 --size 256
+    python -m benchmarks.bench_micro --only fernet aesgcm --output run.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import orjson
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from app.services import encryption, signal
+from app.services.cache import ReadThroughCache
+from app.services.frames import Frame, encode_frame
+from app.services.lru import TTLCache
+from app.services.message_cache import MessageCache
+from app.services.wire import WireMessage, pack, unpack
+from benchmarks import results
+from benchmarks.fakes import InMemoryRedis
+
+
+def measure(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+async def ameasure(fn, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await fn()
+    return (time.perf_counter() - start) / iterations * 1e9
+
+
+def bench_fernet(iterations: int, size: int) -> dict:
+    text = "x" * size
+    token = encryption._encrypt(text)
+    return {
+        "fernet_encrypt_ns": measure(lambda: encryption._encrypt(text), iterations),
+        "fernet_decrypt_ns": measure(lambda: encryption._decrypt(token), iterations),
+    }
+
+
+def bench_aesgcm(iterations: int, size: int) -> dict:
+    aead = AESGCM(AESGCM.generate_key(bit_length=256))
+    text = "x" * size
+    ciphertext, iv, mac = signal._seal(aead, text)
+    return {
+        "aesgcm_seal_ns": measure(lambda: signal._seal(aead, text), iterations),
+        "aesgcm_open_ns": measure(lambda: signal._open(aead, ciphertext, iv, mac), iterations),
+    }
+
+
+def bench_serialization(iterations: int, size: int) -> dict:
+    document = {"mid": 123456789, "session": 42, "sender_id": 7, "text": "x" * size}
+    encoded = orjson.dumps(document)
+    message = WireMessage(123456789, 7, os.urandom(size), os.urandom(12), os.urandom(16))
+    packet = pack(message)
+    return {
+        "orjson_dumps_ns": measure(lambda: orjson.dumps(document), iterations),
+        "orjson_loads_ns": measure(lambda: orjson.loads(encoded), iterations),
+        "json_dumps_ns": measure(lambda: json.dumps(document), iterations),
+        "json_loads_ns": measure(lambda: json.loads(encoded), iterations),
+        "wire_pack_ns": measure(lambda: pack(message), iterations),
+        "wire_unpack_ns": measure(lambda: unpack(packet), iterations),
+        "frame_encode_ns": measure(lambda: encode_frame(encoded), iterations),
+        "frame_text_wire_ns": measure(lambda: Frame(encoded).wire, iterations),
+    }
+
+
+def bench_cache(iterations: int, size: int) -> dict:
+    local = TTLCache(maxsize=iterations, ttl=60)
+    keys = list(range(iterations))
+    value = "x" * size
+    counter = iter(range(10 ** 12))
+
+    measured = {"ttlcache_set_ns": measure(lambda: local.set(next(counter) % iterations, value), iterations)}
+    counter = iter(range(10 ** 12))
+    measured["ttlcache_get_ns"] = measure(lambda: local.get(keys[next(counter) % iterations]), iterations)
+
+    async def run() -> None:
+        entity_cache = ReadThroughCache()
+        entity_cache.redis = InMemoryRedis()
+        row = {"uid": 1, "name": "x" * size}
+
+        async def loader():
+            return row
+
+        await entity_cache.get("cache:user:1", loader)
+        measured["entity_cache_local_hit_ns"] = await ameasure(
+            lambda: entity_cache.get("cache:user:1", loader), iterations)
+
+        async def redis_hit():
+            entity_cache.local.clear()
+            await entity_cache.get("cache:user:1", loader)
+        measured["entity_cache_redis_hit_ns"] = await ameasure(redis_hit, iterations)
+
+        message_cache = MessageCache()
+        message_cache.redis = InMemoryRedis()
+        token = encryption._encrypt(value)
+        mids = iter(range(10 ** 12))
+        measured["message_cache_set_ns"] = await ameasure(
+            lambda: message_cache.set(next(mids), token), iterations)
+        measured["message_cache_get_many_50_ns"] = await ameasure(
+            lambda: message_cache.get_many(range(50)), iterations)
+
+    asyncio.run(run())
+    return measured
+
+
+CASES = {
+    "fernet": bench_fernet,
+    "aesgcm": bench_aesgcm,
+    "serialization": bench_serialization,
+    "cache": bench_cache,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--only", nargs="+", choices=sorted(CASES), default=sorted(CASES))
+    parser.add_argument("--output", help="result file, benchmarks/results/micro-<time>.json by default")
+    args = parser.parse_args()
+
+    measured = {}
+    for name in args.only:
+        measured.update(CASES[name](args.iterations, args.size))
+    for metric, value in measured.items():
+        print(f"{metric:>32}: {value:>10,.0f}")
+
+    path = results.write("micro", {"iterations": args.iterations, "size": args.size},
+                         measured, args.output)
+    print(f"results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Post-processing throughput of the write-behind consumer against the batch size.
+
+Postgres and Redis are replaced by fakes that only cost one simulated round trip per call, the
+decryption is real. Batch size 1 is what one Celery task per message used to cost at best.
+
+    python -m benchmarks.bench_pipeline --messages 5000 --rtt 0.5 --batch-sizes 1 10 50 100 500
+"""
+import argparse
+import asyncio
+import time
+
+from app.services.encryption import _encrypt, decrypt_many
+from app.services.persistence import WriteBehindWorker
+
+
+class FakePipeline:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append(name)
+        return command
+
+    async def execute(self):
+        await asyncio.sleep(self.rtt)
+        return [0] * len(self.commands)
+
+
+class FakeRedis:
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+
+    def pipeline(self, transaction: bool = True):
+        return FakePipeline(self.rtt)
+
+
+async def bench(messages: int, rtt: float, batch_size: int, size: int) -> float:
+    redis = FakeRedis(rtt)
+
+    async def insert(rows):
+        await asyncio.sleep(rtt)
+
+    async def post_process(rows):
+        await decrypt_many([row["mssg_encrypt"] for row in rows])
+        async with redis.pipeline(transaction=False) as pipe:
+            for row in rows:
+                pipe.publish(str(row["session_id"]), row["mssg_encrypt"])
+            await pipe.execute()
+
+    worker = WriteBehindWorker(shards=[0], post_process=post_process)
+    worker.redis = redis
+    worker._insert = insert
+
+    token = _encrypt("x" * size).encode()
+    now = int(time.time() * 1000)
+    entries = [
+        ("messages:wb:0", f"{now}-{mid}".encode(),
+         {b"mid": str(mid).encode(), b"sid": b"1", b"sender": b"1", b"msg": token})
+        for mid in range(messages)
+    ]
+
+    start = time.perf_counter()
+    for offset in range(0, messages, batch_size):
+        await worker.flush(entries[offset:offset + batch_size])
+    return messages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--rtt", type=float, default=0.5,
+                        help="simulated round trip, in milliseconds")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--batch-sizes", type=int, nargs="+",
+                        default=[1, 10, 50, 100, 500])
+    args = parser.parse_args()
+
+    for batch_size in args.batch_sizes:
+        rate = asyncio.run(bench(args.messages, args.rtt / 1000, batch_size, args.size))
+        print(f"batch {batch_size:>5}: {rate:>12,.0f} messages/s")
+
+
+if __name__ == "__main__":
+    main()
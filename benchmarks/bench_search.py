@@ -0,0 +1,136 @@
+"""Query latency of the session search index at scale, against a real Postgres.
+
+Seeds `--messages` synthetic documents into `message_search`, spread over `--sessions` sessions and the
+last `--months` months, with words drawn from a skewed vocabulary so that a few words are very
+common and most are rare, like chat text. Then times the index query of `app.services.search` for
+common, medium and rare words, two word queries, and a deeper page, and reports percentiles.
+
+Run it on a scratch database, DB_CONFIG points to it. Seeding 10M rows takes a while, `--skip-seed`
+reuses a previous run.
+
+    python -m benchmarks.bench_search --messages 10000000 --sessions 1000 --queries 200
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+
+from app.config import Config
+from app.models import MessageSearchModel
+from app.services.db import DB_MANAGER
+from app.services.partitions import ensure_partitions
+from app.services.search import match_query
+from benchmarks import results
+
+# The synthetic sessions live far above real ids
+SESSION_BASE = 2_000_000_000
+
+
+async def seed(args) -> float:
+    start = datetime.utcnow() - timedelta(days=30 * args.months)
+    step_ms = 30 * args.months * 86_400_000 / args.messages
+    async with DB_MANAGER.connect() as connection:
+        await connection.run_sync(MessageSearchModel.__table__.create, checkfirst=True)
+        await ensure_partitions(connection, since=start)
+        await connection.execute(text("DELETE FROM message_search WHERE session_id >= :base"),
+                                 {"base": SESSION_BASE})
+
+    started = time.perf_counter()
+    for first in range(1, args.messages + 1, args.seed_batch):
+        last = min(first + args.seed_batch - 1, args.messages)
+        async with DB_MANAGER.connect() as connection:
+            # power(vocabulary, random()) is log-uniform, word 1 is in about half of the messages and
+            # the tail is rare. The `g > 0` keeps the words subquery correlated, drawn per row.
+            await connection.execute(text(
+                "INSERT INTO message_search (mid, session_id, created_at, document) "
+                "SELECT g, :base + g % :sessions, "
+                "CAST(:start AS timestamp) + g * CAST(:step AS float8) * interval '1 millisecond', "
+                "array_to_tsvector(ARRAY("
+                "  SELECT 'w' || floor(power(:vocabulary, random()))::int "
+                "  FROM generate_series(1, :words) WHERE g > 0)) "
+                "FROM generate_series(:first, :last) AS g"
+            ), {"base": SESSION_BASE, "sessions": args.sessions, "start": start, "step": step_ms,
+                "vocabulary": args.vocabulary, "words": args.words, "first": first, "last": last})
+        print(f"seeded {last:,} / {args.messages:,}")
+    async with DB_MANAGER.connect() as connection:
+        await connection.execute(text("ANALYZE message_search"))
+    return time.perf_counter() - started
+
+
+def percentile(values, fraction: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+async def measure(args, name: str, terms_of, deep: bool = False) -> dict:
+    rng = random.Random(name)
+    latencies, hits = [], 0
+    async with DB_MANAGER.session(readonly=True) as db:
+        for _ in range(args.queries):
+            session_id = SESSION_BASE + rng.randrange(args.sessions)
+            terms = terms_of(rng)
+            before = None
+            if deep:
+                # Cursor of the fifth page, found outside of the timing
+                page = (await db.execute(match_query(session_id, terms, None, args.limit * 5))).all()
+                before = page[-1].mid if page else None
+            started = time.perf_counter()
+            rows = (await db.execute(match_query(session_id, terms, before, args.limit))).all()
+            latencies.append((time.perf_counter() - started) * 1000)
+            hits += len(rows)
+    return {
+        f"{name}_p50_ms": percentile(latencies, 0.50),
+        f"{name}_p99_ms": percentile(latencies, 0.99),
+        f"{name}_avg_hits": hits / args.queries,
+    }
+
+
+async def run(args) -> dict:
+    DB_MANAGER.init(Config.DB_CONFIG, Config.DB_REPLICA_CONFIG)
+    try:
+        measured = {}
+        if not args.skip_seed:
+            measured["seed_seconds"] = await seed(args)
+        medium, rare = int(args.vocabulary ** 0.5), args.vocabulary - 1
+        cases = [
+            ("common", lambda rng: ["w1"]),
+            ("medium", lambda rng: [f"w{rng.randint(medium // 2, medium)}"]),
+            ("rare", lambda rng: [f"w{rng.randint(rare // 2, rare)}"]),
+            ("two_words", lambda rng: ["w1", f"w{rng.randint(2, medium)}"]),
+        ]
+        for name, terms_of in cases:
+            measured.update(await measure(args, name, terms_of))
+        measured.update(await measure(args, "common_page5", cases[0][1], deep=True))
+        return measured
+    finally:
+        await DB_MANAGER.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=10_000_000)
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--months", type=int, default=12)
+    parser.add_argument("--vocabulary", type=int, default=50_000)
+    parser.add_argument("--words", type=int, default=12, help="words per message")
+    parser.add_argument("--seed-batch", type=int, default=500_000)
+    parser.add_argument("--skip-seed", action="store_true")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--limit", type=int, default=Config.HISTORY_PAGE_SIZE)
+    parser.add_argument("--output", help="result file, benchmarks/results/search-<time>.json by default")
+    args = parser.parse_args()
+
+    measured = asyncio.run(run(args))
+    for metric, value in measured.items():
+        print(f"{metric:>24}: {value:>10,.2f}")
+
+    params = {name: value for name, value in vars(args).items() if name != "output"}
+    path = results.write("search", params, measured, args.output)
+    print(f"results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""SignalProto encrypt / decrypt throughput on one core, with the peer keys in the key cache.
+
+    python -m benchmarks.bench_signal --messages 20000 --size 256
+"""
+import argparse
+import asyncio
+import time
+
+from cryptography.hazmat.primitives.asymmetric import x25519
+
+from app.services.signal import SignalProto
+from benchmarks.fakes import InMemoryRedis
+
+
+async def bench(messages: int, size: int) -> None:
+    proto = SignalProto(redis_port=6379, redis_host="localhost")
+    proto.redis = InMemoryRedis()
+    # A single process with nothing to invalidate, the key cache can be used without the listener
+    proto.listening = True
+    peer = x25519.X25519PrivateKey.generate().public_key()
+    await proto.handshake_3D(1, peer)
+
+    text = "x" * size
+    start = time.perf_counter()
+    sealed = [await proto.encrypt_m(1, text) for _ in range(messages)]
+    encrypt_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for ciphertext, iv, mac in sealed:
+        await proto.decrypt_message(1, ciphertext, iv, mac)
+    decrypt_elapsed = time.perf_counter() - start
+
+    print(f"encrypt: {messages / encrypt_elapsed:,.0f} messages/s/core")
+    print(f"decrypt: {messages / decrypt_elapsed:,.0f} messages/s/core")
+    print(f"key cache: {proto.keys.hits} hits, {proto.keys.misses} misses")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=256)
+    args = parser.parse_args()
+    asyncio.run(bench(args.messages, args.size))
+
+
+if __name__ == "__main__":
+    main()
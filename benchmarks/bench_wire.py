@@ -0,0 +1,61 @@
+"""Bytes and CPU per message of the binary packet against JSON with base64 encoded binary fields.
+
+Each message is an AES-GCM sealed payload as produced by `SignalProto.encrypt_m`, encoded then decoded.
+
+    python -m benchmarks.bench_wire --messages 100000 --sizes 32 256 1024 4096
+"""
+import argparse
+import base64
+import os
+import time
+
+import orjson
+
+from app.services.wire import WireMessage, pack, unpack
+
+
+def json_roundtrip(message: WireMessage) -> bytes:
+    data = orjson.dumps({
+        "mid": message.mid,
+        "sender_id": message.sender_id,
+        "ciphertext": base64.b64encode(message.ciphertext).decode(),
+        "iv": base64.b64encode(message.iv).decode(),
+        "tag": base64.b64encode(message.tag).decode(),
+    })
+    document = orjson.loads(data)
+    WireMessage(document["mid"], document["sender_id"], base64.b64decode(document["ciphertext"]),
+                base64.b64decode(document["iv"]), base64.b64decode(document["tag"]))
+    return data
+
+
+def binary_roundtrip(message: WireMessage) -> bytes:
+    data = pack(message)
+    unpack(data)
+    return data
+
+
+def run(fn, message: WireMessage, messages: int) -> tuple:
+    size = len(fn(message))
+    start = time.perf_counter()
+    for _ in range(messages):
+        fn(message)
+    return size, (time.perf_counter() - start) / messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[32, 256, 1024, 4096])
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        message = WireMessage(mid=123456789, sender_id=4242, ciphertext=os.urandom(size),
+                              iv=os.urandom(12), tag=os.urandom(16))
+        for name, fn in (("json+base64", json_roundtrip), ("binary", binary_roundtrip)):
+            wire_size, per_message = run(fn, message, args.messages)
+            print(f"{size:>6} B payload {name:>12}: {wire_size:>6} bytes/message  "
+                  f"{per_message * 1e9:>8,.0f} ns/message")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+"""Side by side comparison of two result files of the same benchmark.
+
+    python -m benchmarks.compare benchmarks/results/micro-A.json benchmarks/results/micro-B.json
+"""
+import argparse
+import json
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    args = parser.parse_args()
+
+    with open(args.baseline) as baseline_file, open(args.candidate) as candidate_file:
+        baseline, candidate = json.load(baseline_file), json.load(candidate_file)
+    print(f"{baseline['benchmark']}: {baseline['commit']} ({baseline['time']}) -> "
+          f"{candidate['commit']} ({candidate['time']})")
+
+    for metric in sorted(set(baseline["results"]) | set(candidate["results"])):
+        before, after = baseline["results"].get(metric), candidate["results"].get(metric)
+        if isinstance(before, (int, float)) and isinstance(after, (int, float)) and before:
+            change = f"{(after - before) / before:+.1%}"
+        else:
+            change = ""
+        print(f"{metric:>40}: {before!s:>14} -> {after!s:>14}  {change}")
+
+
+if __name__ == "__main__":
+    main()
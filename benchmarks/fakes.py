@@ -0,0 +1,69 @@
+"""In-process stand-ins for Redis, for the benchmarks that run without a server."""
+import asyncio
+
+
+class InMemoryPipeline:
+    def __init__(self, redis: "InMemoryRedis"):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def __getattr__(self, name):
+        def command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return command
+
+    async def execute(self):
+        results = []
+        for name, args, kwargs in self.commands:
+            method = getattr(self.redis, name, None)
+            results.append(await method(*args, **kwargs) if method else 0)
+        self.commands = []
+        if self.redis.rtt:
+            await asyncio.sleep(self.redis.rtt)
+        return results
+
+
+# The class `InMemoryRedis` implements the handful of commands the caches use, keyed by the encoded
+# key. `rtt` adds a simulated round trip to every call that reaches it.
+class InMemoryRedis:
+    def __init__(self, rtt: float = 0.0):
+        self.rtt = rtt
+        self.data = {}
+
+    @staticmethod
+    def _key(key):
+        return key.encode() if isinstance(key, str) else key
+
+    @staticmethod
+    def _value(value):
+        return value if isinstance(value, bytes) else str(value).encode()
+
+    async def get(self, key):
+        return self.data.get(self._key(key))
+
+    async def set(self, key, value, ex=None):
+        self.data[self._key(key)] = self._value(value)
+        return True
+
+    async def delete(self, *keys):
+        return sum(self.data.pop(self._key(key), None) is not None for key in keys)
+
+    async def mset(self, mapping):
+        for key, value in mapping.items():
+            self.data[self._key(key)] = self._value(value)
+        return True
+
+    async def mget(self, *keys):
+        if len(keys) == 1 and isinstance(keys[0], (list, tuple)):
+            keys = keys[0]
+        return [self.data.get(self._key(key)) for key in keys]
+
+    def pipeline(self, transaction: bool = True):
+        return InMemoryPipeline(self)
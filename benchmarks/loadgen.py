@@ -0,0 +1,227 @@
+"""End to end load generator against a running API, with its Redis, Postgres and Celery workers.
+
+Opens `--clients` WebSockets spread over `--sessions` sessions on /message/{session_id}, sends messages
+through the socket (`--mode ws`, the broadcast path) or POST /send_message (`--mode http`, persisted
+then published by the `process_message` consumers) and measures when every member receives them.
+
+The http mode persists the messages, the sessions from `--first-session` on must exist and client `n`,
+connected as user `n + 1` to session `first_session + n % sessions`, must be a member of its session:
+messages are sent as the first user connected to each session, and non-members are refused.
+
+    python -m benchmarks.loadgen --url http://localhost:8000 --clients 1000 --sessions 50 \\
+        --rate 200 --duration 30 --mode ws --server-pid $(pgrep -f uvicorn | head -1)
+"""
+import argparse
+import asyncio
+import time
+from typing import Dict, List, Optional, Set
+
+import httpx
+import orjson
+import websockets
+
+from benchmarks import results
+
+PREFIX = "bench:"
+
+
+def rss(pid: str = "self") -> Optional[int]:
+    # Linux only, None elsewhere
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def texts(frame: str) -> List[str]:
+    # Unwrap what the fan-out may have put around the message: coalescing batches, stream envelopes
+    # and the JSON published by the post-processing stage
+    if not frame.startswith("{"):
+        return [frame]
+    try:
+        document = orjson.loads(frame)
+    except orjson.JSONDecodeError:
+        return [frame]
+    if "batch" in document:
+        return [text for item in document["batch"] for text in texts(item)]
+    if "data" in document:
+        return texts(document["data"])
+    if isinstance(document.get("text"), str):
+        return [document["text"]]
+    return []
+
+
+def pong(frame: str) -> Optional[str]:
+    # The answer to a server heartbeat, without it the server evicts the socket after WS_IDLE_TIMEOUT
+    if not frame.startswith('{"ping"'):
+        return None
+    try:
+        document = orjson.loads(frame)
+    except orjson.JSONDecodeError:
+        return None
+    return orjson.dumps({"pong": document["ping"]}).decode() if "ping" in document else None
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class LoadGenerator:
+    def __init__(self, args):
+        self.args = args
+        self.ws_url = args.url.replace("http", "ws", 1)
+        self.sockets: Dict[int, list] = {}
+        # User ids the sockets of every session connected as, in the order of `sockets`
+        self.users: Dict[int, List[int]] = {}
+        self.latencies: List[float] = []
+        self.sent = 0
+        self.expected = 0
+        self.received = 0
+        self.connect_errors = 0
+        self.send_errors = 0
+
+    async def connect(self, client: int, limit: asyncio.Semaphore) -> None:
+        session_id = self.args.first_session + client % self.args.sessions
+        async with limit:
+            try:
+                ws = await websockets.connect(
+                    f"{self.ws_url}/message/{session_id}?user_id={client + 1}", max_queue=None)
+            except (OSError, websockets.WebSocketException):
+                self.connect_errors += 1
+                return
+        self.sockets.setdefault(session_id, []).append(ws)
+        self.users.setdefault(session_id, []).append(client + 1)
+
+    async def receive(self, ws) -> None:
+        try:
+            async for frame in ws:
+                if isinstance(frame, bytes):
+                    continue
+                if (answer := pong(frame)) is not None:
+                    await ws.send(answer)
+                    continue
+                now = time.time_ns()
+                for text in texts(frame):
+                    if text.startswith(PREFIX):
+                        self.received += 1
+                        self.latencies.append((now - int(text.split(":")[2])) / 1e6)
+        except websockets.WebSocketException:
+            pass
+
+    def payload(self, sender: int) -> str:
+        text = f"{PREFIX}{sender}:{time.time_ns()}:"
+        return text + "x" * max(0, self.args.size - len(text))
+
+    async def send(self, http: httpx.AsyncClient, session_id: int) -> None:
+        ws = self.sockets[session_id][0]
+        sender = self.users[session_id][0]
+        try:
+            if self.args.mode == "ws":
+                await ws.send(self.payload(sender))
+            else:
+                text = self.payload(sender)
+                response = await http.post(
+                    "/send_message", params={"session_id": session_id, "user_id": sender},
+                    json={"mid": 0, "sender_id": sender, "session": session_id, "text": text})
+                response.raise_for_status()
+        except (OSError, httpx.HTTPError, websockets.WebSocketException):
+            self.send_errors += 1
+            return
+        self.sent += 1
+        self.expected += len(self.sockets[session_id])
+
+    async def run(self) -> dict:
+        args = self.args
+        client_before, server_before = rss(), rss(args.server_pid) if args.server_pid else None
+
+        limit = asyncio.Semaphore(args.connect_concurrency)
+        await asyncio.gather(*(self.connect(client, limit) for client in range(args.clients)))
+        connected = sum(len(sockets) for sockets in self.sockets.values())
+        await asyncio.sleep(1)  # let the subscriptions settle
+        client_after, server_after = rss(), rss(args.server_pid) if args.server_pid else None
+
+        receivers = [asyncio.create_task(self.receive(ws))
+                     for sockets in self.sockets.values() for ws in sockets]
+        sessions = list(self.sockets)
+        # The loop only keeps weak references to tasks, the sends in flight are held here
+        sending: Set[asyncio.Task] = set()
+        async with httpx.AsyncClient(base_url=args.url, timeout=10) as http:
+            start = time.perf_counter()
+            interval = 1 / args.rate
+            tick = 0
+            while sessions and time.perf_counter() - start < args.duration:
+                task = asyncio.create_task(self.send(http, sessions[tick % len(sessions)]))
+                sending.add(task)
+                task.add_done_callback(sending.discard)
+                tick += 1
+                # Open loop: keep the schedule even when the server falls behind
+                await asyncio.sleep(max(0.0, start + tick * interval - time.perf_counter()))
+            elapsed = time.perf_counter() - start
+            # Every message is sent before the wait for late deliveries starts
+            await asyncio.gather(*sending)
+            await asyncio.sleep(args.drain)
+
+        for sockets in self.sockets.values():
+            for ws in sockets:
+                await ws.close()
+        await asyncio.gather(*receivers, return_exceptions=True)
+
+        latencies = sorted(self.latencies)
+
+        def per_connection(before, after):
+            if before is None or after is None or not connected:
+                return None
+            return (after - before) / connected
+
+        return {
+            "connected": connected,
+            "connect_errors": self.connect_errors,
+            "sent": self.sent,
+            "send_errors": self.send_errors,
+            "expected_deliveries": self.expected,
+            "received": self.received,
+            "delivery_ratio": self.received / self.expected if self.expected else 0.0,
+            "messages_per_sec": self.sent / elapsed if elapsed else 0.0,
+            "deliveries_per_sec": self.received / elapsed if elapsed else 0.0,
+            "latency_p50_ms": percentile(latencies, 0.50),
+            "latency_p90_ms": percentile(latencies, 0.90),
+            "latency_p99_ms": percentile(latencies, 0.99),
+            "latency_max_ms": latencies[-1] if latencies else 0.0,
+            "client_memory_per_connection_bytes": per_connection(client_before, client_after),
+            "server_memory_per_connection_bytes": per_connection(server_before, server_after),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=200)
+    parser.add_argument("--sessions", type=int, default=20)
+    parser.add_argument("--first-session", type=int, default=1)
+    parser.add_argument("--mode", choices=["ws", "http"], default="ws")
+    parser.add_argument("--rate", type=float, default=100, help="messages sent per second, in total")
+    parser.add_argument("--size", type=int, default=256)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--drain", type=float, default=3, help="seconds to wait for late deliveries")
+    parser.add_argument("--connect-concurrency", type=int, default=100)
+    parser.add_argument("--server-pid", help="API process to sample the memory of, Linux only")
+    parser.add_argument("--output", help="result file, benchmarks/results/loadgen-<time>.json by default")
+    args = parser.parse_args()
+
+    measured = asyncio.run(LoadGenerator(args).run())
+    for metric, value in measured.items():
+        print(f"{metric:>36}: {value}")
+
+    params = {name: value for name, value in vars(args).items() if name != "output"}
+    path = results.write("loadgen", params, measured, args.output)
+    print(f"results written to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""JSON result files, so that runs can be compared over time with `python -m benchmarks.compare`."""
+import json
+import platform
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Optional
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write(name: str, params: dict, results: dict, path: Optional[str] = None) -> Path:
+    """
+    Write one run with what is needed to tell runs apart.
+
+    :param name: the benchmark, also the default file name prefix
+    :param results: flat mapping of metric name to number, the part `compare` diffs
+    :return: the path written to, `benchmarks/results/<name>-<timestamp>.json` by default
+    """
+    started = time.strftime("%Y%m%dT%H%M%S")
+    target = Path(path) if path else Path("benchmarks/results") / f"{name}-{started}.json"
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target.write_text(json.dumps({
+        "benchmark": name,
+        "time": started,
+        "commit": _commit(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "params": params,
+        "results": results,
+    }, indent=2))
+    return target
@@ -0,0 +1,84 @@
+import os
+from contextlib import contextmanager
+from typing import Iterator, List
+
+import pytest
+from sqlalchemy import event, insert
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker, create_async_engine
+
+from app.models import Member_Model, RoomModel, SessionModel, User_Session, UserModel
+from app.services.cache import entity_cache
+from app.services.db import Base
+
+# Point to a scratch Postgres database to run the tests against it, an in-memory SQLite by default
+TEST_DB_CONFIG = os.getenv("TEST_DB_CONFIG", "sqlite+aiosqlite://")
+
+TABLES = [UserModel.__table__, RoomModel.__table__, Member_Model.__table__,
+          SessionModel.__table__, User_Session.__table__]
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def engine() -> Iterator[AsyncEngine]:
+    if TEST_DB_CONFIG.startswith("sqlite"):
+        pytest.importorskip("aiosqlite")
+    engine = create_async_engine(TEST_DB_CONFIG)
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all, tables=TABLES)
+        await connection.run_sync(Base.metadata.create_all, tables=TABLES)
+    yield engine
+    async with engine.begin() as connection:
+        await connection.run_sync(Base.metadata.drop_all, tables=TABLES)
+    await engine.dispose()
+
+
+@pytest.fixture
+def sessionmaker(engine):
+    return async_sessionmaker(engine, expire_on_commit=False)
+
+
+@pytest.fixture(autouse=True)
+def no_cache_invalidation(monkeypatch):
+    # The operations invalidate the entity cache in Redis after their writes, not needed here
+    async def invalidate(*keys):
+        pass
+    monkeypatch.setattr(entity_cache, "invalidate", invalidate)
+
+
+async def seed(sessionmaker, users: int, members: int = 0) -> List[int]:
+    """
+    Insert a room with id 1 and `users` users, the first `members` of them members of the room.
+
+    :return: the user ids
+    """
+    async with sessionmaker() as db:
+        user_ids = list((await db.scalars(insert(UserModel).returning(UserModel.uid), [
+            {"name": f"user {i}", "nick_name": f"u{i}", "public_key": "", "status": "",
+             "email": f"user{i}@example.com", "number": f"+1555000{i:04d}"}
+            for i in range(users)
+        ])).all())
+        await db.execute(insert(RoomModel).values(rid=1, room_name="room"))
+        if members:
+            await db.execute(insert(Member_Model), [
+                {"room_id": 1, "user_id": user_id} for user_id in user_ids[:members]])
+        await db.commit()
+    return user_ids
+
+
+@contextmanager
+def count_statements(engine: AsyncEngine) -> Iterator[List[str]]:
+    """Record every statement sent to the database inside the block."""
+    statements: List[str] = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine.sync_engine, "before_cursor_execute", record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine.sync_engine, "before_cursor_execute", record)
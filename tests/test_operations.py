@@ -0,0 +1,44 @@
+import pytest
+
+from app.models.schemas import AddUser, CreateSession
+from app.operations import add_session, add_uses_to_room
+
+from tests.conftest import count_statements, seed
+
+pytestmark = pytest.mark.anyio
+
+
+async def _add_session_statements(engine, sessionmaker, users: int) -> int:
+    user_ids = await seed(sessionmaker, users, members=users)
+    async with sessionmaker() as db:
+        with count_statements(engine) as statements:
+            await add_session(CreateSession(session_name="1", users=user_ids, room_id=1), db)
+    return len(statements)
+
+
+async def _add_users_statements(engine, sessionmaker, users: int) -> int:
+    user_ids = await seed(sessionmaker, users)
+    async with sessionmaker() as db:
+        with count_statements(engine) as statements:
+            await add_uses_to_room(AddUser(room_id=1, user_list=user_ids), db)
+    return len(statements)
+
+
+@pytest.mark.parametrize("users", [10, 100])
+async def test_add_session_statements_do_not_grow_with_users(engine, sessionmaker, users):
+    single = await _add_session_statements(engine, sessionmaker, 1)
+    async with engine.begin() as connection:
+        for table in ("session_data", "sessions", "membership", "rooms", "users"):
+            await connection.exec_driver_sql(f"DELETE FROM {table}")
+
+    assert await _add_session_statements(engine, sessionmaker, users) == single
+
+
+@pytest.mark.parametrize("users", [10, 100])
+async def test_add_users_to_room_statements_do_not_grow_with_users(engine, sessionmaker, users):
+    single = await _add_users_statements(engine, sessionmaker, 1)
+    async with engine.begin() as connection:
+        for table in ("membership", "rooms", "users"):
+            await connection.exec_driver_sql(f"DELETE FROM {table}")
+
+    assert await _add_users_statements(engine, sessionmaker, users) == single
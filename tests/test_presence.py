@@ -0,0 +1,52 @@
+import pytest
+
+from app.services.presence import (EXPIRE_SCRIPT, JOIN_SCRIPT, OFFLINE, ONLINE, connections_key,
+                                   seen_key, state_key)
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+SESSION = 3
+USER = 7
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeRedis()
+
+
+def join(redis, delta: int, state: str, now: float = 100.0):
+    script = redis.register_script(JOIN_SCRIPT)
+    published = script(keys=[state_key(SESSION), seen_key(SESSION), connections_key(SESSION)],
+                       args=[USER, delta, state, now])
+    return published.decode() if published is not None else None
+
+
+def test_user_stays_online_while_another_process_holds_a_socket(redis):
+    assert join(redis, 1, ONLINE) == ONLINE
+    assert join(redis, 1, ONLINE) == ONLINE
+
+    assert join(redis, -1, OFFLINE) is None
+    assert redis.hget(state_key(SESSION), USER) == b"online"
+
+    assert join(redis, -1, OFFLINE) == OFFLINE
+    assert redis.hget(state_key(SESSION), USER) is None
+    assert redis.zscore(seen_key(SESSION), USER) is None
+    assert redis.hget(connections_key(SESSION), USER) is None
+
+
+def test_connect_and_disconnect_within_a_tick(redis):
+    assert join(redis, 0, OFFLINE) == OFFLINE
+    assert redis.hget(connections_key(SESSION), USER) is None
+
+
+def test_expired_users_lose_their_connection_count(redis):
+    join(redis, 1, ONLINE, now=100.0)
+
+    script = redis.register_script(EXPIRE_SCRIPT)
+    expired = script(keys=[seen_key(SESSION), state_key(SESSION), connections_key(SESSION)], args=[150.0])
+
+    assert expired == [str(USER).encode()]
+    assert redis.hget(connections_key(SESSION), USER) is None
+    assert join(redis, 1, ONLINE) == ONLINE
+    assert join(redis, -1, OFFLINE) == OFFLINE
@@ -0,0 +1,81 @@
+import pytest
+
+from app.services import ratelimit
+from app.services.ratelimit import Limit, RateLimiter, TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch) -> Clock:
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, "monotonic", clock)
+    return clock
+
+
+def test_bucket_allows_a_burst_then_refuses(clock):
+    bucket = TokenBucket(Limit(rate=2, burst=3))
+
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+
+
+def test_bucket_refills_at_its_rate(clock):
+    bucket = TokenBucket(Limit(rate=2, burst=3))
+    for _ in range(3):
+        bucket.take()
+
+    clock.now += 0.25
+    assert bucket.take() == pytest.approx(0.25)
+    clock.now += 0.25
+    assert bucket.take() == 0.0
+    assert bucket.take() > 0
+
+
+def test_bucket_never_holds_more_than_its_burst(clock):
+    bucket = TokenBucket(Limit(rate=2, burst=3))
+
+    clock.now += 3600
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() > 0
+
+
+def test_bucket_cost_larger_than_the_tokens_left(clock):
+    bucket = TokenBucket(Limit(rate=4, burst=4))
+    bucket.take(3)
+
+    assert bucket.take(2) == pytest.approx(0.25)
+    assert bucket.tokens == pytest.approx(1)
+
+
+class Script:
+    # Stands for TOKEN_BUCKET_SCRIPT, grants what `replies` says in turn
+    def __init__(self, replies):
+        self.replies = list(replies)
+        self.calls = 0
+
+    async def __call__(self, keys, args):
+        self.calls += 1
+        return self.replies.pop(0)
+
+
+@pytest.mark.anyio
+async def test_limiter_spends_leased_tokens_locally(clock, monkeypatch):
+    monkeypatch.setattr(ratelimit.Config, "RATE_LIMIT_LEASE", 3)
+    limiter = RateLimiter()
+    limiter._bucket = Script([[3, 0], [0, 1500]])
+
+    assert [await limiter.acquire("user:1", Limit(rate=1, burst=10)) for _ in range(3)] == [0.0] * 3
+    assert limiter._bucket.calls == 1
+
+    assert await limiter.acquire("user:1", Limit(rate=1, burst=10)) == pytest.approx(1.5)
+    # The refusal is remembered until the bucket refills
+    clock.now += 1
+    assert await limiter.acquire("user:1", Limit(rate=1, burst=10)) == pytest.approx(0.5)
+    assert limiter._bucket.calls == 2
@@ -0,0 +1,79 @@
+import pytest
+
+from app.services.read_state import (ACK_SCRIPT, COUNT_SCRIPT, DIRTY_KEY, cursor_key, unread_key,
+                                     unread_set_key)
+
+fakeredis = pytest.importorskip("fakeredis")
+pytest.importorskip("lupa")
+
+USER = 7
+SESSION = 3
+
+
+@pytest.fixture
+def redis():
+    return fakeredis.FakeRedis()
+
+
+def count(redis, *mids: int, limit: int = 1000) -> int:
+    script = redis.register_script(COUNT_SCRIPT)
+    return script(keys=[unread_key(USER), unread_set_key(USER, SESSION), cursor_key(USER)],
+                  args=[SESSION, limit, *mids])
+
+
+def ack(redis, mid: int) -> int:
+    script = redis.register_script(ACK_SCRIPT)
+    return script(keys=[cursor_key(USER), unread_key(USER), DIRTY_KEY, unread_set_key(USER, SESSION)],
+                  args=[SESSION, mid, f"{USER}:{SESSION}"])
+
+
+def unread(redis) -> int:
+    return int(redis.hget(unread_key(USER), SESSION) or 0)
+
+
+def test_count_adds_up_the_batches(redis):
+    count(redis, 10, 11)
+    count(redis, 12)
+
+    assert unread(redis) == 3
+
+
+def test_ack_keeps_the_messages_counted_after_it(redis):
+    count(redis, 10, 11, 12, 13)
+
+    assert ack(redis, 11) == 1
+    assert unread(redis) == 2
+    assert int(redis.hget(cursor_key(USER), SESSION)) == 11
+    assert redis.sismember(DIRTY_KEY, f"{USER}:{SESSION}")
+
+
+def test_ack_of_the_last_message_clears_the_counter(redis):
+    count(redis, 10, 11)
+    ack(redis, 11)
+
+    assert redis.hget(unread_key(USER), SESSION) is None
+
+
+def test_late_ack_changes_nothing(redis):
+    count(redis, 10, 11, 12)
+    ack(redis, 11)
+
+    assert ack(redis, 10) == 0
+    assert unread(redis) == 1
+    assert int(redis.hget(cursor_key(USER), SESSION)) == 11
+
+
+def test_messages_already_read_are_not_counted(redis):
+    count(redis, 10)
+    ack(redis, 12)
+    count(redis, 11, 12, 13)
+
+    assert unread(redis) == 1
+
+
+def test_count_keeps_the_newest_messages(redis):
+    count(redis, *range(1, 11), limit=4)
+    assert unread(redis) == 4
+
+    ack(redis, 8)
+    assert unread(redis) == 2
@@ -0,0 +1,46 @@
+from collections import Counter
+
+import pytest
+
+from app.services.sharding import HashRing
+
+NODES = ["10.0.0.1:8000", "10.0.0.2:8000", "10.0.0.3:8000"]
+SESSIONS = range(1, 30001)
+
+
+def owners(ring: HashRing) -> dict:
+    return {session_id: ring.owner(session_id) for session_id in SESSIONS}
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing([]).owner(1) is None
+
+
+def test_owner_does_not_depend_on_the_node_order():
+    assert owners(HashRing(NODES)) == owners(HashRing(list(reversed(NODES))))
+
+
+def test_sessions_spread_evenly():
+    spread = Counter(owners(HashRing(NODES)).values())
+
+    fair = len(SESSIONS) / len(NODES)
+    assert set(spread) == set(NODES)
+    assert all(abs(count - fair) < 0.25 * fair for count in spread.values())
+
+
+def test_adding_a_node_only_moves_sessions_to_it():
+    before = owners(HashRing(NODES))
+    after = owners(HashRing(NODES + ["10.0.0.4:8000"]))
+
+    moved = [session_id for session_id in SESSIONS if before[session_id] != after[session_id]]
+    assert all(after[session_id] == "10.0.0.4:8000" for session_id in moved)
+    assert len(moved) == pytest.approx(len(SESSIONS) / 4, rel=0.25)
+
+
+def test_removing_a_node_only_moves_its_sessions():
+    before = owners(HashRing(NODES))
+    after = owners(HashRing(NODES[1:]))
+
+    for session_id in SESSIONS:
+        if before[session_id] != NODES[0]:
+            assert after[session_id] == before[session_id]
@@ -0,0 +1,94 @@
+import base64
+
+import orjson
+import pytest
+
+from app.services.wire import (HEADER, WireMessage, is_packed, pack, pack_batch, to_json, unpack,
+                               unpack_batch, with_entry_id)
+
+MESSAGE = WireMessage(mid=42, sender_id=7, ciphertext=b"\x00ciphertext\xff", iv=b"i" * 12, tag=b"t" * 16)
+
+
+@pytest.mark.parametrize("message", [
+    MESSAGE,
+    MESSAGE._replace(entry_id=b"1700000000000-3"),
+    MESSAGE._replace(ciphertext=b"", iv=b"", tag=b""),
+])
+def test_pack_round_trip(message):
+    packet = pack(message)
+
+    assert is_packed(packet)
+    assert unpack(packet) == message
+
+
+def test_entry_id_without_sequence_is_sequence_zero():
+    assert unpack(pack(MESSAGE._replace(entry_id=b"1700000000000"))).entry_id == b"1700000000000-0"
+
+
+def test_with_entry_id_keeps_the_message():
+    packet = with_entry_id(pack(MESSAGE), b"5-1")
+
+    assert unpack(packet) == MESSAGE._replace(entry_id=b"5-1")
+
+
+@pytest.mark.parametrize("size", [0, 1, HEADER.size - 1])
+def test_unpack_rejects_a_truncated_header(size):
+    with pytest.raises(ValueError, match="truncated header"):
+        unpack(pack(MESSAGE)[:size])
+
+
+def test_unpack_rejects_a_truncated_entry_id():
+    packet = pack(MESSAGE._replace(entry_id=b"5-1"))
+
+    with pytest.raises(ValueError, match="truncated entry id"):
+        unpack(packet[:HEADER.size + 4])
+
+
+def test_unpack_rejects_a_truncated_payload():
+    with pytest.raises(ValueError, match="truncated payload"):
+        unpack(pack(MESSAGE)[:HEADER.size + 4])
+
+
+@pytest.mark.parametrize("packet", [
+    b"\x00" + pack(MESSAGE)[1:],
+    pack_batch([pack(MESSAGE)]) + b"\x00" * HEADER.size,
+])
+def test_unpack_rejects_what_is_not_a_message(packet):
+    with pytest.raises(ValueError, match="not a message packet"):
+        unpack(packet)
+
+
+def test_text_is_never_packed():
+    assert not is_packed("{\"text\": \"hello\"}".encode())
+
+
+def test_batch_round_trip():
+    messages = [MESSAGE, MESSAGE._replace(mid=43, entry_id=b"6-0"), MESSAGE._replace(mid=44, ciphertext=b"")]
+
+    assert unpack_batch(pack_batch([pack(message) for message in messages])) == messages
+    assert unpack_batch(pack_batch([])) == []
+
+
+def test_unpack_batch_rejects_bad_packets():
+    batch = pack_batch([pack(MESSAGE), pack(MESSAGE)])
+
+    with pytest.raises(ValueError, match="not a batch packet"):
+        unpack_batch(pack(MESSAGE))
+    with pytest.raises(ValueError, match="truncated batch"):
+        unpack_batch(batch[:len(pack_batch([pack(MESSAGE)]))])
+    with pytest.raises(ValueError, match="truncated batch"):
+        unpack_batch(batch[:-1])
+
+
+def test_to_json_encodes_binary_fields():
+    document = orjson.loads(to_json(pack(MESSAGE), b"9-9"))
+
+    assert document == {
+        "mid": 42,
+        "sender_id": 7,
+        "ciphertext": base64.b64encode(MESSAGE.ciphertext).decode(),
+        "iv": base64.b64encode(MESSAGE.iv).decode(),
+        "tag": base64.b64encode(MESSAGE.tag).decode(),
+        "id": "9-9",
+    }
+    assert "id" not in orjson.loads(to_json(pack(MESSAGE)))